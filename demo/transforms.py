@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import numpy as np
+import os
 from os import path
 import yaml
 
@@ -9,9 +10,23 @@ from pytransform3d import rotations as pr
 from pytransform3d import transformations as pt
 from pytransform3d.transform_manager import TransformManager
 
+_TF_FILE = path.join(path.dirname(path.realpath(__file__)), '../calibration/transforms.yaml')
+
+
 def _read_yaml_file(filename):
-    file = open(filename, 'r')
-    return yaml.safe_load(file)
+    with open(filename, 'r') as file:
+        return yaml.safe_load(file)
+
+
+_tf_statics_cache = {}
+def _read_tf_statics(filename):
+    # Only parse the yaml file again if it changed on disk
+    mtime = os.stat(filename).st_mtime_ns
+    cached = _tf_statics_cache.get(filename)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, _read_yaml_file(filename))
+        _tf_statics_cache[filename] = cached
+    return cached[1]
 
 
 def _generate_tf_manager(tf_statics, object='setup', tm=None):
@@ -37,12 +52,78 @@ def _generate_tf_manager_for_all(tf_statics):
 
 
 def get_tf_manager():
-    filename = path.join(path.dirname(path.realpath(__file__)), '../calibration/transforms.yaml')
+    # Returns a new manager every time, since users will usually add their own (dynamic) transforms
+    filename = _TF_FILE
     if path.isfile(filename):
-        tf_statics = _read_yaml_file(filename)
+        tf_statics = _read_tf_statics(filename)
         tf_manager = _generate_tf_manager_for_all(tf_statics)
         return tf_manager
     else:
         print(f"Tf file '{filename}' not found, returning an empty tf manager")
         return TransformManager()
 
+
+class TransformRegistry:
+    """
+    Read-only lookup of the static transforms. All chains between frames that are connected by 
+    static transforms (e.g. setup/sonar -> setup/portal_crane or target/100lbs -> world) are 
+    resolved once, so later lookups don't have to walk the transform graph. The registry is 
+    recompiled automatically when the yaml file changes.
+    """
+    def __init__(self, filename=_TF_FILE):
+        self.filename = filename
+        self._mtime = None
+        self._transforms = {}
+        self._frames = []
+
+    def _compile(self):
+        mtime = os.stat(self.filename).st_mtime_ns
+        if mtime == self._mtime:
+            return
+
+        tm = _generate_tf_manager_for_all(_read_tf_statics(self.filename))
+        frames = list(tm.nodes)
+        transforms = {}
+        for frame_a in frames:
+            for frame_b in frames:
+                try:
+                    transforms[(frame_a, frame_b)] = tm.get_transform(frame_a, frame_b)
+                except KeyError:
+                    # Not connected by static transforms (e.g. setup and targets)
+                    pass
+
+        self._frames = frames
+        self._transforms = transforms
+        self._mtime = mtime
+
+    @property
+    def frames(self):
+        self._compile()
+        return list(self._frames)
+
+    def has_transform(self, frame_a, frame_b):
+        self._compile()
+        return (frame_a, frame_b) in self._transforms
+
+    def get_transform(self, frame_a, frame_b):
+        # Same semantics as TransformManager.get_transform: maps points from frame_a to frame_b
+        self._compile()
+        try:
+            return self._transforms[(frame_a, frame_b)].copy()
+        except KeyError:
+            raise KeyError(f"No static transform from '{frame_a}' to '{frame_b}'") from None
+
+    def transform_points(self, frame_a, frame_b, points):
+        # Points of shape (N, 3) given in frame_a, returns them in frame_b
+        A2B = self.get_transform(frame_a, frame_b)
+        points = np.asarray(points, dtype=float)
+        return points @ A2B[:3, :3].T + A2B[:3, 3]
+
+
+_tf_registry = None
+def get_tf_registry():
+    global _tf_registry
+    if _tf_registry is None:
+        _tf_registry = TransformRegistry()
+    return _tf_registry
+
@@ -0,0 +1,174 @@
+import os
+import sys
+import threading
+import weakref
+from collections import OrderedDict
+
+
+# Weak references, so that caches of e.g. closed viewers can be garbage collected
+_all_caches = weakref.WeakSet()
+
+
+def estimate_size(obj):
+    # Rough memory footprint in bytes; exact enough to keep caches bounded
+    if hasattr(obj, 'memory_usage'):
+        # pandas DataFrame / Series
+        usage = obj.memory_usage(deep=True)
+        return int(usage.sum()) if hasattr(usage, 'sum') else int(usage)
+    if hasattr(obj, 'nbytes'):
+        # numpy arrays
+        return int(obj.nbytes)
+    if hasattr(obj, 'sizeInBytes'):
+        # QImage
+        return int(obj.sizeInBytes())
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(estimate_size(k) + estimate_size(v) for k,v in obj.items())
+    if isinstance(obj, (list, tuple, set)):
+        return sys.getsizeof(obj) + sum(estimate_size(x) for x in obj)
+    return sys.getsizeof(obj)
+
+
+def _file_signature(path):
+    try:
+        st = os.stat(path)
+    except (FileNotFoundError, TypeError):
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+
+class LRUCache:
+    """
+    Least recently used cache that is bounded by number of items and/or memory. Entries can depend
+    on files, in which case they are reloaded as soon as one of these files is modified, created or
+    deleted.
+    """
+    def __init__(self, name, max_items=None, max_bytes=None, sizeof=estimate_size):
+        self.name = name
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+
+        self._entries = OrderedDict()  # key -> (value, size, file signatures)
+        self._bytes = 0
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        _all_caches.add(self)
+
+    def get(self, key, load, depends_on=()):
+        signature = tuple(_file_signature(p) for p in depends_on)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[2] == signature:
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    return entry[0]
+
+                # One of the files changed on disk
+                self.invalidations += 1
+                self._remove(key)
+            self.misses += 1
+
+        # Don't block other threads while loading
+        value = load()
+        self.put(key, value, signature)
+        return value
+
+    def lookup(self, key, default=None):
+        # Like get, but never loads anything; counts towards the statistics
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def peek(self, key, default=None):
+        # Does not change the order or statistics and ignores file dependencies
+        with self._lock:
+            entry = self._entries.get(key)
+            return default if entry is None else entry[0]
+
+    def put(self, key, value, signature=()):
+        size = self.sizeof(value)
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (value, size, signature)
+            self._bytes += size
+            self._evict()
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def _evict(self):
+        # Always keep the newest entry, even if it alone exceeds the memory limit
+        while len(self._entries) > 1 and (
+            (self.max_items is not None and len(self._entries) > self.max_items) or
+            (self.max_bytes is not None and self._bytes > self.max_bytes)
+        ):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size_bytes(self):
+        return self._bytes
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return dict(
+            items=len(self._entries),
+            bytes=self._bytes,
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=self.hits / requests if requests else 0.,
+            evictions=self.evictions,
+            invalidations=self.invalidations,
+        )
+
+    def __repr__(self):
+        s = self.stats()
+        return (f'{self.name}: {s["items"]} items, {s["bytes"] / 1e6:.1f}MB, '
+                f'{s["hits"]} hits, {s["misses"]} misses ({s["hit_rate"]:.0%}), '
+                f'{s["evictions"]} evicted, {s["invalidations"]} invalidated')
+
+
+def _live_caches():
+    return list(_all_caches)
+
+
+def get_cache_stats():
+    return {c.name: c.stats() for c in _live_caches()}
+
+
+def print_cache_stats():
+    for c in _live_caches():
+        print(c)
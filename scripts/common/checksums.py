@@ -0,0 +1,190 @@
+import os
+import sys
+import time
+import shutil
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+
+
+"""
+Checksums of the exported dataset. The export hashes every file while writing it; each recording
+lists its files in checksums.sha256, and the whole release is covered by release_manifest.sha256
+in the export dir. Both use the format of sha256sum, so they can also be checked with
+"sha256sum -c". Run "python -m common.checksums <dataset_dir>" to verify a (downloaded) dataset
+against its manifest using all cores.
+"""
+
+
+# Files are hashed while they are being written, so every byte only has to pass through once
+CHUNK_SIZE = 1 << 20
+CHECKSUM_ALGORITHM = 'sha256'
+
+CHECKSUM_FILE = 'checksums.sha256'
+RELEASE_MANIFEST = 'release_manifest.sha256'
+
+
+def new_hash():
+    return hashlib.new(CHECKSUM_ALGORITHM)
+
+
+def file_checksum(path, chunk_size=CHUNK_SIZE):
+    h = new_hash()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def copy_with_checksum(src, dst, chunk_size=CHUNK_SIZE):
+    # Same as shutil.copy, but returns the checksum of the copied data without reading it twice
+    h = new_hash()
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        while chunk := fin.read(chunk_size):
+            h.update(chunk)
+            fout.write(chunk)
+    return h.hexdigest()
+
+
+def write_with_checksum(dst, data):
+    h = new_hash()
+    h.update(data)
+    with open(dst, 'wb') as f:
+        f.write(data)
+    return h.hexdigest()
+
+
+def write_checksum_file(path, checksums):
+    # Same format as sha256sum, so the result can also be checked with "sha256sum -c"
+    with open(path, 'w') as f:
+        for relpath, checksum in sorted(checksums.items()):
+            f.write(f'{checksum}  {relpath}\n')
+
+
+def read_checksum_file(path):
+    checksums = {}
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            checksum, relpath = line.split('  ', maxsplit=1)
+            checksums[relpath] = checksum
+    return checksums
+
+
+def stat_signature(path):
+    # Cheap fingerprint that changes whenever a file is rewritten. Directories change whenever
+    # files are added or removed.
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def copytree_with_checksums(src, dst, ignore=None):
+    # Same as shutil.copytree, but returns the checksums of all copied files (paths relative to dst)
+    checksums = {}
+
+    def copy_function(s, d):
+        checksums[os.path.relpath(d, dst).replace(os.sep, '/')] = copy_with_checksum(s, d)
+        shutil.copystat(s, d)
+
+    shutil.copytree(src, dst, ignore=ignore, copy_function=copy_function, dirs_exist_ok=True)
+    return checksums
+
+
+def write_release_manifest(root, known=None):
+    """
+    Writes the checksums of all files below root into the release manifest. Checksums that are
+    already known (from the export's checksum files or the known dict, paths relative to root) are
+    reused, so only files without one are read. Returns the number of files that had to be hashed.
+    """
+    known = dict(known or {})
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        reldir = os.path.relpath(dirpath, root).replace(os.sep, '/')
+        prefix = '' if reldir == '.' else reldir + '/'
+        if CHECKSUM_FILE in filenames:
+            for relpath, checksum in read_checksum_file(os.path.join(dirpath, CHECKSUM_FILE)).items():
+                known.setdefault(prefix + relpath, checksum)
+        files += [prefix + f for f in filenames if prefix + f != RELEASE_MANIFEST]
+
+    checksums = {}
+    num_hashed = 0
+    for relpath in tqdm(files, desc='manifest'):
+        checksum = known.get(relpath)
+        if checksum is None:
+            checksum = file_checksum(os.path.join(root, relpath))
+            num_hashed += 1
+        checksums[relpath] = checksum
+
+    write_checksum_file(os.path.join(root, RELEASE_MANIFEST), checksums)
+    return num_hashed
+
+
+def _check_file(args):
+    path, expected = args
+    try:
+        return path, file_checksum(path) == expected, os.path.getsize(path)
+    except OSError:
+        return path, None, 0
+
+
+def verify_checksums(root, manifest_file=None, workers=0):
+    """
+    Checks all files listed in the manifest (default: the release manifest in root) on all cores.
+    Returns the lists of missing and mismatched files.
+    """
+    manifest_file = manifest_file or os.path.join(root, RELEASE_MANIFEST)
+    base_dir = os.path.dirname(os.path.abspath(manifest_file)) if root is None else root
+    checksums = read_checksum_file(manifest_file)
+    tasks = [(os.path.join(base_dir, relpath), checksum) for relpath, checksum in checksums.items()]
+
+    missing = []
+    mismatched = []
+    num_bytes = 0
+    t = time.perf_counter()
+    with ProcessPoolExecutor(workers or os.cpu_count()) as pool:
+        for path, ok, size in tqdm(pool.map(_check_file, tasks, chunksize=16), total=len(tasks), desc='verifying'):
+            relpath = os.path.relpath(path, base_dir)
+            if ok is None:
+                missing.append(relpath)
+            elif not ok:
+                mismatched.append(relpath)
+            num_bytes += size
+    duration = time.perf_counter() - t
+
+    print(f'Checked {len(tasks)} files ({num_bytes / 1e6:.1f}MB) in {duration:.1f}s '
+          f'({num_bytes / 1e6 / max(duration, 1e-9):.1f}MB/s)')
+    return missing, mismatched
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Verify a dataset against its checksum manifest')
+    parser.add_argument('dataset_dir', nargs='?', default=None, help='defaults to the directory of the manifest')
+    parser.add_argument('-m', '--manifest', default=None, help=f'manifest to check against, defaults to <dataset_dir>/{RELEASE_MANIFEST}')
+    parser.add_argument('-w', '--workers', type=int, default=0, help='number of processes, 0 to use all cores')
+    parser.add_argument('--write', action='store_true', help='(re)write the release manifest of dataset_dir instead')
+
+    args = parser.parse_args()
+    if args.dataset_dir is None and args.manifest is None:
+        parser.error('dataset_dir or --manifest is required')
+
+    if args.write:
+        num_hashed = write_release_manifest(args.dataset_dir)
+        print(f'Wrote {os.path.join(args.dataset_dir, RELEASE_MANIFEST)}, {num_hashed} files had to be hashed')
+        sys.exit(0)
+
+    missing, mismatched = verify_checksums(args.dataset_dir, args.manifest, args.workers)
+    for relpath in missing:
+        print(f'MISSING: {relpath}')
+    for relpath in mismatched:
+        print(f'FAILED: {relpath}')
+    if missing or mismatched:
+        print(f'{len(missing)} files missing, {len(mismatched)} files corrupted')
+        sys.exit(1)
+    print('OK')
@@ -0,0 +1,297 @@
+import os
+import time
+import argparse
+import sqlite3
+import numpy as np
+
+from common.checksums import stat_signature
+
+
+"""
+Index of an exported dataset in a single SQLite file (<export_dir>/dataset_index.sqlite), so that
+viewers and loaders don't have to list and sort thousands of files per recording. It contains the
+recordings (target type, location, modalities present), every exported ARIS frame with the sizes
+of its files, and the sizes of the per-recording tables. release_1_export.py keeps it up to date;
+it can also be (re)built for an existing export with "python -m common.dataset_index <export_dir>".
+
+Recordings are only rescanned if their folder, manifest or tables changed since they were indexed.
+"""
+
+
+INDEX_FILE = 'dataset_index.sqlite'
+INDEX_VERSION = 1
+
+FRAME_MODALITIES = ('aris_raw', 'aris_polar', 'gopro')
+TABLE_FILES = {
+    'gantry': 'gantry.csv',
+    'ar3': 'ar3.csv',
+    'meta': 'aris_frame_meta.csv',
+    'pose': 'sonar_pose.csv',
+    'pose_npz': 'sonar_pose.npz',
+}
+OTHER_FILES = ['aris_file_meta.yaml', 'notes.txt', 'manifest.yaml', 'checksums.sha256']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS info (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS recordings (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL,
+    target_type TEXT NOT NULL,
+    num_frames INTEGER NOT NULL,
+    modalities TEXT NOT NULL,
+    aris_raw_ext TEXT,
+    aris_polar_ext TEXT,
+    gopro_ext TEXT,
+    signature TEXT
+);
+CREATE TABLE IF NOT EXISTS frames (
+    recording_id INTEGER NOT NULL,
+    aris_frame_idx INTEGER NOT NULL,
+    aris_raw_size INTEGER,
+    aris_polar_size INTEGER,
+    gopro_size INTEGER,
+    PRIMARY KEY (recording_id, aris_frame_idx)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS files (
+    recording_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (recording_id, name)
+) WITHOUT ROWID;
+"""
+
+# File sizes are -1 for missing files
+FRAME_DTYPE = np.dtype([
+    ('aris_frame_idx', np.int32),
+    ('aris_raw_size', np.int64),
+    ('aris_polar_size', np.int64),
+    ('gopro_size', np.int64),
+])
+
+
+def get_index_path(export_dir):
+    return os.path.join(export_dir, INDEX_FILE)
+
+
+def iter_recordings(root):
+    # Accepts the export dir, its recordings folder or a single recording. Exported recordings are
+    # placed in recordings/<target_type>/<recording>.
+    if os.path.isfile(os.path.join(root, 'gantry.csv')):
+        yield os.path.basename(os.path.dirname(os.path.abspath(root))), os.path.abspath(root)
+        return
+
+    recordings_dir = os.path.join(root, 'recordings')
+    if not os.path.isdir(recordings_dir):
+        recordings_dir = root
+
+    for target_type in sorted(os.listdir(recordings_dir)):
+        target_dir = os.path.join(recordings_dir, target_type)
+        if not os.path.isdir(target_dir):
+            continue
+        for rec_name in sorted(os.listdir(target_dir)):
+            rec_dir = os.path.join(target_dir, rec_name)
+            if os.path.isfile(os.path.join(rec_dir, 'gantry.csv')):
+                yield target_type, os.path.abspath(rec_dir)
+
+
+def _recording_signature(rec_dir):
+    # Files are only added or removed by the export and release_1b, which changes the folder's mtime.
+    # The tables are also listed since release_1b overwrites its pose tables in place.
+    files = ['manifest.yaml'] + list(TABLE_FILES.values())
+    return repr([stat_signature(rec_dir)] + [stat_signature(os.path.join(rec_dir, f)) for f in files])
+
+
+def _scan_frames(frame_dir):
+    # Frame numbers, file sizes and file extension of an export folder (e.g. aris_polar/0042.png)
+    frames = {}
+    ext = None
+    try:
+        with os.scandir(frame_dir) as it:
+            for entry in it:
+                stem, ext_ = os.path.splitext(entry.name)
+                if stem.isdigit():
+                    frames[int(stem)] = entry.stat().st_size
+                    ext = ext_
+    except FileNotFoundError:
+        pass
+    return frames, ext
+
+
+def scan_recording(rec_dir):
+    frame_sizes = {}
+    exts = {}
+    for modality in FRAME_MODALITIES:
+        frame_sizes[modality], exts[modality] = _scan_frames(os.path.join(rec_dir, modality))
+
+    # Same rule as everywhere else: we step through the ARIS frames
+    aris_frames = frame_sizes['aris_polar'] or frame_sizes['aris_raw']
+    frames = [(idx, frame_sizes['aris_raw'].get(idx), frame_sizes['aris_polar'].get(idx), frame_sizes['gopro'].get(idx))
+              for idx in sorted(aris_frames)]
+
+    files = {}
+    for name in list(TABLE_FILES.values()) + OTHER_FILES:
+        path = os.path.join(rec_dir, name)
+        if os.path.isfile(path):
+            files[name] = os.path.getsize(path)
+
+    modalities = [m for m in FRAME_MODALITIES if frame_sizes[m]]
+    modalities += [m for m,f in TABLE_FILES.items() if f in files and m != 'pose_npz']
+    if TABLE_FILES['pose_npz'] in files and 'pose' not in modalities:
+        modalities.append('pose')
+
+    return frames, exts, files, modalities
+
+
+def _connect(index_file, readonly=False):
+    if readonly:
+        return sqlite3.connect(f'file:{index_file}?mode=ro', uri=True, check_same_thread=False)
+    conn = sqlite3.connect(index_file)
+    conn.executescript(SCHEMA)
+    conn.execute('INSERT OR REPLACE INTO info VALUES (?, ?)', ('version', str(INDEX_VERSION)))
+    return conn
+
+
+def _delete_recording(conn, rec_id):
+    conn.execute('DELETE FROM frames WHERE recording_id = ?', (rec_id,))
+    conn.execute('DELETE FROM files WHERE recording_id = ?', (rec_id,))
+    conn.execute('DELETE FROM recordings WHERE id = ?', (rec_id,))
+
+
+def update_index(export_dir, force=False, verbose=False):
+    """
+    Adds all recordings of an export to its index and rescans those that changed. Recordings that
+    no longer exist are removed. Returns the number of (re)indexed recordings.
+    """
+    export_dir = os.path.abspath(export_dir)
+    conn = _connect(get_index_path(export_dir))
+    num_updated = 0
+
+    with conn:
+        known = {path: (rec_id, signature) for rec_id, path, signature in conn.execute('SELECT id, path, signature FROM recordings')}
+        found = set()
+
+        for target_type, rec_dir in iter_recordings(export_dir):
+            relpath = os.path.relpath(rec_dir, export_dir)
+            found.add(relpath)
+            signature = _recording_signature(rec_dir)
+            if relpath in known:
+                rec_id, old_signature = known[relpath]
+                if old_signature == signature and not force:
+                    continue
+                _delete_recording(conn, rec_id)
+
+            frames, exts, files, modalities = scan_recording(rec_dir)
+            cur = conn.execute(
+                'INSERT INTO recordings (path, name, target_type, num_frames, modalities, aris_raw_ext, aris_polar_ext, gopro_ext, signature) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (relpath, os.path.basename(rec_dir), target_type, len(frames), ','.join(modalities),
+                 exts['aris_raw'], exts['aris_polar'], exts['gopro'], signature))
+            rec_id = cur.lastrowid
+            conn.executemany('INSERT INTO frames VALUES (?, ?, ?, ?, ?)', [(rec_id,) + f for f in frames])
+            conn.executemany('INSERT INTO files VALUES (?, ?, ?)', [(rec_id, name, size) for name, size in files.items()])
+            num_updated += 1
+            if verbose:
+                print(f' -> indexed {relpath}: {len(frames)} frames, {",".join(modalities)}')
+
+        for relpath, (rec_id, _) in known.items():
+            if relpath not in found:
+                _delete_recording(conn, rec_id)
+                if verbose:
+                    print(f' -> removed {relpath}')
+
+    conn.close()
+    return num_updated
+
+
+class DatasetIndex:
+    """
+    Read access to the index of an export. Opening it only loads the (small) recordings table,
+    frames are queried per recording.
+    """
+    def __init__(self, index_file):
+        self.index_file = os.path.abspath(index_file)
+        self.export_dir = os.path.dirname(self.index_file)
+        self._conn = _connect(self.index_file, readonly=True)
+
+        columns = ['id', 'path', 'name', 'target_type', 'num_frames', 'modalities', 'aris_raw_ext', 'aris_polar_ext', 'gopro_ext']
+        self.recordings = []
+        for row in self._conn.execute(f'SELECT {", ".join(columns)} FROM recordings ORDER BY path'):
+            rec = dict(zip(columns, row))
+            rec['modalities'] = rec['modalities'].split(',') if rec['modalities'] else []
+            rec['abspath'] = os.path.join(self.export_dir, rec['path'])
+            self.recordings.append(rec)
+        self._by_path = {os.path.normpath(rec['abspath']): rec for rec in self.recordings}
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def find_recording(self, rec_dir):
+        return self._by_path.get(os.path.normpath(os.path.abspath(rec_dir)))
+
+    def recordings_under(self, path):
+        # All recordings inside a folder of the export, e.g. recordings/<target_type>
+        path = os.path.normpath(os.path.abspath(path))
+        return [rec for rec in self.recordings
+                if rec['abspath'] == path or rec['abspath'].startswith(path + os.sep)]
+
+    def get_frames(self, rec_id):
+        rows = self._conn.execute(
+            'SELECT aris_frame_idx, IFNULL(aris_raw_size, -1), IFNULL(aris_polar_size, -1), IFNULL(gopro_size, -1) '
+            'FROM frames WHERE recording_id = ? ORDER BY aris_frame_idx', (rec_id,)).fetchall()
+        return np.array(rows, dtype=FRAME_DTYPE) if rows else np.empty(0, dtype=FRAME_DTYPE)
+
+    def get_files(self, rec_id):
+        return dict(self._conn.execute('SELECT name, size FROM files WHERE recording_id = ?', (rec_id,)))
+
+    def get_frame_path(self, rec, modality, aris_frame_idx):
+        return os.path.join(rec['abspath'], modality, f'{aris_frame_idx:04}{rec[modality + "_ext"]}')
+
+
+def find_index(path, max_levels=3):
+    # Index of the export that path (export dir, recordings folder or a single recording) belongs to
+    path = os.path.abspath(path)
+    for _ in range(max_levels + 1):
+        index_file = get_index_path(path)
+        if os.path.isfile(index_file):
+            try:
+                return DatasetIndex(index_file)
+            except sqlite3.Error as e:
+                print(f'Ignoring broken dataset index {index_file}: {e}')
+                return None
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or update the index of an exported dataset')
+    parser.add_argument('export_dir')
+    parser.add_argument('-f', '--force', action='store_true', help='rescan all recordings')
+    parser.add_argument('-l', '--list', action='store_true', help='list the indexed recordings')
+
+    args = parser.parse_args()
+
+    t = time.perf_counter()
+    num_updated = update_index(args.export_dir, force=args.force, verbose=True)
+    print(f'Updated {num_updated} recordings in {time.perf_counter() - t:.2f}s')
+
+    t = time.perf_counter()
+    index = DatasetIndex(get_index_path(args.export_dir))
+    num_frames = sum(len(index.get_frames(rec['id'])) for rec in index.recordings)
+    print(f'Index with {len(index.recordings)} recordings and {num_frames} frames read in {(time.perf_counter() - t) * 1000:.1f}ms')
+
+    if args.list:
+        for rec in index.recordings:
+            print(f' - {rec["path"]}: {rec["num_frames"]} frames, {",".join(rec["modalities"])}')
@@ -0,0 +1,182 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+
+from common.checksums import write_with_checksum, file_checksum
+
+
+"""
+Encoding the GoPro frames is by far the most expensive part of the export, so there are two ways
+to write them:
+ - opencv: the export loop decodes the frames and a thread pool encodes and writes them (OpenCV
+   releases the GIL while encoding), with control over the JPEG quality and chroma subsampling
+ - ffmpeg: an external ffmpeg process decodes the clip and writes the selected frames as an image
+   sequence directly from the video's YUV data, without passing them through Python or converting
+   them to BGR and back. Frames are selected by their index in the clip, like the frame index
+   used by opencv. Needs ffmpeg >= 5.1.
+
+StageTimer collects the time spent per stage of the export, so the throughput of each stage can be
+compared.
+"""
+
+
+GOPRO_ENCODERS = ('opencv', 'ffmpeg')
+
+# Chroma subsampling of jpg frames, for OpenCV and ffmpeg
+JPEG_SUBSAMPLING = {
+    '444': (cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444, 'yuvj444p'),
+    '422': (cv2.IMWRITE_JPEG_SAMPLING_FACTOR_422, 'yuvj422p'),
+    '420': (cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420, 'yuvj420p'),
+}
+
+
+class StageTimer:
+    """
+    Sums up time, number of items and bytes per named stage. Can be shared between threads; stages
+    running in a thread pool accumulate the time of all threads.
+    """
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, items=1, num_bytes=0):
+        with self._lock:
+            total = self.stages.setdefault(stage, [0., 0, 0])
+            total[0] += seconds
+            total[1] += items
+            total[2] += num_bytes
+
+    @contextmanager
+    def measure(self, stage, items=1, num_bytes=0):
+        t = time.perf_counter()
+        yield
+        self.add(stage, time.perf_counter() - t, items, num_bytes)
+
+    def summary(self):
+        lines = []
+        for stage, (seconds, items, num_bytes) in self.stages.items():
+            line = f'  {stage:<14} {seconds:8.2f}s {items:7} items {items / max(seconds, 1e-9):8.1f}/s'
+            if num_bytes:
+                line += f' {num_bytes / 1e6 / max(seconds, 1e-9):8.1f}MB/s'
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+def get_jpeg_params(quality=95, subsampling='420'):
+    return [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_SAMPLING_FACTOR, JPEG_SUBSAMPLING[subsampling][0]]
+
+
+class GoProFrameWriter:
+    """
+    Encodes and writes frames to <out_dir>/<relpath> in a thread pool. Only two frames per worker
+    can be waiting, so decoding doesn't run away from encoding (a UHD frame takes 25MB).
+    """
+    def __init__(self, out_dir, fmt='jpg', quality=95, subsampling='420', workers=0, timer=None):
+        self.out_dir = out_dir
+        self.ext = '.' + fmt
+        self.params = get_jpeg_params(quality, subsampling) if fmt == 'jpg' else []
+        self.timer = timer or StageTimer()
+
+        workers = workers or os.cpu_count() or 1
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix='gopro_writer')
+        self._slots = threading.Semaphore(2 * workers)
+        self._futures = {}
+
+    def _write(self, relpath, frame):
+        try:
+            t = time.perf_counter()
+            ok, data = cv2.imencode(self.ext, frame, self.params)
+            if not ok:
+                raise IOError(f'Could not encode {relpath}')
+            t_encoded = time.perf_counter()
+            checksum = write_with_checksum(os.path.join(self.out_dir, relpath), data.tobytes())
+            self.timer.add('gopro encode', t_encoded - t, 1, frame.nbytes)
+            self.timer.add('gopro write', time.perf_counter() - t_encoded, 1, data.nbytes)
+            return checksum
+        finally:
+            self._slots.release()
+
+    def submit(self, relpath, frame):
+        # Frames are encoded later, so they must not be modified afterwards
+        self._slots.acquire()
+        self._futures[relpath] = self._pool.submit(self._write, relpath, frame)
+
+    def finish(self):
+        # Waits for all frames and returns their checksums, raises the first error
+        checksums = {relpath: future.result() for relpath, future in self._futures.items()}
+        self._futures = {}
+        return checksums
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def ffmpeg_jpeg_qscale(quality):
+    # Maps the JPEG quality (1-100) onto ffmpeg's quantizer scale (1 is best, 31 worst), so that
+    # frames end up roughly the size OpenCV produces at the same quality (95 -> 1, 90 -> 2, 80 -> 4)
+    return min(max(round((100 - quality) / 5), 1), 31)
+
+
+def extract_frames_ffmpeg(video_file, frames, out_dir, fmt='jpg', quality=95, subsampling='420', ffmpeg='ffmpeg', timer=None):
+    """
+    Writes frames of video_file as images using an external ffmpeg process. frames maps frame
+    indices within the clip to the paths (relative to out_dir) that frame should be written to.
+    Returns the checksums of all written files; frames that ffmpeg couldn't decode are missing.
+    """
+    timer = timer or StageTimer()
+    indices = sorted(frames)
+    if not indices:
+        return {}
+
+    # Output goes to a temporary folder on the same file system first, numbered in selection order
+    tmp_dir = tempfile.mkdtemp(prefix='.ffmpeg_', dir=out_dir)
+    try:
+        # The selection can be thousands of frames long, too much for a command line
+        filter_file = os.path.join(tmp_dir, 'select.txt')
+        with open(filter_file, 'w') as f:
+            f.write("select='" + '+'.join(f'eq(n,{i})' for i in indices) + "'")
+
+        cmd = [ffmpeg, '-hide_banner', '-loglevel', 'error', '-nostdin',
+               '-i', video_file,
+               '-filter_script:v', filter_file,
+               '-fps_mode', 'passthrough',
+               '-frames:v', str(len(indices))]
+        if fmt == 'jpg':
+            cmd += ['-pix_fmt', JPEG_SUBSAMPLING[subsampling][1], '-qmin', '1', '-q:v', str(ffmpeg_jpeg_qscale(quality))]
+        cmd += ['-start_number', '0', os.path.join(tmp_dir, f'%06d.{fmt}')]
+
+        t = time.perf_counter()
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f'ffmpeg failed on {video_file}: {result.stderr.strip()}')
+        extracted = [(idx, os.path.join(tmp_dir, f'{n:06}.{fmt}')) for n, idx in enumerate(indices)]
+        extracted = [(idx, path) for idx, path in extracted if os.path.isfile(path)]
+        num_bytes = sum(os.path.getsize(path) for _, path in extracted)
+        timer.add('gopro ffmpeg', time.perf_counter() - t, len(extracted), num_bytes)
+
+        checksums = {}
+        with timer.measure('gopro write', len(extracted), num_bytes):
+            for idx, path in extracted:
+                relpaths = frames[idx]
+                checksum = file_checksum(path)
+                # The same clip frame can belong to more than one sonar frame
+                for relpath in relpaths[1:]:
+                    shutil.copyfile(path, os.path.join(out_dir, relpath))
+                    checksums[relpath] = checksum
+                os.replace(path, os.path.join(out_dir, relpaths[0]))
+                checksums[relpaths[0]] = checksum
+        return checksums
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,166 @@
+import os
+import glob
+import time
+import argparse
+import numpy as np
+import cv2
+
+
+"""
+Lossless formats for storing the sonar frames (raw and polar), and a benchmark to choose between
+them. Sonar frames are 8 bit grayscale; all formats here reproduce them exactly, but differ a lot in
+size and in the CPU time needed to encode and decode them:
+ - pgm: uncompressed, fastest to read and write
+ - png: zlib compressed, the compression level (0-9) mostly affects encoding time
+ - webp: lossless WebP, usually smaller than png but slower to encode
+ - jxl: lossless JPEG-XL, only if OpenCV was built with libjxl; effort (1-9) trades time for size
+
+Run "python -m common.image_codecs [frame dirs]" to benchmark the formats on a sample of frames
+(by default the extracted raw and polar frames from config.yaml).
+"""
+
+
+LOSSLESS_FORMATS = ('pgm', 'png', 'webp', 'jxl')
+IMAGE_EXTENSIONS = ('.pgm', '.png', '.webp', '.jxl')
+
+
+def is_format_available(fmt):
+    return cv2.haveImageWriter('frame.' + fmt)
+
+
+def get_imwrite_params(fmt, png_compression=3, jxl_effort=7):
+    if fmt == 'pgm':
+        return [cv2.IMWRITE_PXM_BINARY, 1]
+    if fmt == 'png':
+        return [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+    if fmt == 'webp':
+        # Quality above 100 selects the lossless mode
+        return [cv2.IMWRITE_WEBP_QUALITY, 101]
+    if fmt == 'jxl':
+        return [cv2.IMWRITE_JPEGXL_DISTANCE, 0, cv2.IMWRITE_JPEGXL_EFFORT, jxl_effort]
+    raise ValueError(f'{fmt} is not a lossless image format ({", ".join(LOSSLESS_FORMATS)})')
+
+
+def encode_image(img, fmt, **params):
+    if not is_format_available(fmt):
+        raise ValueError(f'{fmt} images are not supported by this OpenCV build')
+    ok, data = cv2.imencode('.' + fmt, img, get_imwrite_params(fmt, **params))
+    if not ok:
+        raise IOError(f'Could not encode image as {fmt}')
+    return data.tobytes()
+
+
+def write_image(path, img, **params):
+    # The format is taken from the file extension
+    with open(path, 'wb') as f:
+        f.write(encode_image(img, os.path.splitext(path)[1][1:].lower(), **params))
+
+
+def decode_sonar_image(data):
+    # WebP has no grayscale mode and decodes to 3 identical channels, which this reduces back to one
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise IOError('Could not decode image')
+    return img
+
+
+def read_sonar_image(path):
+    img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise IOError(f'Could not read {path}')
+    return img
+
+
+def get_benchmark_candidates():
+    # (format, imwrite params) pairs to compare
+    candidates = [('pgm', {})]
+    candidates += [('png', {'png_compression': level}) for level in (0, 1, 3, 6, 9)]
+    if is_format_available('webp'):
+        candidates.append(('webp', {}))
+    if is_format_available('jxl'):
+        candidates += [('jxl', {'jxl_effort': effort}) for effort in (1, 3, 7)]
+    return candidates
+
+
+def benchmark(images, candidates=None, repeat=3):
+    """
+    Encodes and decodes all images in every candidate format, returning one dict per candidate with
+    the mean size and the best of repeat timings per frame. Decoded images are compared against the
+    originals to make sure the format is actually lossless.
+    """
+    results = []
+    raw_bytes = sum(img.nbytes for img in images)
+
+    for fmt, params in candidates or get_benchmark_candidates():
+        t_encode = t_decode = float('inf')
+        for _ in range(repeat):
+            t = time.perf_counter()
+            encoded = [encode_image(img, fmt, **params) for img in images]
+            t_encode = min(t_encode, time.perf_counter() - t)
+
+            t = time.perf_counter()
+            decoded = [decode_sonar_image(data) for data in encoded]
+            t_decode = min(t_decode, time.perf_counter() - t)
+
+        num_bytes = sum(len(data) for data in encoded)
+        results.append({
+            'format': fmt,
+            'params': ', '.join(f'{k}={v}' for k, v in params.items()),
+            'bytes_per_frame': num_bytes / len(images),
+            'ratio': raw_bytes / num_bytes,
+            'encode_ms': t_encode / len(images) * 1000,
+            'decode_ms': t_decode / len(images) * 1000,
+            'lossless': all(np.array_equal(a, b) for a, b in zip(images, decoded)),
+        })
+    return results
+
+
+def print_benchmark(results, title=''):
+    if title:
+        print(title)
+    print(f'  {"format":<6} {"params":<18} {"KB/frame":>9} {"ratio":>6} {"encode ms":>10} {"decode ms":>10}  lossless')
+    for r in results:
+        print(f'  {r["format"]:<6} {r["params"]:<18} {r["bytes_per_frame"] / 1e3:>9.1f} {r["ratio"]:>6.2f} '
+              f'{r["encode_ms"]:>10.2f} {r["decode_ms"]:>10.2f}  {"yes" if r["lossless"] else "NO"}')
+
+
+def sample_frames(frame_dirs, num_samples, seed=0):
+    # Random sample of the frames in all given dirs (including recording subfolders)
+    files = []
+    for frame_dir in frame_dirs:
+        for ext in IMAGE_EXTENSIONS:
+            files += glob.glob(os.path.join(frame_dir, '*' + ext))
+    files = sorted(files)
+    if len(files) > num_samples:
+        rng = np.random.default_rng(seed)
+        files = [files[i] for i in sorted(rng.choice(len(files), num_samples, replace=False))]
+    return [read_sonar_image(f) for f in files]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark lossless image formats on a sample of sonar frames')
+    parser.add_argument('frame_dirs', nargs='*', help='folders containing frames, each benchmarked separately; '
+                                                      'defaults to the raw and polar frames in aris_extract')
+    parser.add_argument('-n', '--num-samples', type=int, default=100, help='number of frames to sample from each set')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='timings are the best of this many runs')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+
+    args = parser.parse_args()
+
+    if args.frame_dirs:
+        frame_sets = {d: [d] for d in args.frame_dirs}
+    else:
+        from common.config import get_config
+        aris_extract = get_config()["aris_extract"]
+        frame_sets = {
+            'raw frames': glob.glob(os.path.join(aris_extract, '*/')),
+            'polar frames': glob.glob(os.path.join(aris_extract, '*/polar/')),
+        }
+
+    for title, frame_dirs in frame_sets.items():
+        images = sample_frames(frame_dirs, args.num_samples, args.seed)
+        if not images:
+            print(f'{title}: no frames found')
+            continue
+        h, w = images[0].shape[:2]
+        print_benchmark(benchmark(images, repeat=args.repeat), f'{title} ({len(images)} frames, e.g. {w}x{h})')
@@ -1,9 +1,15 @@
 import os
+import threading
+from collections import OrderedDict
 import yaml
 import numpy as np
 import pandas as pd
 import cv2
 
+from common.cache import LRUCache
+from common.odometry import get_odometry_path, load_odometry, sort_odometry, world_velocity
+from common.video_index import load_frame_index, FrameSeeker
+
 
 def folder_basename(s):
     if s.endswith('/'):
@@ -11,72 +17,178 @@ def folder_basename(s):
     return os.path.split(s)[-1]
 
 
-_aris_metadata_cache = {}
-def get_aris_metadata(aris_data_dir):
-    if aris_data_dir in _aris_metadata_cache:
-        return _aris_metadata_cache[aris_data_dir]
-    
+# Metadata of all recordings would easily fill up the memory during long matching sessions, so keep 
+# only the most recently used ones. Entries are reloaded when their files change (e.g. _marks.yaml).
+_aris_metadata_cache = LRUCache('aris_metadata', max_items=32, max_bytes=512 * 2**20)
+_aris_marks_cache = LRUCache('aris_marks', max_items=1024)
+_gopro_metadata_cache = LRUCache('gopro_metadata', max_items=8)
+_gantry_metadata_cache = LRUCache('gantry_metadata', max_items=8)
+
+
+def _aris_metadata_files(aris_data_dir):
     aris_basename = folder_basename(aris_data_dir)
-    with open(os.path.join(aris_data_dir, aris_basename + '_metadata.yaml'), 'r') as f:
-        file_meta = yaml.safe_load(f)
+    return (os.path.join(aris_data_dir, aris_basename + '_metadata.yaml'), 
+            os.path.join(aris_data_dir, aris_basename + '_frames.csv'))
+
+
+def get_aris_marks(aris_data_dir):
+    marks_file = os.path.join(aris_data_dir, folder_basename(aris_data_dir) + '_marks.yaml')
     
-    frame_meta = pd.read_csv(os.path.join(aris_data_dir, aris_basename + '_frames.csv'))
+    def load():
+        try:
+            with open(marks_file, 'r') as f:
+                return yaml.safe_load(f)
+        except IOError:
+            return None
     
-    try:
-        with open(os.path.join(aris_data_dir, aris_basename + '_marks.yaml'), 'r') as f:
-            marks_meta = yaml.safe_load(f)
-    except IOError:
-        marks_meta = None
+    return _aris_marks_cache.get(aris_data_dir, load, depends_on=[marks_file])
+
+
+def get_aris_metadata(aris_data_dir):
+    file_meta_file, frame_meta_file = _aris_metadata_files(aris_data_dir)
     
-    _aris_metadata_cache[aris_data_dir] = (file_meta, frame_meta, marks_meta)
+    def load():
+        with open(file_meta_file, 'r') as f:
+            file_meta = yaml.safe_load(f)
+        frame_meta = pd.read_csv(frame_meta_file)
+        return file_meta, frame_meta
+    
+    file_meta, frame_meta = _aris_metadata_cache.get(aris_data_dir, load, depends_on=[file_meta_file, frame_meta_file])
+    marks_meta = get_aris_marks(aris_data_dir)
     return file_meta, frame_meta, marks_meta
 
 
-_gopro_metadata_cache = {}
 def get_gopro_metadata(gopro_files_dir):
-    if gopro_files_dir in _gopro_metadata_cache:
-        return _gopro_metadata_cache[gopro_files_dir]
-    
-    metadata = pd.read_csv(os.path.join(gopro_files_dir, 'gopro_metadata.csv'))
-    _gopro_metadata_cache[gopro_files_dir] = metadata
-    return metadata
+    metadata_file = os.path.join(gopro_files_dir, 'gopro_metadata.csv')
+    return _gopro_metadata_cache.get(gopro_files_dir, lambda: pd.read_csv(metadata_file), depends_on=[metadata_file])
 
 
-_gantry_metadata_cache = {}
 def get_gantry_metadata(gantry_files_dir):
-    if gantry_files_dir in _gantry_metadata_cache:
-        return _gantry_metadata_cache[gantry_files_dir]
-    
-    metadata = pd.read_csv(os.path.join(gantry_files_dir, 'gantry_metadata.csv'))
-    _gantry_metadata_cache[gantry_files_dir] = metadata
-    return metadata
+    metadata_file = os.path.join(gantry_files_dir, 'gantry_metadata.csv')
+    return _gantry_metadata_cache.get(gantry_files_dir, lambda: pd.read_csv(metadata_file), depends_on=[metadata_file])
 
 
-class MatchingContext:
-    def __init__(self, aris_dir, gantry_file, gopro_file, polar_img_format='png'):
-        self.aris_basename = folder_basename(aris_dir)
-        self.gantry_basename = folder_basename(gantry_file)
-        self.gopro_basename = folder_basename(gopro_file)
-        
-        self.recording_label = self.aris_basename
-        
-        # Load ARIS data
-        aris_dir_polar = os.path.join(aris_dir, 'polar')
-        
-        self.aris_frames_raw = sorted(
+# Recording handles: everything that is expensive to set up for a recording is kept around, so that
+# switching back and forth between recordings is cheap
+_aris_frame_list_cache = LRUCache('aris_frame_lists', max_items=64)
+_gantry_data_cache = LRUCache('gantry_data', max_items=16, max_bytes=256 * 2**20)
+_video_info_cache = LRUCache('video_info', max_items=256)
+_frame_index_cache = LRUCache('frame_index', max_items=64)
+
+
+def get_aris_frame_lists(aris_dir, polar_img_format='png'):
+    aris_dir_polar = os.path.join(aris_dir, 'polar')
+    
+    def load():
+        frames_raw = sorted(
             os.path.join(aris_dir, f) 
             for f in os.listdir(aris_dir) 
             if f.lower().endswith('.pgm')
         )
         try:
-            self.aris_frames_polar = sorted(
+            frames_polar = sorted(
                 os.path.join(aris_dir_polar, f) 
                 for f in os.listdir(aris_dir_polar) 
                 if f.lower().endswith(polar_img_format)
             )
         except FileNotFoundError:
+            frames_polar = None
+        return frames_raw, frames_polar
+    
+    # Directory mtimes change when files are added or removed
+    return _aris_frame_list_cache.get((aris_dir, polar_img_format), load, depends_on=[aris_dir, aris_dir_polar])
+
+
+def get_gantry_data(gantry_file):
+    return _gantry_data_cache.get(gantry_file, lambda: pd.read_csv(gantry_file), depends_on=[gantry_file])
+
+
+def get_gantry_velocity(gantry_file):
+    # Timestamps and linear velocities (odometry frame) from the twist of the full odometry that 
+    # prep_5 extracts next to the trajectory, or None if it doesn't exist
+    odom_file = get_odometry_path(gantry_file)
+    
+    def load():
+        if not os.path.isfile(odom_file):
+            return None
+        odom = sort_odometry(load_odometry(odom_file))
+        return odom['timestamp_us'], world_velocity(odom)
+    
+    return _gantry_data_cache.get(('velocity', gantry_file), load, depends_on=[odom_file])
+
+
+def get_video_info(video_file):
+    def load():
+        clip = video_capture_pool.acquire(video_file)
+        info = (int(clip.get(cv2.CAP_PROP_FRAME_COUNT)), clip.get(cv2.CAP_PROP_FPS))
+        video_capture_pool.release(video_file, clip)
+        return info
+    
+    return _video_info_cache.get(video_file, load, depends_on=[video_file])
+
+
+def get_frame_index(video_file):
+    # None if the clip can't be indexed, in which case seeking falls back to CAP_PROP_POS_FRAMES
+    return _frame_index_cache.get(video_file, lambda: load_frame_index(video_file), depends_on=[video_file])
+
+
+class VideoCapturePool:
+    # Keeps a few video files open after they have been used. A capture is handed out exclusively 
+    # (VideoCapture is not thread safe) and should be returned to the pool once it is not needed 
+    # anymore.
+    def __init__(self, max_open=4):
+        self.max_open = max_open
+        self._idle = OrderedDict()  # video_file -> capture
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def acquire(self, video_file):
+        with self._lock:
+            clip = self._idle.pop(video_file, None)
+            if clip is not None:
+                self.hits += 1
+                return clip
+            self.misses += 1
+        return cv2.VideoCapture(video_file)
+    
+    def release(self, video_file, clip):
+        to_close = []
+        with self._lock:
+            if video_file in self._idle:
+                to_close.append(self._idle.pop(video_file))
+            self._idle[video_file] = clip
+            while len(self._idle) > self.max_open:
+                to_close.append(self._idle.popitem(last=False)[1])
+        
+        for c in to_close:
+            c.release()
+    
+    def clear(self):
+        with self._lock:
+            clips = list(self._idle.values())
+            self._idle.clear()
+        for c in clips:
+            c.release()
+    
+    def __repr__(self):
+        return f'video_captures: {len(self._idle)} open, {self.hits} reused, {self.misses} opened'
+
+video_capture_pool = VideoCapturePool()
+
+
+class MatchingContext:
+    def __init__(self, aris_dir, gantry_file, gopro_file, polar_img_format='png'):
+        self.aris_basename = folder_basename(aris_dir)
+        self.gantry_basename = folder_basename(gantry_file)
+        self.gopro_basename = folder_basename(gopro_file)
+        
+        self.recording_label = self.aris_basename
+        
+        # Load ARIS data
+        self.aris_frames_raw, self.aris_frames_polar = get_aris_frame_lists(aris_dir, polar_img_format)
+        if self.aris_frames_polar is None:
             print(f'ARIS dataset {self.aris_basename} does not contain polar frames, using raw frames instead')
-            self.aris_frames_polar = None
         
         self.aris_file_meta, self.aris_frames_meta, self.aris_marks_meta = get_aris_metadata(aris_dir)
         self._aris_frame_idx = 0
@@ -97,7 +209,11 @@ class MatchingContext:
         # Load Gantry recording
         all_gantry_meta = get_gantry_metadata(os.path.dirname(gantry_file))
         self.gantry_meta = all_gantry_meta.loc[all_gantry_meta['file'] == self.gantry_basename].iloc[0]
-        self.gantry_data = pd.read_csv(gantry_file)
+        self.gantry_data = get_gantry_data(gantry_file)
+        self._gantry_t = self.gantry_data['timestamp_us'].to_numpy()
+        self._gantry_xyz = self.gantry_data[['x', 'y', 'z']].to_numpy()
+        self._gantry_file = gantry_file
+        self._gantry_velocity = None  # loaded on demand
         self.gantry_t0 = self.gantry_meta['start_us']
         self.gantry_onset = self.gantry_meta['onset_us']
         self.gantry_duration = self.gantry_meta['end_us'] - self.gantry_t0
@@ -109,13 +225,33 @@ class MatchingContext:
             # GoPro metadata is no longer required (and was never useful)
             #all_gopro_meta = get_gopro_metadata(os.path.dirname(gopro_file))
             #self.gopro_meta = all_gopro_meta.loc[all_gopro_meta['file'] == self.gopro_basename].iloc[0]
-            self.gopro_clip = cv2.VideoCapture(gopro_file)
+            self.gopro_file = gopro_file
+            self._gopro_clip = None
+            self._gopro_seeker = None
             self.gopro_frame_idx = -1
-            self.gopro_frames_total = int(self.gopro_clip.get(cv2.CAP_PROP_FRAME_COUNT))
-            self.gopro_fps = self.gopro_clip.get(cv2.CAP_PROP_FPS)
+            self.gopro_frames_total, self.gopro_fps = get_video_info(gopro_file)
+            self.gopro_index = get_frame_index(gopro_file)
+            if self.gopro_index is not None:
+                self.gopro_frames_total = len(self.gopro_index)
             self.gopro_offset = 0
             self._gopro_frame = None
 
+    @property
+    def gopro_clip(self):
+        # Only opened (or taken from the pool) when frames are actually read
+        if self._gopro_clip is None:
+            self._gopro_clip = video_capture_pool.acquire(self.gopro_file)
+            self.gopro_frame_idx = -1
+            if self.gopro_index is not None:
+                self._gopro_seeker = FrameSeeker(self._gopro_clip, self.gopro_index)
+        return self._gopro_clip
+    
+    def close(self):
+        # Returns the video handle to the pool so that the next context for this clip can reuse it
+        if self.has_gopro and self._gopro_clip is not None:
+            video_capture_pool.release(self.gopro_file, self._gopro_clip)
+            self._gopro_clip = None
+            self._gopro_seeker = None
 
     @property
     def aris_start_frame(self):
@@ -163,15 +299,25 @@ class MatchingContext:
         new_frame_idx = self.aristime_to_gopro_idx(aris_frametime)
         
         if new_frame_idx != self.gopro_frame_idx:
-            self.gopro_clip.set(cv2.CAP_PROP_POS_FRAMES, new_frame_idx)
-            clip_pos = self.gopro_clip.get(cv2.CAP_PROP_POS_FRAMES)
-            
-            if exact and clip_pos != new_frame_idx:
-                return None, clip_pos
+            clip = self.gopro_clip
+            if self._gopro_seeker is not None:
+                # The frame index guarantees that we get exactly the requested frame or nothing
+                gopro_frame = self._gopro_seeker.read(new_frame_idx)
+                if exact and gopro_frame is None:
+                    return None, new_frame_idx
+            else:
+                clip.set(cv2.CAP_PROP_POS_FRAMES, new_frame_idx)
+                clip_pos = clip.get(cv2.CAP_PROP_POS_FRAMES)
+                
+                if exact and clip_pos != new_frame_idx:
+                    return None, clip_pos
+                
+                has_frame, gopro_frame = clip.read()
+                if not has_frame:
+                    gopro_frame = None
             
             self.gopro_frame_idx = new_frame_idx
-            has_frame, gopro_frame = self.gopro_clip.read()
-            if has_frame:
+            if gopro_frame is not None:
                 self._gopro_frame = gopro_frame
         
         return self._gopro_frame, self.gopro_frame_idx
@@ -184,15 +330,36 @@ class MatchingContext:
         
         return range_min, range_max
     
-    def get_gantry_odom(self, aris_frametime):
+    def get_gantry_timepos(self, aris_frametime):
         time_after_onset = aris_frametime - self.get_aris_frametime(self.aris_start_frame)
         timepos = self.gantry_t0 + self.gantry_offset + time_after_onset
         
         timepos = max(timepos, self.gantry_t0)
         timepos = min(timepos, self.gantry_t0 + self.gantry_duration)
+        return timepos
+    
+    def get_gantry_odom(self, aris_frametime):
+        timepos = self.get_gantry_timepos(aris_frametime)
         
-        t = self.gantry_data['timestamp_us']   
-        xi = np.interp(timepos, t, self.gantry_data['x'])
-        yi = np.interp(timepos, t, self.gantry_data['y'])
-        zi = np.interp(timepos, t, self.gantry_data['z'])
+        t = self._gantry_t
+        xi = np.interp(timepos, t, self._gantry_xyz[:, 0])
+        yi = np.interp(timepos, t, self._gantry_xyz[:, 1])
+        zi = np.interp(timepos, t, self._gantry_xyz[:, 2])
         return (xi, yi, zi), timepos
+    
+    def get_gantry_velocity(self, aris_frametime):
+        if self._gantry_velocity is None:
+            self._gantry_velocity = get_gantry_velocity(self._gantry_file)
+            if self._gantry_velocity is None:
+                # Older extractions only have the positions
+                t, idx = np.unique(self._gantry_t, return_index=True)
+                xyz = self._gantry_xyz[idx]
+                vel = np.gradient(xyz, t / 1e6, axis=0) if len(t) > 1 else np.zeros_like(xyz)
+                self._gantry_velocity = (t, vel)
+        
+        timepos = self.get_gantry_timepos(aris_frametime)
+        t, vel = self._gantry_velocity
+        vx = np.interp(timepos, t, vel[:, 0])
+        vy = np.interp(timepos, t, vel[:, 1])
+        vz = np.interp(timepos, t, vel[:, 2])
+        return (vx, vy, vz), timepos
@@ -0,0 +1,82 @@
+import os
+import numpy as np
+from scipy.spatial.transform import Rotation as R, Slerp
+
+
+"""
+Full gantry odometry as extracted by prep_5_gantry_extract.py: one column per field of the
+nav_msgs/Odometry messages, stored as a binary columnar file (<trajectory>_odom.npz) next to the
+trajectory .csv. Position and orientation are given in the odometry frame, the twist (vx.. and
+wx..) in the crane's frame as published by ROS.
+"""
+
+
+ODOMETRY_COLUMNS = {
+    'timestamp_us': np.int64,
+    'x': np.float64, 'y': np.float64, 'z': np.float64,
+    'qx': np.float64, 'qy': np.float64, 'qz': np.float64, 'qw': np.float64,
+    'vx': np.float64, 'vy': np.float64, 'vz': np.float64,
+    'wx': np.float64, 'wy': np.float64, 'wz': np.float64,
+}
+
+POSITION_COLUMNS = ['x', 'y', 'z']
+ORIENTATION_COLUMNS = ['qx', 'qy', 'qz', 'qw']
+TWIST_COLUMNS = ['vx', 'vy', 'vz', 'wx', 'wy', 'wz']
+
+
+def get_odometry_path(gantry_file):
+    return os.path.splitext(gantry_file)[0] + '_odom.npz'
+
+
+def save_odometry(odom_file, odom):
+    # Uncompressed, so that single columns can be loaded without touching the others
+    np.savez(odom_file, **{k: np.asarray(odom[k], dtype=t) for k, t in ODOMETRY_COLUMNS.items()})
+
+
+def load_odometry(odom_file):
+    with np.load(odom_file) as f:
+        return {k: f[k] for k in f.files}
+
+
+def sort_odometry(odom, unique=False):
+    # Sorted by timestamp, optionally without duplicate timestamps (as required for interpolation)
+    if unique:
+        _, idx = np.unique(odom['timestamp_us'], return_index=True)
+    else:
+        idx = np.argsort(odom['timestamp_us'], kind='stable')
+    return {k: v[idx] for k, v in odom.items()}
+
+
+def resample_odometry(odom, rate):
+    # Interpolates all columns to a fixed rate (Hz): linear for positions and twists, spherical
+    # for orientations
+    odom = sort_odometry(odom, unique=True)
+    t = odom['timestamp_us']
+    if len(t) < 2:
+        return odom
+
+    t_new = np.arange(t[0], t[-1] + 1, int(round(1e6 / rate)), dtype=np.int64)
+    res = {'timestamp_us': t_new}
+    for col in POSITION_COLUMNS + TWIST_COLUMNS:
+        res[col] = np.interp(t_new, t, odom[col])
+
+    quats = np.column_stack([odom[col] for col in ORIENTATION_COLUMNS])
+    quats_new = Slerp(t, R.from_quat(quats))(t_new).as_quat()
+    for i, col in enumerate(ORIENTATION_COLUMNS):
+        res[col] = quats_new[:, i]
+    return res
+
+
+def world_velocity(odom):
+    # Linear velocity in the odometry frame, shape (N, 3)
+    quats = np.column_stack([odom[col] for col in ORIENTATION_COLUMNS])
+    velocity = np.column_stack([odom[col] for col in ['vx', 'vy', 'vz']])
+
+    # Messages without a valid orientation are treated as not rotated
+    valid = np.linalg.norm(quats, axis=1) > 1e-9
+    if valid.all():
+        return R.from_quat(quats).apply(velocity)
+    res = velocity.copy()
+    if valid.any():
+        res[valid] = R.from_quat(quats[valid]).apply(velocity[valid])
+    return res
@@ -0,0 +1,223 @@
+import os
+import glob
+import json
+import time
+import hashlib
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+"""
+A small make-like task runner for the preprocessing pipeline (see run_pipeline.py). Each task is
+one step applied to one item (usually a recording), with declared inputs, outputs and parameters.
+
+A task is up to date if it ran successfully before with the same fingerprint and all of its outputs
+still exist. The fingerprint covers the parameters (e.g. the relevant config options) and the path,
+size and modification time of every input file, so a task runs again if an input changed, appeared
+or disappeared. Tasks without a recorded fingerprint (e.g. on the first run over data that was
+prepared by running the scripts by hand) are treated like make does: they are up to date if all
+outputs exist and are newer than all inputs. Tasks are marked as started in the state before they
+run, so outputs left behind by an interrupted run are never mistaken for finished ones.
+
+Fingerprints are computed only once all dependencies of a task are done, so outputs of upstream
+tasks that just ran are taken into account. Independent tasks run in parallel in a process pool.
+"""
+
+
+# Recorded while a task runs, replaced by its fingerprint once it finished
+STARTED = 'started'
+
+
+class Task:
+    """
+    Runs func(*args). Inputs are paths or glob patterns (folders include all files below them),
+    outputs are paths of files or folders. Tasks named in deps have to be done first; deps that
+    are not part of the run count as done.
+    """
+    def __init__(self, step, item, func, args=(), inputs=(), outputs=(), params=None, deps=()):
+        self.step = step
+        self.item = item
+        self.name = f'{step}:{item}' if item else step
+        self.func = func
+        self.args = tuple(args)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.deps = list(deps)
+
+    def __repr__(self):
+        return f'Task({self.name})'
+
+
+def _walk_files(path):
+    for root, dirs, files in os.walk(path):
+        # Byte code is rewritten whenever the scripts run
+        dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+        for f in files:
+            yield os.path.join(root, f)
+
+
+def expand_paths(patterns):
+    files = set()
+    for pattern in patterns:
+        matches = [pattern] if os.path.exists(pattern) else glob.glob(pattern)
+        for path in matches:
+            if os.path.isdir(path):
+                files.update(_walk_files(path))
+            else:
+                files.add(path)
+    return sorted(files)
+
+
+def get_fingerprint(task):
+    h = hashlib.sha256()
+    h.update(json.dumps({'params': task.params, 'inputs': task.inputs}, sort_keys=True, default=str).encode())
+    for path in expand_paths(task.inputs):
+        st = os.stat(path)
+        h.update(f'{path}\0{st.st_size}\0{st.st_mtime_ns}\n'.encode())
+    return h.hexdigest()
+
+
+def _outputs_newer_than_inputs(task):
+    input_files = expand_paths(task.inputs)
+    output_files = expand_paths(task.outputs)
+    if not output_files:
+        return False
+    newest_input = max((os.path.getmtime(f) for f in input_files), default=0.)
+    return min(os.path.getmtime(f) for f in output_files) >= newest_input
+
+
+class PipelineState:
+    # Fingerprints of the last successful run of every task, kept in a json file
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.fingerprints = {}
+        if os.path.isfile(state_file):
+            with open(state_file, 'r') as f:
+                self.fingerprints = json.load(f)
+
+    def get(self, name):
+        return self.fingerprints.get(name)
+
+    def set(self, name, fingerprint):
+        self.fingerprints[name] = fingerprint
+
+    def save(self):
+        # Written after every task, an interrupted run must not leave a broken file behind
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.fingerprints, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.state_file)
+
+
+def check_task(task, state, force=False):
+    """
+    Returns the fingerprint of the task and the reason why it has to run, which is None if the
+    task is up to date.
+    """
+    fingerprint = get_fingerprint(task)
+    if force:
+        return fingerprint, 'forced'
+    if not all(os.path.exists(p) for p in task.outputs):
+        return fingerprint, 'outputs missing'
+
+    last = state.get(task.name)
+    if last == STARTED:
+        return fingerprint, 'did not finish'
+    if last is None:
+        if not task.outputs:
+            return fingerprint, 'never ran'
+        return fingerprint, None if _outputs_newer_than_inputs(task) else 'outputs older than inputs'
+    if last != fingerprint:
+        return fingerprint, 'inputs or options changed'
+    return fingerprint, None
+
+
+def run_tasks(tasks, state, workers=0, dry_run=False, force_steps=(), keep_going=True):
+    """
+    Runs all tasks that are not up to date, each as soon as its dependencies are done. Returns
+    the number of failed tasks. With dry_run, only prints what would run.
+    """
+    tasks = {t.name: t for t in tasks}
+    status = {}         # name -> 'done', 'ran', 'failed' or 'skipped'
+    pending = dict(tasks)
+    running = {}
+    num_failed = 0
+    t_start = time.perf_counter()
+
+    def dep_status(task):
+        states = [status.get(d) if d in tasks else 'done' for d in task.deps]
+        if any(s is None for s in states):
+            return None
+        if any(s in ('failed', 'skipped') for s in states):
+            return 'failed'
+        if any(s == 'ran' for s in states):
+            return 'ran'
+        return 'done'
+
+    pool = None if dry_run else ProcessPoolExecutor(workers or os.cpu_count())
+    try:
+        while pending or running:
+            for name, task in list(pending.items()):
+                deps = dep_status(task)
+                if deps is None:
+                    continue
+                del pending[name]
+
+                if deps == 'failed' or (num_failed and not keep_going):
+                    status[name] = 'skipped'
+                    print(f'[skipped]  {name}')
+                    continue
+
+                fingerprint, reason = check_task(task, state, task.step in force_steps)
+                if reason is None and dry_run and deps == 'ran':
+                    # Upstream tasks would change the inputs first
+                    reason = 'dependencies will run'
+                if reason is None:
+                    if state.get(name) is None and not dry_run:
+                        state.set(name, fingerprint)
+                        state.save()
+                    status[name] = 'done'
+                    continue
+
+                print(f'[{"would run" if dry_run else "running"}] {name} ({reason})')
+                if dry_run:
+                    status[name] = 'ran'
+                    continue
+                state.set(name, STARTED)
+                state.save()
+                running[pool.submit(task.func, *task.args)] = (task, fingerprint, time.perf_counter())
+
+            if not running:
+                if pending:
+                    # Only possible with circular dependencies
+                    for name in pending:
+                        print(f'[skipped]  {name} (unresolvable dependencies)')
+                        status[name] = 'skipped'
+                    pending = {}
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task, fingerprint, t = running.pop(future)
+                try:
+                    future.result()
+                except Exception:
+                    traceback.print_exc()
+                    print(f'[failed]   {task.name}')
+                    status[task.name] = 'failed'
+                    num_failed += 1
+                    continue
+
+                state.set(task.name, fingerprint)
+                state.save()
+                status[task.name] = 'ran'
+                print(f'[done]     {task.name} in {time.perf_counter() - t:.1f}s')
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    counts = {s: list(status.values()).count(s) for s in ('ran', 'done', 'failed', 'skipped')}
+    print(f'{counts["ran"]} tasks {"would run" if dry_run else "ran"}, {counts["done"]} up to date, '
+          f'{counts["failed"]} failed, {counts["skipped"]} skipped ({time.perf_counter() - t_start:.1f}s)')
+    return num_failed
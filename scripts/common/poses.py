@@ -0,0 +1,124 @@
+import sys
+import argparse
+import numpy as np
+from scipy.spatial.transform import Rotation as R
+
+
+"""
+Vectorized poses of the frames mounted to the gantry crane (see BatchPoseEngine). Run
+"python -m common.poses" to compare them against the per-row TransformManager calculation they
+replace on random crane positions and pan & tilt angles.
+"""
+
+
+class BatchPoseEngine:
+    # Calculates the world poses of a frame mounted to the gantry crane for many crane positions at
+    # once. The gantry crane only translates, so everything between the crane and the mounted frame
+    # is static and only has to be looked up once from the transform manager.
+    def __init__(self, tm, frame='setup/ar3', crane_frame='setup/portal_crane'):
+        self.frame = frame
+        self.crane_frame = crane_frame
+
+        # Static chain from the mounted frame to the crane
+        self.frame2crane = tm.get_transform(frame, crane_frame)
+        self.rotation = R.from_matrix(self.frame2crane[:3, :3])
+
+        # Maps homogeneous crane positions (x, y, z, 1) to positions of the mounted frame
+        self._position_map = np.vstack([np.eye(3), self.frame2crane[:3, 3]])
+
+    def positions(self, crane_positions):
+        crane_positions = np.asarray(crane_positions, dtype=float).reshape(-1, 3)
+        crane_positions_h = np.hstack([crane_positions, np.ones((len(crane_positions), 1))])
+        return crane_positions_h @ self._position_map
+
+    def orientations(self, roll_tilt_pan=None):
+        # The pan & tilt unit rotates the mounted frame. Angles are in degrees as found in the ARIS
+        # frame metadata (SonarRoll, SonarTilt, SonarPan).
+        if roll_tilt_pan is None:
+            return self.rotation
+
+        roll_tilt_pan = np.asarray(roll_tilt_pan, dtype=float).reshape(-1, 3)
+        return self.rotation * R.from_euler('xyz', roll_tilt_pan, degrees=True)
+
+    def transforms(self, crane_positions, roll_tilt_pan=None):
+        # Full 4x4 transforms from the mounted frame to the world, shape (N, 4, 4)
+        positions = self.positions(crane_positions)
+        rotations = self.orientations(roll_tilt_pan).as_matrix()
+
+        A2B = np.zeros((len(positions), 4, 4))
+        A2B[:, :3, :3] = rotations
+        A2B[:, :3, 3] = positions
+        A2B[:, 3, 3] = 1.
+        return A2B
+
+    def child_transforms(self, child2frame, crane_positions, roll_tilt_pan=None):
+        # Transforms from a frame further down the static chain (e.g. setup/sonar below setup/ar3) 
+        # to the world, shape (N, 4, 4)
+        return self.transforms(crane_positions, roll_tilt_pan) @ child2frame
+
+
+def invert_transforms(A2B):
+    # Batched inverse of rigid transforms of shape (..., 4, 4)
+    rot_inv = np.swapaxes(A2B[..., :3, :3], -1, -2)
+    B2A = np.zeros_like(A2B)
+    B2A[..., :3, :3] = rot_inv
+    B2A[..., :3, 3] = -(rot_inv @ A2B[..., :3, 3, None])[..., 0]
+    B2A[..., 3, 3] = 1.
+    return B2A
+
+
+def transforms_to_pq(A2B):
+    # Splits transforms of shape (N, 4, 4) into positions (N, 3) and quaternions (N, 4, scalar last)
+    return A2B[:, :3, 3], R.from_matrix(A2B[:, :3, :3]).as_quat()
+
+
+def compare_with_transform_manager(tm, crane_positions, roll_tilt_pan, frame='setup/ar3', 
+                                   crane_frame='setup/portal_crane', world_frame='world'):
+    """
+    Calculates the poses once with BatchPoseEngine and once per row by moving the crane in the
+    transform manager (as the export used to). Returns the maximum position deviation and the
+    maximum angle (radians) between the orientations; q and -q are the same orientation.
+    """
+    crane_positions = np.asarray(crane_positions, dtype=float).reshape(-1, 3)
+    roll_tilt_pan = np.asarray(roll_tilt_pan, dtype=float).reshape(-1, 3)
+
+    engine = BatchPoseEngine(tm, frame, crane_frame)
+    positions = engine.positions(crane_positions)
+    quats = engine.orientations(roll_tilt_pan).as_quat()
+
+    ref_positions = np.zeros_like(positions)
+    ref_quats = np.zeros_like(quats)
+    for i in range(len(crane_positions)):
+        A2B = np.eye(4)
+        A2B[:3, 3] = crane_positions[i]
+        tm.add_transform(crane_frame, world_frame, A2B)
+        frame2world = tm.get_transform(frame, world_frame)
+        ref_positions[i] = frame2world[:3, 3]
+        ref_quats[i] = (R.from_matrix(frame2world[:3, :3]) * R.from_euler('xyz', roll_tilt_pan[i], degrees=True)).as_quat()
+
+    position_error = np.abs(positions - ref_positions).max()
+    # Angle of the rotation between both, which doesn't depend on the sign of the quaternions
+    angle_error = (R.from_quat(quats).inv() * R.from_quat(ref_quats)).magnitude().max()
+    return position_error, angle_error
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare BatchPoseEngine against the per-row TransformManager calculation')
+    parser.add_argument('-n', '--num-rows', type=int, default=500)
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-t', '--tolerance', type=float, default=1e-9, help='maximum deviation in m and rad')
+
+    args = parser.parse_args()
+
+    from dataset.calibration.tf_demo.transforms import get_tf_manager
+
+    rng = np.random.default_rng(args.seed)
+    crane_positions = rng.uniform([0., 0., -1.], [3., 3., 0.], (args.num_rows, 3))
+    roll_tilt_pan = rng.uniform([-5., -45., -90.], [5., 0., 90.], (args.num_rows, 3))
+    position_error, angle_error = compare_with_transform_manager(get_tf_manager(), crane_positions, roll_tilt_pan)
+
+    print(f'{args.num_rows} poses, max. position deviation: {position_error:.2e}m, max. orientation deviation: {angle_error:.2e}rad')
+    if position_error > args.tolerance or angle_error > args.tolerance:
+        print('MISMATCH')
+        sys.exit(1)
+    print('OK')
@@ -0,0 +1,85 @@
+import os
+import numpy as np
+import cv2
+
+
+# Low resolution stand-ins for the GoPro clips and ARIS frames that make scrubbing in the GUIs fast.
+# They are created by prep_8b_make_proxies.py and only ever used for display, never for export.
+PROXY_CLIPS_DIR = 'clips_proxy'
+
+
+def get_proxy_clip_path(gopro_file):
+    # data_processed/gopro/clips_sd/x.mp4 -> data_processed/gopro/clips_proxy/x.mp4
+    clips_dir = os.path.dirname(os.path.abspath(gopro_file))
+    return os.path.join(os.path.dirname(clips_dir), PROXY_CLIPS_DIR, os.path.basename(gopro_file))
+
+
+def get_proxy_clip(gopro_file):
+    # Returns the proxy for a clip if there is one that is not older than the clip itself
+    proxy_file = get_proxy_clip_path(gopro_file)
+    if os.path.abspath(proxy_file) == os.path.abspath(gopro_file):
+        return None
+    try:
+        if os.path.getmtime(proxy_file) >= os.path.getmtime(gopro_file):
+            return proxy_file
+    except OSError:
+        pass
+    return None
+
+
+def get_aris_preview_path(aris_dir, kind='raw'):
+    basename = os.path.basename(os.path.normpath(aris_dir))
+    return os.path.join(aris_dir, f'{basename}_preview_{kind}.npy')
+
+
+def is_aris_preview_current(aris_dir, frame_files, kind='raw'):
+    # Other files are written to the recording directories all the time (marks, optical flow), so
+    # compare against the frames themselves. Checking the first and last frame is enough to notice
+    # a re-extraction.
+    try:
+        preview_mtime = os.path.getmtime(get_aris_preview_path(aris_dir, kind))
+        return all(preview_mtime >= os.path.getmtime(f) for f in (frame_files[0], frame_files[-1]))
+    except (OSError, IndexError):
+        return False
+
+
+def load_aris_preview(aris_dir, frame_files, kind='raw', frame_shape=None):
+    # Memory-mapped stack of shape (frames, height, width) matching frame_files, or None if there is
+    # no usable preview. With frame_shape, stacks of a different (e.g. downscaled) size are ignored.
+    if not frame_files or not is_aris_preview_current(aris_dir, frame_files, kind):
+        return None
+    try:
+        stack = np.load(get_aris_preview_path(aris_dir, kind), mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    if len(stack) != len(frame_files):
+        return None
+    if frame_shape is not None and stack.shape[1:] != tuple(frame_shape):
+        return None
+    return stack
+
+
+def get_preview_shape(frame_file, max_size=0):
+    # Frames are scaled down so their larger side is max_size, 0 keeps the native resolution
+    h, w = cv2.imread(frame_file, cv2.IMREAD_GRAYSCALE).shape
+    scale = min(1., max_size / max(h, w)) if max_size else 1.
+    return max(1, round(h * scale)), max(1, round(w * scale))
+
+
+def make_aris_preview(aris_dir, frame_files, kind, max_size=0):
+    h, w = get_preview_shape(frame_files[0], max_size)
+    size = (w, h)
+
+    out_file = get_aris_preview_path(aris_dir, kind)
+    tmp_file = os.path.splitext(out_file)[0] + '.part.npy'
+    stack = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.uint8, shape=(len(frame_files), size[1], size[0]))
+
+    for idx, frame_file in enumerate(frame_files):
+        img = cv2.imread(frame_file, cv2.IMREAD_GRAYSCALE)
+        if (img.shape[1], img.shape[0]) != size:
+            img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+        stack[idx] = img
+
+    stack.flush()
+    del stack
+    os.replace(tmp_file, out_file)
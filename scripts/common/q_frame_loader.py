@@ -0,0 +1,91 @@
+import threading
+from PyQt5 import QtCore
+
+from common.cache import LRUCache
+
+
+def ring_indices(center, step, ring_size, lo, hi):
+    # Frame indices around the playback cursor, ordered by priority: the current frame first, then
+    # alternating between the next and previous ticks
+    keys = [center] if lo <= center <= hi else []
+    for i in range(1, ring_size + 1):
+        for key in (center + i * step, center - i * step):
+            if lo <= key <= hi:
+                keys.append(key)
+    return keys
+
+
+class FramePrefetcher(QtCore.QObject):
+    """
+    Loads frames on a background thread so that the UI thread never has to wait for disk access or
+    decoding. Frames around the playback cursor are loaded ahead of time and kept in a bounded
+    cache. Finished frames are announced through the frameReady signal, which Qt delivers on the
+    UI thread.
+
+    The load function is called on the background thread. It must not create QPixmaps (QImages
+    are fine) and should return None if a frame is not available. With more than one thread it is
+    called concurrently, so it must not share state like a video reader between calls.
+    """
+    frameReady = QtCore.pyqtSignal(object, object)  # key, frame
+
+    def __init__(self, name, load_func, ring_size=8, max_bytes=256 * 2**20, num_threads=1, parent=None):
+        super().__init__(parent)
+        self._load_func = load_func
+        self.ring_size = ring_size
+        self.cache = LRUCache(name, max_items=4 * ring_size + 2, max_bytes=max_bytes)
+
+        self._wanted = []
+        self._loading = set()
+        self._cond = threading.Condition()
+        self._running = True
+        self._threads = [threading.Thread(target=self._run, name=name, daemon=True) for _ in range(num_threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def get(self, key):
+        # Returns the frame if it has already been loaded, otherwise None
+        return self.cache.lookup(key)
+
+    def request(self, keys):
+        # Replaces all pending requests; keys are expected in order of priority
+        with self._cond:
+            self._wanted = [k for k in keys if k not in self.cache and k not in self._loading]
+            self._cond.notify_all()
+
+    def request_ring(self, center, step, lo, hi):
+        self.request(ring_indices(center, max(1, step), self.ring_size, lo, hi))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._wanted:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                key = self._wanted.pop(0)
+                if key in self.cache or key in self._loading:
+                    continue
+                self._loading.add(key)
+
+            try:
+                frame = self._load_func(key)
+            except Exception as e:
+                print(f'{threading.current_thread().name}: failed to load frame {key}: {e}')
+                frame = None
+            finally:
+                with self._cond:
+                    self._loading.discard(key)
+
+            if frame is None:
+                continue
+
+            self.cache.put(key, frame)
+            self.frameReady.emit(key, frame)
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._wanted = []
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
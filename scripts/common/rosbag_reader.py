@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+import io
+import os
+import sys
+import bz2
+import csv
+import time
+import mmap
+import struct
+import argparse
+import numpy as np
+
+
+"""
+Minimal reader for ROS1 bag files (format version 2.0) that doesn't need a ROS installation.
+
+Instead of deserializing every message into Python objects like rosbag does, the raw serialized
+messages of a topic are collected and then decoded all at once with NumPy. This works for message
+types that have a fixed layout (e.g. nav_msgs/Odometry as long as the frame ids don't change).
+
+Format reference: http://wiki.ros.org/Bags/Format/2.0
+"""
+
+
+BAG_MAGIC = b'#ROSBAG V2.0\n'
+
+OP_MSG_DATA = 0x02
+OP_BAG_HEADER = 0x03
+OP_INDEX_DATA = 0x04
+OP_CHUNK = 0x05
+OP_CHUNK_INFO = 0x06
+OP_CONNECTION = 0x07
+
+
+def _header_fields(buf):
+    # Name -> (start, end) of the value of every field in a record header
+    fields = {}
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        (field_len,) = struct.unpack_from('<I', buf, pos)
+        pos += 4
+        sep = bytes(buf[pos:pos + field_len]).index(b'=')
+        fields[bytes(buf[pos:pos + sep]).decode()] = (pos + sep + 1, pos + field_len)
+        pos += field_len
+    return fields
+
+
+def _parse_header(buf):
+    return {name: bytes(buf[start:end]) for name, (start, end) in _header_fields(buf).items()}
+
+
+def _iter_records(buf, pos=0, end=None):
+    # Yields (header fields, data) of all records in buf[pos:end]
+    end = len(buf) if end is None else end
+    while pos + 4 <= end:
+        (header_len,) = struct.unpack_from('<I', buf, pos)
+        pos += 4
+        header = _parse_header(buf[pos:pos + header_len])
+        pos += header_len
+        (data_len,) = struct.unpack_from('<I', buf, pos)
+        pos += 4
+        yield header, buf[pos:pos + data_len]
+        pos += data_len
+
+
+def _decompress(compression, data, size):
+    if compression == b'none':
+        return data
+    if compression == b'bz2':
+        return bz2.decompress(data)
+    if compression == b'lz4':
+        try:
+            import lz4.frame
+        except ImportError:
+            raise RuntimeError('this bag uses lz4 compression, please install the lz4 package')
+        return lz4.frame.decompress(bytes(data))
+    raise ValueError(f'unknown chunk compression {compression}')
+
+
+class BagReader:
+    def __init__(self, bag_file):
+        self.bag_file = bag_file
+        self._file = open(bag_file, 'rb')
+        if self._file.read(len(BAG_MAGIC)) != BAG_MAGIC:
+            self._file.close()
+            raise ValueError(f'{bag_file} is not a ROS bag (version 2.0)')
+        self._buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # The bag header tells where the index with connections and chunk infos starts
+        header, _ = next(_iter_records(self._buf, len(BAG_MAGIC)))
+        if header['op'][0] != OP_BAG_HEADER:
+            raise ValueError(f'{bag_file}: missing bag header')
+        self._index_pos = struct.unpack('<Q', header['index_pos'])[0]
+
+        self.connections = {}  # conn id -> dict(topic, type, ...)
+        self._message_counts = {}  # conn id -> count
+        if self._index_pos:
+            for header, data in _iter_records(self._buf, self._index_pos):
+                op = header['op'][0]
+                if op == OP_CONNECTION:
+                    self._add_connection(header, data)
+                elif op == OP_CHUNK_INFO:
+                    for i in range(0, len(data), 8):
+                        conn, count = struct.unpack_from('<II', data, i)
+                        self._message_counts[conn] = self._message_counts.get(conn, 0) + count
+
+    def _add_connection(self, header, data):
+        conn = struct.unpack('<I', header['conn'])[0]
+        if conn not in self.connections:
+            info = {k: v.decode(errors='replace') for k, v in _parse_header(data).items()}
+            info['topic'] = header['topic'].decode()
+            self.connections[conn] = info
+
+    def close(self):
+        self._buf.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _connections_for(self, topics):
+        return {conn for conn, info in self.connections.items() if info['topic'] in topics}
+
+    def get_message_count(self, topic):
+        return sum(self._message_counts.get(conn, 0) for conn in self._connections_for({topic}))
+
+    def _iter_chunks(self):
+        # Decompressed data of all chunks, in file order
+        end = self._index_pos or len(self._buf)
+        for header, data in _iter_records(self._buf, len(BAG_MAGIC), end):
+            op = header['op'][0]
+            if op == OP_CHUNK:
+                size = struct.unpack('<I', header['size'])[0]
+                yield _decompress(header['compression'], data, size)
+            elif op == OP_CONNECTION:
+                self._add_connection(header, data)
+
+    def _scan_chunk(self, chunk):
+        # Connection ids, record times (ns), data offsets and lengths of all message records in a chunk.
+        # This is the only loop over individual messages: message records all have the same header
+        # layout, so it is parsed once and every following record is read with a single unpack.
+        conns, times, offsets, lengths = [], [], [], []
+        # Struct, header length, data offset and field indices of the last message record seen
+        layout = None
+        pos = 0
+        end = len(chunk)
+        while pos < end:
+            if layout is not None:
+                record, msg_header_len, msg_data_offset, op_idx, conn_idx, secs_idx = layout
+                try:
+                    values = record.unpack_from(chunk, pos)
+                except struct.error:
+                    values = None
+                if values and values[0] == msg_header_len and values[op_idx] == OP_MSG_DATA:
+                    conns.append(values[conn_idx])
+                    times.append(values[secs_idx] * 1_000_000_000 + values[secs_idx + 1])
+                    offsets.append(pos + msg_data_offset)
+                    lengths.append(values[-1])
+                    pos += msg_data_offset + values[-1]
+                    continue
+
+            (header_len,) = struct.unpack_from('<I', chunk, pos)
+            header_buf = chunk[pos + 4:pos + 4 + header_len]
+            (data_len,) = struct.unpack_from('<I', chunk, pos + 4 + header_len)
+            data_offset = 8 + header_len
+            fields = _header_fields(header_buf)
+            op = header_buf[fields['op'][0]]
+
+            if op == OP_CONNECTION:
+                self._add_connection(_parse_header(header_buf), chunk[pos + data_offset:pos + data_offset + data_len])
+            elif op == OP_MSG_DATA:
+                record, indices = _message_record_struct(header_len, fields)
+                layout = (record, header_len, data_offset) + indices
+                continue  # read again with the new layout
+            pos += data_offset + data_len
+
+        return (np.array(conns, dtype=np.uint32), np.array(times, dtype=np.int64),
+                np.array(offsets, dtype=np.int64), np.array(lengths, dtype=np.int64))
+
+    def read_messages_block(self, topics):
+        # All serialized messages of the given topics as one uint8 array, plus the offset and length of
+        # every message in it and its record time (ns). Meant for decoding in bulk with NumPy.
+        if isinstance(topics, str):
+            topics = {topics}
+        topics = set(topics)
+
+        buffers, conns, times, offsets, lengths = [], [], [], [], []
+        base = 0
+        for chunk in self._iter_chunks():
+            c, t, o, l = self._scan_chunk(chunk)
+            keep = np.isin(c, list(self._connections_for(topics)))
+            if not keep.any():
+                continue
+            buffers.append(np.frombuffer(chunk, dtype=np.uint8))
+            conns.append(c[keep])
+            times.append(t[keep])
+            offsets.append(o[keep] + base)
+            lengths.append(l[keep])
+            base += len(chunk)
+
+        if not buffers:
+            empty = np.zeros(0, dtype=np.int64)
+            return np.zeros(0, dtype=np.uint8), empty, empty, empty
+        return np.concatenate(buffers), np.concatenate(offsets), np.concatenate(lengths), np.concatenate(times)
+
+    def read_raw_messages(self, topics):
+        # Yields (topic, record time in ns, serialized message) in the order they are stored
+        if isinstance(topics, str):
+            topics = {topics}
+        topics = set(topics)
+        for chunk in self._iter_chunks():
+            wanted = self._connections_for(topics)
+            for conn, t, offset, length in zip(*self._scan_chunk(chunk)):
+                if conn in wanted:
+                    yield self.connections[conn]['topic'], int(t), bytes(chunk[offset:offset + length])
+
+
+def _message_record_struct(header_len, fields):
+    # Struct that unpacks header length, op, conn, time and data length of a message record with
+    # the given header layout in one go. Also returns the indices of op, conn and time secs.
+    items = sorted([(4 + fields['op'][0], 'B', 'op'), (4 + fields['conn'][0], 'I', 'conn'),
+                    (4 + fields['time'][0], 'II', 'time')])
+    fmt = '<I'
+    pos = 4
+    indices = {}
+    num_values = 1
+    for offset, code, name in items:
+        fmt += f'{offset - pos}x{code}'
+        indices[name] = num_values
+        num_values += len(code)
+        pos = offset + struct.calcsize('<' + code)
+    fmt += f'{4 + header_len - pos}xI'
+    return struct.Struct(fmt), (indices['op'], indices['conn'], indices['time'])
+
+
+# nav_msgs/Odometry: std_msgs/Header header, string child_frame_id,
+# geometry_msgs/PoseWithCovariance pose, geometry_msgs/TwistWithCovariance twist
+def odometry_dtype(frame_id_len, child_frame_id_len):
+    pose = 20 + frame_id_len + child_frame_id_len
+    twist = pose + 7 * 8 + 36 * 8
+    return np.dtype({
+        'names': ['secs', 'nsecs', 'position', 'orientation', 'linear', 'angular'],
+        'formats': ['<u4', '<u4', ('<f8', 3), ('<f8', 4), ('<f8', 3), ('<f8', 3)],
+        'offsets': [4, 8, pose, pose + 3 * 8, twist, twist + 3 * 8],
+        'itemsize': twist + 6 * 8 + 36 * 8,
+    })
+
+
+def _odometry_dtype_at(data, offset):
+    frame_id_len = int(data[offset + 12:offset + 16].view('<u4')[0])
+    child_frame_id_len = int(data[offset + 16 + frame_id_len:offset + 20 + frame_id_len].view('<u4')[0])
+    return odometry_dtype(frame_id_len, child_frame_id_len)
+
+
+def _gather_u4(data, offsets):
+    return data[offsets[:, None] + np.arange(4)].view('<u4')[:, 0]
+
+
+def gather_fields(data, offsets, dtype):
+    # Reads the fields of a structured dtype from messages at the given offsets. Only the bytes of the
+    # fields are copied, not the whole messages (e.g. the covariances are skipped).
+    cols, packed_offsets, pos = [], [], 0
+    for name in dtype.names:
+        field_dtype, offset = dtype.fields[name][:2]
+        cols.append(np.arange(offset, offset + field_dtype.itemsize))
+        packed_offsets.append(pos)
+        pos += field_dtype.itemsize
+    packed = np.dtype({'names': list(dtype.names), 'formats': [dtype.fields[n][0] for n in dtype.names],
+                       'offsets': packed_offsets, 'itemsize': pos})
+    return data[offsets[:, None] + np.concatenate(cols)].view(packed)[:, 0]
+
+
+def parse_odometry(data, offsets, lengths):
+    # Decodes serialized nav_msgs/Odometry messages (see BagReader.read_messages_block) into the
+    # columns of common.odometry.ODOMETRY_COLUMNS. The covariances are skipped.
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    msgs = np.zeros(len(offsets), dtype=gather_fields(np.zeros(0, dtype=np.uint8), offsets[:0], odometry_dtype(0, 0)).dtype)
+
+    # Every field is at a fixed offset once the lengths of the frame ids are known. These usually
+    # never change, so there is only one group of messages.
+    if len(offsets):
+        frame_id_len = _gather_u4(data, offsets + 12)
+        child_frame_id_len = _gather_u4(data, offsets + 16 + frame_id_len)
+        layouts = frame_id_len.astype(np.int64) << 32 | child_frame_id_len
+        for layout in np.unique(layouts):
+            sel = np.flatnonzero(layouts == layout)
+            dtype = odometry_dtype(int(layout >> 32), int(layout & 0xffffffff))
+            if np.any(lengths[sel] != dtype.itemsize):
+                raise ValueError('messages are not of type nav_msgs/Odometry')
+            msgs[sel] = gather_fields(data, offsets[sel], dtype)
+
+    odom = {'timestamp_us': msgs['secs'].astype(np.int64) * 1_000_000 + msgs['nsecs'] // 1000}
+    for field, names in (('position', ['x', 'y', 'z']), ('orientation', ['qx', 'qy', 'qz', 'qw']),
+                         ('linear', ['vx', 'vy', 'vz']), ('angular', ['wx', 'wy', 'wz'])):
+        for i, name in enumerate(names):
+            odom[name] = msgs[field][:, i].copy()
+    return odom
+
+
+def read_odometry(bag_file, topic='/odom'):
+    with BagReader(bag_file) as bag:
+        data, offsets, lengths, _ = bag.read_messages_block(topic)
+    return parse_odometry(data, offsets, lengths)
+
+
+def _serialize_odometry(seq, secs, nsecs, position, orientation=(0., 0., 0., 1.), linear=(0., 0., 0.),
+                        angular=(0., 0., 0.), frame_id=b'world', child_frame_id=b'portal_crane'):
+    return (struct.pack('<III', seq, secs, nsecs) + struct.pack('<I', len(frame_id)) + frame_id
+            + struct.pack('<I', len(child_frame_id)) + child_frame_id
+            + struct.pack('<3d', *position) + struct.pack('<4d', *orientation) + bytes(36 * 8)
+            + struct.pack('<3d', *linear) + struct.pack('<3d', *angular) + bytes(36 * 8))
+
+
+def _record(header, data):
+    header_bytes = b''.join(struct.pack('<I', len(k) + 1 + len(v)) + k.encode() + b'=' + v for k, v in header.items())
+    return struct.pack('<I', len(header_bytes)) + header_bytes + struct.pack('<I', len(data)) + data
+
+
+def write_synthetic_bag(bag_file, num_msgs, rate=50., msgs_per_chunk=1000, compression='none', seed=0):
+    # Writes a bag with a random /odom trajectory, used for benchmarks and to check the reader
+    rng = np.random.default_rng(seed)
+    positions = np.cumsum(rng.normal(0, 1e-3, (num_msgs, 3)), axis=0)
+    t0 = 1695222664 * 1_000_000_000
+    stamps = t0 + (np.arange(num_msgs) * 1e9 / rate).astype(np.int64)
+
+    # Slowly turning around z, the twist is given in the turning frame
+    yaw = np.linspace(0, np.pi / 2, num_msgs)
+    orientations = np.column_stack([np.zeros(num_msgs), np.zeros(num_msgs), np.sin(yaw / 2), np.cos(yaw / 2)])
+    world_velocity = np.gradient(positions, axis=0) * rate
+    linear = np.column_stack([np.cos(yaw) * world_velocity[:, 0] + np.sin(yaw) * world_velocity[:, 1],
+                              -np.sin(yaw) * world_velocity[:, 0] + np.cos(yaw) * world_velocity[:, 1],
+                              world_velocity[:, 2]])
+    angular = np.zeros((num_msgs, 3))
+    angular[:, 2] = np.gradient(yaw) * rate
+
+    conn_header = {'op': bytes([OP_CONNECTION]), 'conn': struct.pack('<I', 0), 'topic': b'/odom'}
+    conn_data = b''.join(struct.pack('<I', len(k) + 1 + len(v)) + k.encode() + b'=' + v for k, v in
+                         {'topic': b'/odom', 'type': b'nav_msgs/Odometry', 'md5sum': b'cd5e73d190d741a2f92e81eda573aca7'}.items())
+
+    chunks = []
+    for start in range(0, num_msgs, msgs_per_chunk):
+        records = [_record(conn_header, conn_data)] if start == 0 else []
+        for i in range(start, min(start + msgs_per_chunk, num_msgs)):
+            secs, nsecs = divmod(int(stamps[i]), 1_000_000_000)
+            msg = _serialize_odometry(i, secs, nsecs, positions[i], orientations[i], linear[i], angular[i])
+            records.append(_record({'op': bytes([OP_MSG_DATA]), 'conn': struct.pack('<I', 0), 'time': struct.pack('<II', secs, nsecs)}, msg))
+        chunks.append((b''.join(records), min(start + msgs_per_chunk, num_msgs) - start))
+
+    with open(bag_file, 'wb') as f:
+        f.write(BAG_MAGIC)
+        header_pos = f.tell()
+        f.write(bytes(4096))  # placeholder for the bag header
+
+        chunk_infos = []
+        for chunk, count in chunks:
+            data = bz2.compress(chunk) if compression == 'bz2' else chunk
+            chunk_infos.append((f.tell(), count))
+            f.write(_record({'op': bytes([OP_CHUNK]), 'compression': compression.encode(), 'size': struct.pack('<I', len(chunk))}, data))
+
+        index_pos = f.tell()
+        f.write(_record(conn_header, conn_data))
+        for chunk_pos, count in chunk_infos:
+            f.write(_record({'op': bytes([OP_CHUNK_INFO]), 'ver': struct.pack('<I', 1), 'chunk_pos': struct.pack('<Q', chunk_pos),
+                             'start_time': bytes(8), 'end_time': bytes(8), 'count': struct.pack('<I', 1)},
+                            struct.pack('<II', 0, count)))
+
+        # The bag header record is padded to 4096 bytes
+        fields = {'op': bytes([OP_BAG_HEADER]), 'index_pos': struct.pack('<Q', index_pos),
+                  'conn_count': struct.pack('<I', 1), 'chunk_count': struct.pack('<I', len(chunks))}
+        header_len = len(_record(fields, b''))
+        f.seek(header_pos)
+        f.write(_record(fields, b' ' * (4096 - header_len)))
+
+    odom = {'timestamp_us': stamps // 1000}
+    for values, names in ((positions, ['x', 'y', 'z']), (orientations, ['qx', 'qy', 'qz', 'qw']),
+                          (linear, ['vx', 'vy', 'vz']), (angular, ['wx', 'wy', 'wz'])):
+        odom.update({name: values[:, i] for i, name in enumerate(names)})
+    return odom
+
+
+def benchmark(num_msgs, compression='none'):
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bag_file = os.path.join(tmp_dir, 'synthetic.bag')
+        expected = write_synthetic_bag(bag_file, num_msgs, compression=compression)
+        print(f'{num_msgs} messages, {os.path.getsize(bag_file) / 1e6:.1f}MB, compression={compression}')
+
+        t = time.perf_counter()
+        odom = read_odometry(bag_file)
+        t_read = time.perf_counter() - t
+        np.savetxt(io.StringIO(), np.column_stack([odom[k] for k in ['timestamp_us', 'x', 'y', 'z']]),
+                   fmt=['%d', '%.9g', '%.9g', '%.9g'], delimiter=',')
+        t_fast = time.perf_counter() - t
+        assert all(np.array_equal(odom[k], v) for k, v in expected.items())
+
+        # Per message decoding and one csv row per message, like the rosbag based extraction
+        t = time.perf_counter()
+        writer = csv.writer(io.StringIO())
+        with BagReader(bag_file) as bag:
+            for _, _, raw in bag.read_raw_messages('/odom'):
+                msg = np.frombuffer(raw, dtype=_odometry_dtype_at(np.frombuffer(raw, dtype=np.uint8), 0), count=1)[0]
+                writer.writerow([int(msg['secs']) * 1_000_000 + int(msg['nsecs']) // 1000, *msg['position']])
+        t_slow = time.perf_counter() - t
+
+        print(f'numpy:       {num_msgs / t_fast:10.0f} msgs/s ({t_fast:.3f}s, {t_read:.3f}s without writing the csv)')
+        print(f'per message: {num_msgs / t_slow:10.0f} msgs/s ({t_slow:.3f}s)')
+
+        try:
+            import rosbag
+        except ImportError:
+            print('rosbag is not installed, skipping comparison')
+            return
+
+        t = time.perf_counter()
+        writer = csv.writer(io.StringIO())
+        for _, msg, _ in rosbag.Bag(bag_file).read_messages('/odom'):
+            p = msg.pose.pose.position
+            writer.writerow([msg.header.stamp.secs * 1_000_000 + msg.header.stamp.nsecs // 1000, p.x, p.y, p.z])
+        t_rosbag = time.perf_counter() - t
+        print(f'rosbag:      {num_msgs / t_rosbag:10.0f} msgs/s ({t_rosbag:.3f}s)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Read ROS bags without ROS')
+    parser.add_argument('bag_files', nargs='*')
+    parser.add_argument('--benchmark', type=int, metavar='NUM_MSGS', default=0, help='measure the extraction speed on a synthetic bag')
+    parser.add_argument('--compression', choices=['none', 'bz2'], default='none', help='chunk compression of the synthetic bag')
+
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark, args.compression)
+        sys.exit(0)
+
+    for bag_file in args.bag_files:
+        with BagReader(bag_file) as bag:
+            print(bag_file)
+            for conn, info in sorted(bag.connections.items()):
+                print(f'  {info["topic"]}: {info.get("type", "?")}, {bag.get_message_count(info["topic"])} messages')
@@ -0,0 +1,179 @@
+import os
+import glob
+import tarfile
+import numpy as np
+import cv2
+
+
+"""
+Shards are plain tar files (readable with any tar tool) of a limited size, each accompanied by an
+offset index (<shard>.tar.idx) listing the name, data offset and size of every member. With the
+index, single files can be read straight from the archive without extracting it, while a whole
+shard can still be streamed sequentially.
+
+The index is a text file with one "<offset> <size> <name>" line per member, in archive order.
+"""
+
+
+INDEX_SUFFIX = '.idx'
+SHARD_PATTERN = '{prefix}-{num:05}.tar'
+
+
+def get_shard_index_path(shard_file):
+    return shard_file + INDEX_SUFFIX
+
+
+def write_shard_index(index_file, entries):
+    with open(index_file, 'w') as f:
+        for name, offset, size in entries:
+            f.write(f'{offset} {size} {name}\n')
+
+
+def read_shard_index(index_file):
+    entries = {}
+    with open(index_file, 'r') as f:
+        for line in f:
+            offset, size, name = line.rstrip('\n').split(' ', maxsplit=2)
+            entries[name] = (int(offset), int(size))
+    return entries
+
+
+def _tar_blocks(size):
+    return (size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+
+
+class ShardWriter:
+    """
+    Writes files into consecutive shards of at most max_bytes each (a single file larger than that
+    gets a shard of its own). Headers don't contain any user or host specific information, so
+    packing the same files twice results in identical shards.
+    """
+    def __init__(self, out_dir, prefix, max_bytes):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.shard_files = []
+
+        self._tar = None
+        self._entries = []
+
+    def _open_shard(self):
+        shard_file = os.path.join(self.out_dir, SHARD_PATTERN.format(prefix=self.prefix, num=len(self.shard_files)))
+        self.shard_files.append(shard_file)
+        self._tar = tarfile.open(shard_file, 'w', format=tarfile.PAX_FORMAT)
+        self._entries = []
+
+    def _close_shard(self):
+        if self._tar is None:
+            return
+        self._tar.close()
+        write_shard_index(get_shard_index_path(self.shard_files[-1]), self._entries)
+        self._tar = None
+
+    def add_file(self, path, arcname):
+        st = os.stat(path)
+        info = tarfile.TarInfo(arcname)
+        info.size = st.st_size
+        info.mtime = int(st.st_mtime)
+        info.mode = 0o644
+
+        # Header (at least one block) + data + the two end-of-archive blocks
+        needed = tarfile.BLOCKSIZE + _tar_blocks(info.size)
+        if self._tar is None or (self._entries and self._tar.offset + needed + 2 * tarfile.BLOCKSIZE > self.max_bytes):
+            self._close_shard()
+            self._open_shard()
+
+        with open(path, 'rb') as f:
+            self._tar.addfile(info, f)
+        # The data is the last thing written (padded to full blocks)
+        self._entries.append((arcname, self._tar.offset - _tar_blocks(info.size), info.size))
+
+    def close(self):
+        self._close_shard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ShardReader:
+    # Random access to the members of a single shard
+    def __init__(self, shard_file):
+        self.shard_file = shard_file
+        self.entries = read_shard_index(get_shard_index_path(shard_file))
+        self._fd = os.open(shard_file, os.O_RDONLY)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def names(self):
+        return list(self.entries.keys())
+
+    def read(self, name):
+        offset, size = self.entries[name]
+        # pread doesn't move a shared file position, so threads can read concurrently
+        return os.pread(self._fd, size, offset)
+
+    def stream(self):
+        # Sequential read of the whole shard as (name, data) pairs, in archive order
+        with tarfile.open(self.shard_file, 'r|') as tar:
+            for info in tar:
+                if info.isfile():
+                    yield info.name, tar.extractfile(info).read()
+
+
+class ShardedArchive:
+    """
+    All shards of a packed export. Files are addressed by their path relative to the export dir,
+    e.g. recordings/100lbs/<recording>/gopro/0042.jpg.
+    """
+    def __init__(self, shard_dir, prefix='*'):
+        shard_files = sorted(glob.glob(os.path.join(shard_dir, prefix + '-*.tar')))
+        self.shards = [ShardReader(f) for f in shard_files if os.path.isfile(get_shard_index_path(f))]
+        self._lookup = {name: shard for shard in self.shards for name in shard.entries}
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self._lookup
+
+    def __len__(self):
+        return len(self._lookup)
+
+    def names(self):
+        return list(self._lookup.keys())
+
+    def read(self, name):
+        return self._lookup[name].read(name)
+
+    def read_image(self, name, flags=cv2.IMREAD_UNCHANGED):
+        img = cv2.imdecode(np.frombuffer(self.read(name), dtype=np.uint8), flags)
+        if img is None:
+            raise IOError(f'Could not decode {name}')
+        return img
+
+    def stream(self, num_workers=1, worker_id=0):
+        # Whole shards are assigned to workers round robin, each worker reads its shards sequentially
+        for shard in self.shards[worker_id::num_workers]:
+            yield from shard.stream()
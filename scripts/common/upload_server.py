@@ -0,0 +1,158 @@
+import os
+import json
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+"""
+Local stand-in for the upload bucket, used to test release_3_upload.py without touching the real
+deposition. Files PUT to http://<host>:<port>/<bucket>/<filename> end up in <out_dir>/<bucket>/.
+
+Whole-file PUTs are answered like Zenodo's bucket API (json including "checksum": "md5:<hex>").
+PUTs with a Content-Range header are treated as resumable uploads: incomplete uploads are answered
+with 308 and a Range header listing the bytes received so far, "bytes */<size>" queries the state.
+With --fail-rate, requests randomly fail with a 503 or a dropped connection to test the retries.
+"""
+
+
+CHUNK_SIZE = 1 << 20
+
+
+class UploadHandler(BaseHTTPRequestHandler):
+    out_dir = '.'
+    token = None
+    fail_rate = 0.
+    _lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=None, headers=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _target(self):
+        url = urlparse(self.path)
+        if self.token is not None and parse_qs(url.query).get('access_token', [None])[0] != self.token:
+            return None, url
+        parts = [p for p in url.path.split('/') if p and p not in ('.', '..')]
+        if not parts:
+            return None, url
+        target_dir = os.path.join(self.out_dir, *parts[:-1])
+        os.makedirs(target_dir, exist_ok=True)
+        return os.path.join(target_dir, parts[-1]), url
+
+    def _receive(self, fp, length):
+        # Copies the request body, possibly dropping the connection half way through
+        drop_at = random.randrange(length) if length and random.random() < self.fail_rate / 2 else None
+        received = 0
+        while received < length:
+            n = min(CHUNK_SIZE, length - received)
+            if drop_at is not None and received + n > drop_at:
+                n = drop_at - received
+                fp.write(self.rfile.read(n))
+                fp.flush()
+                self.close_connection = True
+                self.connection.shutdown(2)
+                return False
+            fp.write(self.rfile.read(n))
+            received += n
+        return True
+
+    def _done(self, path):
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            while chunk := f.read(CHUNK_SIZE):
+                md5.update(chunk)
+        self._reply(201, {'key': os.path.basename(path), 'size': os.path.getsize(path), 'checksum': 'md5:' + md5.hexdigest()})
+
+    def do_PUT(self):
+        path, _ = self._target()
+        if path is None:
+            self._reply(403, {'message': 'invalid bucket or access token'})
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        content_range = self.headers.get('Content-Range')
+
+        if random.random() < self.fail_rate / 2:
+            self.rfile.read(length)
+            self._reply(503, {'message': 'try again later'})
+            return
+
+        if content_range is None:
+            tmp_path = path + '.upload'
+            with open(tmp_path, 'wb') as f:
+                if not self._receive(f, length):
+                    return
+            os.replace(tmp_path, path)
+            self._done(path)
+            return
+
+        # Resumable upload, "bytes <start>-<end>/<total>" or "bytes */<total>"
+        part_path = path + '.part'
+        spec, total = content_range.split(' ', 1)[1].split('/')
+        total = int(total)
+        with self._lock:
+            received = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+            if os.path.isfile(path) and not os.path.isfile(part_path) and os.path.getsize(path) == total and spec == '*':
+                self._done(path)
+                return
+
+        if spec != '*':
+            start = int(spec.split('-')[0])
+            if start > received:
+                self.rfile.read(length)
+                self._reply(416, {'message': f'expected offset {received}'})
+                return
+            with open(part_path, 'r+b' if os.path.isfile(part_path) else 'wb') as f:
+                f.truncate(start)
+                f.seek(start)
+                complete = self._receive(f, length)
+            if not complete:
+                return
+            received = os.path.getsize(part_path)
+
+        if received >= total and spec != '*':
+            os.replace(part_path, path)
+            self._done(path)
+            return
+
+        headers = {'Range': f'bytes=0-{received - 1}'} if received else {}
+        self._reply(308, headers=headers)
+
+
+def serve(out_dir, host='localhost', port=8000, token=None, fail_rate=0.):
+    UploadHandler.out_dir = out_dir
+    UploadHandler.token = token
+    UploadHandler.fail_rate = fail_rate
+    server = ThreadingHTTPServer((host, port), UploadHandler)
+    print(f'Receiving uploads at http://{host}:{port}/<bucket> into {out_dir}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in server for testing release_3_upload.py')
+    parser.add_argument('out_dir')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('-p', '--port', type=int, default=8000)
+    parser.add_argument('-t', '--token', default=None, help='only accept uploads with this access token')
+    parser.add_argument('-f', '--fail-rate', type=float, default=0., help='fraction of requests that fail (503 or dropped connection)')
+
+    args = parser.parse_args()
+    serve(args.out_dir, args.host, args.port, args.token, args.fail_rate)
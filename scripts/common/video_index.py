@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import struct
+import argparse
+import numpy as np
+import cv2
+
+
+"""
+Frame index for MP4 clips (e.g. the GoPro clips) that allows exact random access.
+
+Seeking with CAP_PROP_POS_FRAMES makes OpenCV guess the target timestamp from the frame rate,
+which is slow and with some codecs lands on the wrong frame. Instead, the sample tables of the MP4
+container are read once to get the presentation timestamp of every frame and the positions of all
+keyframes. Short jumps forward are decoded instead of seeking, and after every seek the timestamp of
+the decoded frame is used to verify (and if necessary correct) where the decoder actually is.
+
+The index is cached next to the clip (<clip>_frameindex.npz) and rebuilt when the clip changes.
+"""
+
+
+INDEX_SUFFIX = '_frameindex.npz'
+INDEX_VERSION = 1
+
+
+def _iter_boxes(f, start, end):
+    # Yields (type, payload start, box end) of all MP4 boxes in the given byte range
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            break
+        yield box_type.decode('latin-1'), pos + header, pos + size
+        pos += size
+
+
+def _find_box(f, start, end, box_type):
+    for t, payload, box_end in _iter_boxes(f, start, end):
+        if t == box_type:
+            return payload, box_end
+    return None
+
+
+def _read_table(f, payload, dtype, columns):
+    # Full box header (version + flags), entry count, entries
+    f.seek(payload)
+    version = f.read(1)[0]
+    f.read(3)
+    count = struct.unpack('>I', f.read(4))[0]
+    data = np.frombuffer(f.read(count * columns * 4), dtype=dtype)
+    return version, data.reshape(count, columns) if columns > 1 else data
+
+
+def _read_video_track(f, file_size):
+    moov = _find_box(f, 0, file_size, 'moov')
+    if moov is None:
+        return None
+
+    for box_type, trak_start, trak_end in _iter_boxes(f, *moov):
+        if box_type != 'trak':
+            continue
+
+        mdia = _find_box(f, trak_start, trak_end, 'mdia')
+        if mdia is None:
+            continue
+        hdlr = _find_box(f, *mdia, 'hdlr')
+        f.seek(hdlr[0] + 8)
+        if f.read(4) != b'vide':
+            continue
+
+        mdhd = _find_box(f, *mdia, 'mdhd')
+        f.seek(mdhd[0])
+        version = f.read(1)[0]
+        f.seek(mdhd[0] + (20 if version == 1 else 12))
+        timescale = struct.unpack('>I', f.read(4))[0]
+
+        # The first non-empty edit tells which media time is presented first
+        media_time = 0
+        edts = _find_box(f, trak_start, trak_end, 'edts')
+        elst = _find_box(f, *edts, 'elst') if edts else None
+        if elst:
+            f.seek(elst[0])
+            version = f.read(1)[0]
+            f.read(3)
+            count = struct.unpack('>I', f.read(4))[0]
+            for _ in range(count):
+                if version == 1:
+                    _, mt, _ = struct.unpack('>Qqi', f.read(20))
+                else:
+                    _, mt, _ = struct.unpack('>Iii', f.read(12))
+                if mt != -1:
+                    media_time = mt
+                    break
+
+        minf = _find_box(f, *mdia, 'minf')
+        stbl = _find_box(f, *minf, 'stbl')
+        tables = {t: p for t, p, _ in _iter_boxes(f, *stbl)}
+
+        _, stts = _read_table(f, tables['stts'], '>u4', 2)
+        deltas = np.repeat(stts[:, 1].astype(np.int64), stts[:, 0])
+        dts = np.concatenate([[0], np.cumsum(deltas)[:-1]])
+
+        cts = dts
+        if 'ctts' in tables:
+            version, ctts = _read_table(f, tables['ctts'], '>u4', 2)
+            offsets = ctts[:, 1].view('>i4') if version == 1 else ctts[:, 1]
+            cts = dts + np.repeat(offsets.astype(np.int64), ctts[:, 0])
+
+        # Without a sync sample table every sample is a keyframe
+        keyframe = np.ones(len(dts), dtype=bool)
+        if 'stss' in tables:
+            _, stss = _read_table(f, tables['stss'], '>u4', 1)
+            keyframe[:] = False
+            keyframe[stss.astype(np.int64) - 1] = True
+
+        return cts - media_time, keyframe, timescale
+
+    return None
+
+
+def read_mp4_frame_index(video_file):
+    # Returns the presentation timestamps in seconds (relative to the first frame) and keyframe
+    # flags of all frames in presentation order, or None if the file is not a (non-fragmented) MP4
+    file_size = os.path.getsize(video_file)
+    try:
+        with open(video_file, 'rb') as f:
+            track = _read_video_track(f, file_size)
+    except (struct.error, KeyError, TypeError, ValueError, IndexError):
+        return None
+    if track is None:
+        return None
+
+    pts, keyframe, timescale = track
+    order = np.argsort(pts, kind='stable')
+    pts, keyframe = pts[order], keyframe[order]
+
+    # Frames before the start of the edit list are never shown by the decoder
+    shown = pts >= 0
+    return pts[shown] / timescale, keyframe[shown]
+
+
+class FrameIndex:
+    def __init__(self, pts, keyframe):
+        self.pts = np.asarray(pts, dtype=np.float64)
+        self.keyframe = np.asarray(keyframe, dtype=bool)
+
+        # Closest keyframe at or before each frame
+        idx = np.where(self.keyframe, np.arange(len(self.pts)), 0)
+        self._keyframe_for = np.maximum.accumulate(idx) if len(idx) else idx
+
+    def __len__(self):
+        return len(self.pts)
+
+    @property
+    def keyframes(self):
+        return np.flatnonzero(self.keyframe)
+
+    @property
+    def fps(self):
+        if len(self.pts) < 2:
+            return 0.
+        return (len(self.pts) - 1) / (self.pts[-1] - self.pts[0])
+
+    def keyframe_for(self, frame_idx):
+        return int(self._keyframe_for[frame_idx])
+
+    def frame_at(self, t):
+        # Index of the frame whose timestamp is closest to t (seconds)
+        i = int(np.searchsorted(self.pts, t))
+        if i > 0 and (i == len(self.pts) or t - self.pts[i - 1] < self.pts[i] - t):
+            i -= 1
+        return i
+
+
+def _file_signature(path):
+    st = os.stat(path)
+    return np.array([st.st_size, st.st_mtime_ns, INDEX_VERSION], dtype=np.int64)
+
+
+def get_index_file(video_file):
+    return os.path.splitext(video_file)[0] + INDEX_SUFFIX
+
+
+def load_frame_index(video_file, use_cache_file=True):
+    # Returns a FrameIndex or None if the clip's container can't be indexed
+    signature = _file_signature(video_file)
+    index_file = get_index_file(video_file)
+
+    if use_cache_file:
+        try:
+            with np.load(index_file) as data:
+                if np.array_equal(data['signature'], signature):
+                    return FrameIndex(data['pts'], data['keyframe'])
+        except (OSError, KeyError, ValueError):
+            pass
+
+    res = read_mp4_frame_index(video_file)
+    if res is None:
+        return None
+    index = FrameIndex(*res)
+
+    if use_cache_file:
+        try:
+            np.savez(index_file, signature=signature, pts=index.pts, keyframe=index.keyframe)
+        except OSError as e:
+            # Read-only media etc.; the index is cheap enough to rebuild
+            print(f'Could not write frame index {index_file}: {e}')
+
+    return index
+
+
+class FrameSeeker:
+    """
+    Exact random access on a cv2.VideoCapture using a FrameIndex. Frames up to the next keyframe are
+    reached by decoding forward; everything else seeks, so the latency of a jump is bounded by the
+    keyframe interval.
+    """
+    def __init__(self, clip, index):
+        self.clip = clip
+        self.index = index
+        self.pos = -1  # frame that was decoded last, -1 if unknown
+
+        self.seeks = 0
+        self.grabs = 0
+
+    def _grab(self):
+        if not self.clip.grab():
+            self.pos = -1
+            return False
+        self.grabs += 1
+        # The decoder's timestamp tells where we really are
+        self.pos = self.index.frame_at(self.clip.get(cv2.CAP_PROP_POS_MSEC) / 1000)
+        return True
+
+    def _seek(self, frame_idx):
+        # OpenCV already seeks to the preceding keyframe and decodes forward, but it estimates the
+        # target from the frame rate. The timestamp of the decoded frame tells whether that worked.
+        target = frame_idx
+        while True:
+            self.clip.set(cv2.CAP_PROP_POS_FRAMES, target)
+            self.seeks += 1
+            if not self._grab():
+                return False
+            if self.pos <= frame_idx:
+                return True
+            if target == 0:
+                return False
+            # Overshot, start over from the keyframe before the target
+            target = self.index.keyframe_for(min(target, frame_idx) - 1)
+
+    def read(self, frame_idx):
+        # Returns the decoded frame (BGR) or None
+        if not 0 <= frame_idx < len(self.index):
+            return None
+
+        if frame_idx == self.pos:
+            ok, frame = self.clip.retrieve()
+            return frame if ok else None
+
+        # Decoding forward is cheaper than seeking as long as there is no keyframe in between
+        if not (0 <= self.pos < frame_idx and self.index.keyframe_for(frame_idx) <= self.pos + 1):
+            if not self._seek(frame_idx):
+                return None
+
+        while self.pos < frame_idx:
+            if not self._grab():
+                return None
+
+        if self.pos != frame_idx:
+            return None
+
+        ok, frame = self.clip.retrieve()
+        return frame if ok else None
+
+
+def verify(video_file, num_samples=200, seed=0):
+    # Compares random access against decoding the whole clip sequentially
+    index = load_frame_index(video_file)
+    if index is None:
+        print(f'{video_file}: not an indexable MP4')
+        return False
+
+    clip = cv2.VideoCapture(video_file)
+    reference = []
+    while True:
+        ok, frame = clip.read()
+        if not ok:
+            break
+        reference.append(frame)
+    clip.release()
+
+    rng = np.random.default_rng(seed)
+    targets = rng.integers(0, len(reference), num_samples)
+
+    seeker = FrameSeeker(cv2.VideoCapture(video_file), index)
+    t = time.perf_counter()
+    mismatches = sum(1 for i in targets if not np.array_equal(seeker.read(i), reference[i]))
+    t_indexed = (time.perf_counter() - t) / num_samples
+
+    clip = cv2.VideoCapture(video_file)
+    t = time.perf_counter()
+    pos_frames_wrong = 0
+    for i in targets:
+        clip.set(cv2.CAP_PROP_POS_FRAMES, i)
+        ok, frame = clip.read()
+        pos_frames_wrong += not ok or not np.array_equal(frame, reference[i])
+    t_pos_frames = (time.perf_counter() - t) / num_samples
+
+    # Stepping forward a few frames at a time, as during playback with more than one frame per update
+    steps = np.arange(0, len(reference), 3)
+    seeker = FrameSeeker(cv2.VideoCapture(video_file), index)
+    t = time.perf_counter()
+    mismatches += sum(1 for i in steps if not np.array_equal(seeker.read(i), reference[i]))
+    t_indexed_step = (time.perf_counter() - t) / len(steps)
+
+    t = time.perf_counter()
+    for i in steps:
+        clip.set(cv2.CAP_PROP_POS_FRAMES, i)
+        ok, frame = clip.read()
+        pos_frames_wrong += not ok or not np.array_equal(frame, reference[i])
+    t_pos_frames_step = (time.perf_counter() - t) / len(steps)
+
+    print(f'{os.path.basename(video_file)}: {len(index)} frames ({len(reference)} decoded), {len(index.keyframes)} keyframes')
+    print(f'  indexed:             {t_indexed * 1000:6.1f}ms per random access, {t_indexed_step * 1000:6.1f}ms per step, {mismatches} wrong frames')
+    print(f'  CAP_PROP_POS_FRAMES: {t_pos_frames * 1000:6.1f}ms per random access, {t_pos_frames_step * 1000:6.1f}ms per step, {pos_frames_wrong} wrong frames')
+    return mismatches == 0 and len(index) == len(reference)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build frame indices for video clips')
+    parser.add_argument('paths', nargs='+', help='video files or directories containing them')
+    parser.add_argument('--verify', type=int, metavar='NUM_SAMPLES', default=0, help='check random access against sequential decoding')
+
+    args = parser.parse_args()
+
+    video_files = []
+    for p in args.paths:
+        if os.path.isdir(p):
+            video_files += sorted(os.path.join(p, f) for f in os.listdir(p) if f.lower().endswith('.mp4'))
+        else:
+            video_files.append(p)
+
+    ok = True
+    for video_file in video_files:
+        if args.verify:
+            ok &= verify(video_file, args.verify)
+        else:
+            index = load_frame_index(video_file)
+            if index is None:
+                print(f'{video_file}: not an indexable MP4')
+                ok = False
+            else:
+                print(f'{video_file}: {len(index)} frames, {len(index.keyframes)} keyframes')
+
+    sys.exit(0 if ok else 1)
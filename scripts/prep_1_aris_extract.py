@@ -41,27 +41,10 @@ FileHeaderStruct = _Struct(aris_definitions.FileHeaderDefinition, ArisFile)
 FrameHeaderStruct = _Struct(aris_definitions.FrameHeaderDefinition, ArisFrame)
 
 
-if __name__ == '__main__':
-    """
-    for every run a user-specific json file is created and stored in the python-script directory
-    the json file contains the source- and outpot-folders for aris, gantry and gopro data
-    the json file is automatically imported for all following preprocessing-steps
+def extract_aris_file(aris_recording_path, output_path):
+    filename = os.path.splitext(os.path.basename(aris_recording_path))[0]
     
-    Note that the cutting and downsampling of the gopro .mp4 files is still done purely as bash-script in the terminal
-    
-    """
-    
-    config = get_config()
-    input_path = config["aris_input"]
-    output_path = config["aris_extract"]
-
-    aris_files = sorted([file for file in os.listdir(input_path) if file.endswith(".aris")])
-    
-    for recording in tqdm(aris_files):
-        aris_recording_path = os.path.join(input_path, recording)
-        in_file = open(aris_recording_path, 'rb')
-        filename = os.path.splitext(os.path.basename(aris_recording_path))[0]
-        
+    with open(aris_recording_path, 'rb') as in_file:
         # Basic sanity checks
         file_header = FileHeaderStruct.read(in_file)
         if file_header[ArisFile.version.value] != 0x05464444:
@@ -86,24 +69,44 @@ if __name__ == '__main__':
         frame_number_padding = 4  #int(np.log10(num_frames)) + 1
         
         # Prepare the frame metadata file
-        out_file = open(os.path.join(output_path, filename, filename + '_frames.csv'), 'w')
-        writer = csv.DictWriter(out_file, frame_header.keys())
-        writer.writeheader()
-        
-        # Write frame metadata and frames
-        with tqdm(total=num_frames) as t:
-            while frame_header is not None:
-                # Write header to csv
-                writer.writerow(frame_header)
-                
-                # Write data to ppm
-                frame_idx = frame_header[ArisFrame.frame_index.value]
-                in_file.readinto(frame_data.data)
-                cv2.imwrite(
-                    os.path.join(output_path, filename, f'{frame_idx:0{frame_number_padding}}.pgm'), 
-                    frame_data
-                )
-                t.update()
-                
-                # Read next header
-                frame_header = FrameHeaderStruct.read(in_file)
\ No newline at end of file
+        with open(os.path.join(output_path, filename, filename + '_frames.csv'), 'w') as out_file:
+            writer = csv.DictWriter(out_file, frame_header.keys())
+            writer.writeheader()
+            
+            # Write frame metadata and frames
+            with tqdm(total=num_frames) as t:
+                while frame_header is not None:
+                    # Write header to csv
+                    writer.writerow(frame_header)
+                    
+                    # Write data to ppm
+                    frame_idx = frame_header[ArisFrame.frame_index.value]
+                    in_file.readinto(frame_data.data)
+                    cv2.imwrite(
+                        os.path.join(output_path, filename, f'{frame_idx:0{frame_number_padding}}.pgm'), 
+                        frame_data
+                    )
+                    t.update()
+                    
+                    # Read next header
+                    frame_header = FrameHeaderStruct.read(in_file)
+
+
+if __name__ == '__main__':
+    """
+    for every run a user-specific json file is created and stored in the python-script directory
+    the json file contains the source- and outpot-folders for aris, gantry and gopro data
+    the json file is automatically imported for all following preprocessing-steps
+    
+    Note that the cutting and downsampling of the gopro .mp4 files is still done purely as bash-script in the terminal
+    
+    """
+    
+    config = get_config()
+    input_path = config["aris_input"]
+    output_path = config["aris_extract"]
+
+    aris_files = sorted([file for file in os.listdir(input_path) if file.endswith(".aris")])
+    
+    for recording in tqdm(aris_files):
+        extract_aris_file(os.path.join(input_path, recording), output_path)
@@ -7,6 +7,7 @@ import cv2
 from tqdm import tqdm
 
 from common.config import get_config
+from common.image_codecs import LOSSLESS_FORMATS, is_format_available, get_imwrite_params
 from common.aris_definitions import (
     get_beamcount_from_pingmode,
     BeamWidthsAris3000_64,
@@ -260,6 +261,106 @@ def aris_frame_to_polar_csv(frame, frame_idx, metadata):
     return df
 
 
+def get_polar_imwrite_params(image_format, png_compression_level=3, jxl_effort=7):
+    # See common/image_codecs.py for a benchmark of the lossless formats
+    if not is_format_available(image_format):
+        raise ValueError(f"{image_format} images are not supported by this OpenCV build")
+    if image_format in LOSSLESS_FORMATS:
+        return get_imwrite_params(image_format, png_compression=png_compression_level, jxl_effort=jxl_effort)
+    return []
+
+
+def convert_recording(recording_path,
+                      methods,
+                      image_format="png",
+                      imwrite_params=(),
+                      skip_existing=True,
+                      polar1_norm_intensity=False,
+                      polar1_antialiasing=False,
+                      polar1_scale=2.0,
+                      polar2_resolution=500,
+                      progress=None):
+    rec_name = os.path.basename(os.path.normpath(recording_path))
+    both_polars = "polar" in methods and "polar2" in methods
+    imwrite_params = list(imwrite_params)
+
+    frames_meta_file = os.path.join(recording_path, f"{rec_name}_frames.csv")
+    out_path = os.path.join(recording_path, "polar")
+    os.makedirs(out_path, exist_ok=True)
+
+    with open(frames_meta_file, "r") as frames_meta_file:
+        metadata = pd.read_csv(frames_meta_file)
+
+        for f in sorted(os.listdir(recording_path)):
+            if not f.lower().endswith(".pgm"):
+                continue
+
+            basename = os.path.splitext(os.path.basename(f))[0]
+            frame_out_path = os.path.join(out_path, basename)
+
+            # Check if any of the to-be-generated files are missing
+            if skip_existing:
+                for m in methods:
+                    if m.startswith("polar") and not os.path.isfile(frame_out_path + '.' + image_format):
+                        break
+
+                    if m == "csv" and not os.path.isfile(frame_out_path + '.csv'):
+                        break
+                else:
+                    # All files we would generate already exist, skip this frame
+                    continue
+
+            frame_name = f
+            if "_" in frame_name:
+                # Assume the actual frame identifier comes after an underscore (if present)
+                frame_name = f[f.index("_") + 1 :]
+
+            frame_idx = int(os.path.splitext(frame_name)[0])
+            frame = cv2.imread(os.path.join(recording_path, f), cv2.IMREAD_UNCHANGED)
+            
+            if both_polars:
+                polar2_out_path = os.path.join(out_path + '2', basename)
+            else:
+                polar2_out_path = frame_out_path
+
+            # Run the conversions
+            for conversion in methods:
+                if conversion == "polar1":
+                    polar_img = aris_frame_to_polar(
+                        frame, 
+                        frame_idx, 
+                        metadata,
+                        polar1_norm_intensity,
+                        polar1_antialiasing,
+                        polar1_scale,
+                    )
+                    cv2.imwrite(
+                        frame_out_path + '.' + image_format, 
+                        polar_img, 
+                        imwrite_params
+                    )
+                elif conversion == "polar2":
+                    polar_img = aris_frame_to_polar2(
+                        frame, 
+                        frame_idx, 
+                        metadata,
+                        polar2_resolution,
+                    )
+                    cv2.imwrite(
+                        polar2_out_path + '.' + image_format, 
+                        polar_img, 
+                        imwrite_params
+                    )
+                elif conversion == "csv":
+                    polar_df = aris_frame_to_polar_csv(frame, frame_idx, metadata)
+                    polar_df.to_csv(frame_out_path + '.csv', header=True, index=False)
+                else:
+                    raise ValueError(f"Invalid method {conversion}")
+        
+            if progress is not None:
+                progress.update()
+
+
 if __name__ == "__main__":
     config = get_config()
 
@@ -267,14 +368,16 @@ if __name__ == "__main__":
     methods = config.get("aris_to_polar_method", "polar2+csv").split('+')
     skip_existing = config.get("aris_to_polar_skip_existing", True)
     image_format = config.get("aris_to_polar_image_format", "pgm")
-    png_compression_level = config.get("aris_to_polar_png_compression", 9)
+    png_compression_level = config.get("aris_to_polar_png_compression", 3)
+    jxl_effort = config.get("aris_to_polar_jxl_effort", 7)
 
     polar1_norm_intensity = config.get("aris_to_polar_polar1_norm_intensity", False)
     polar1_antialiasing = config.get("aris_to_polar_polar1_antialiasing", False)
     polar1_scale = config.get("aris_to_polar_polar1_scale", 2.0)
     polar2_resolution = config.get("aris_to_polar_polar2_resolution", 500)
 
-    both_polars = "polar" in methods and "polar2" in methods
+    imwrite_params = get_polar_imwrite_params(image_format, png_compression_level, jxl_effort)
+
     recordings = sorted([x for x in os.listdir(input_path)])
 
     # Get the total number of frames we have to generate
@@ -301,78 +404,13 @@ if __name__ == "__main__":
             if not os.path.isdir(recording_path):
                 continue
 
-            frames_meta_file = os.path.join(recording_path, f"{rec_name}_frames.csv")
-            out_path = os.path.join(recording_path, "polar")
-            os.makedirs(out_path, exist_ok=True)
-
-            with open(frames_meta_file, "r") as frames_meta_file:
-                metadata = pd.read_csv(frames_meta_file)
-
-                for f in sorted(os.listdir(recording_path)):
-                    if not f.lower().endswith(".pgm"):
-                        continue
-
-                    basename = os.path.splitext(os.path.basename(f))[0]
-                    frame_out_path = os.path.join(out_path, basename)
-
-                    # Check if any of the to-be-generated files are missing
-                    if skip_existing:
-                        for m in methods:
-                            if m.startswith("polar") and not os.path.isfile(frame_out_path + '.' + image_format):
-                                break
-
-                            if m == "csv" and not os.path.isfile(frame_out_path + '.csv'):
-                                break
-                        else:
-                            # All files we would generate already exist, skip this frame
-                            continue
-
-                    frame_name = f
-                    if "_" in frame_name:
-                        # Assume the actual frame identifier comes after an underscore (if present)
-                        frame_name = f[f.index("_") + 1 :]
-
-                    frame_idx = int(os.path.splitext(frame_name)[0])
-                    frame = cv2.imread(os.path.join(recording_path, f), cv2.IMREAD_UNCHANGED)
-                    polar = aris_frame_to_polar(frame, frame_idx, metadata)
-                    
-                    if both_polars:
-                        polar2_out_path = os.path.join(out_path + '2', basename)
-                    else:
-                        polar2_out_path = frame_out_path
-
-                    # Run the conversions
-                    for conversion in methods:
-                        if conversion == "polar1":
-                            polar_img = aris_frame_to_polar(
-                                frame, 
-                                frame_idx, 
-                                metadata,
-                                polar1_norm_intensity,
-                                polar1_antialiasing,
-                                polar1_scale,
-                            )
-                            cv2.imwrite(
-                                frame_out_path + '.' + image_format, 
-                                polar_img, 
-                                [cv2.IMWRITE_PNG_COMPRESSION, png_compression_level]
-                            )
-                        elif conversion == "polar2":
-                            polar_img = aris_frame_to_polar2(
-                                frame, 
-                                frame_idx, 
-                                metadata,
-                                polar2_resolution,
-                            )
-                            cv2.imwrite(
-                                polar2_out_path + '.' + image_format, 
-                                polar_img, 
-                                [cv2.IMWRITE_PNG_COMPRESSION, png_compression_level]
-                            )
-                        elif conversion == "csv":
-                            polar_df = aris_frame_to_polar_csv(frame, frame_idx, metadata)
-                            polar_df.to_csv(frame_out_path + '.csv', header=True, index=False)
-                        else:
-                            raise ValueError(f"Invalid method {conversion}")
-                
-                    t.update()
+            convert_recording(recording_path,
+                              methods,
+                              image_format,
+                              imwrite_params,
+                              skip_existing,
+                              polar1_norm_intensity,
+                              polar1_antialiasing,
+                              polar1_scale,
+                              polar2_resolution,
+                              progress=t)
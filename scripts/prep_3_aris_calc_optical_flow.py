@@ -1,5 +1,4 @@
 #!/usr/bin/env python
-import sys
 import os
 import cv2
 import pandas as pd
@@ -33,12 +32,53 @@ feature_params_lk = dict(
 )   
 
 
+class ImageFileIterator:
+    def __init__(self, image_files) -> None:
+        self._image_files = image_files
+    
+    def __iter__(self):
+        for idx in trange(len(self._image_files)):
+            yield cv2.imread(self._image_files[idx], cv2.IMREAD_UNCHANGED)
+            
+    def __len__(self):
+        return len(self._image_files)
+
+
+def calc_aris_flow(aris_data_dir, method='lk', polar_img_format='png'):
+    out_file = os.path.join(aris_data_dir, os.path.split(aris_data_dir)[-1] + '_flow.csv')
+    
+    frames_path = os.path.join(aris_data_dir, 'polar')
+    frames_ext = '.' + polar_img_format
+    if not os.path.isdir(frames_path):
+        print(f'{aris_data_dir} does not contain polar frames, using raw frames instead')
+        frames_path = aris_data_dir
+        frames_ext = '.pgm'
+    aris_frames = sorted(
+        os.path.join(frames_path, f) 
+        for f in os.listdir(frames_path) 
+        if f.lower().endswith(frames_ext)
+    )
+    
+    iterator = ImageFileIterator(aris_frames)
+    
+    if method == 'lk':
+        flow = calc_optical_flow_lk(iterator, flow_params_lk, feature_params_lk)
+    elif method == 'farnerback':
+        flow = calc_optical_flow_farnerback(iterator, flow_params_farneback)
+    else:
+        raise ValueError('Invalid method')
+    
+    pd.DataFrame(flow).to_csv(out_file, header=None, index=None)
+    return out_file
+
+
 if __name__ == '__main__':
     config = get_config()
 
     input_path = config["aris_extract"]
     method = config.get("aris_optical_flow_method", "lk")
     recalc = config.get("aris_optical_flow_recalc", True)
+    polar_img_format = config.get("aris_to_polar_image_format", "png")
 
     recordings = sorted([x for x in os.listdir(input_path)])
 
@@ -53,37 +93,6 @@ if __name__ == '__main__':
         out_file = os.path.join(aris_data_dir, os.path.split(aris_data_dir)[-1] + '_flow.csv')
         if not recalc and os.path.isfile(out_file):
             print(f'{out_file} already exists, skipping')
-            sys.exit(0)
-        
-        frames_path = os.path.join(aris_data_dir, 'polar')
-        if not os.path.isdir(frames_path):
-            print(f'{aris_data_dir} does not contain polar frames, using raw frames instead')
-            frames_path = aris_data_dir
-        aris_frames = sorted(
-            os.path.join(frames_path, f) 
-            for f in os.listdir(frames_path) 
-            if f.lower().endswith('.pgm')
-        )
-        
-        class ImageFileIterator:
-            def __init__(self, image_files) -> None:
-                self._image_files = image_files
-            
-            def __iter__(self):
-                for idx in trange(len(self._image_files)):
-                    yield cv2.imread(self._image_files[idx], cv2.IMREAD_UNCHANGED)
-                    
-            def __len__(self):
-                return len(self._image_files)
-        
-        iterator = ImageFileIterator(aris_frames)
-        
-        if method == 'lk':
-            flow = calc_optical_flow_lk(iterator, flow_params_lk, feature_params_lk)
-        elif method == 'farnerback':
-            flow = calc_optical_flow_farnerback(iterator, flow_params_farneback)
-        else:
-            raise ValueError('Invalid method')
+            continue
         
-        pd.DataFrame(flow).to_csv(out_file, header=None, index=None)
-        #print(flow.shape)
+        calc_aris_flow(aris_data_dir, method, polar_img_format)
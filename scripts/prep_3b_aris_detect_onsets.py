@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+import os
+import time
+import yaml
+import numpy as np
+import pandas as pd
+import cv2
+from tqdm import tqdm
+
+from common.config import get_config
+from common.proxies import load_aris_preview
+
+
+"""
+Proposes the motion onset and end for every ARIS recording, similar to what prep_6 does for the
+gantry trajectories. The proposals are written to the recordings' _marks.yaml in a separate "auto"
+section, so they never overwrite an onset that was set manually. prep_4_aris_find_offsets.py starts
+at the proposed onset so that it only has to be confirmed (or corrected).
+
+Two per-frame motion signals are used: the optical flow magnitudes from prep_3 and the mean absolute
+difference between consecutive frames. Both are normalized and combined, and the recording is then
+split into rest - motion - rest by finding the two change points that best explain the signal
+(least squares fit of three constant segments).
+"""
+
+
+DIFF_IMAGE_SIZE = 128  # frame differences are calculated on downscaled frames
+
+
+def read_frame_diffs(aris_dir, frame_files):
+    # Mean absolute difference between consecutive frames. The preview stack from prep_8b is much
+    # faster to read than the individual frames.
+    stack = load_aris_preview(aris_dir, frame_files, 'raw')
+
+    def frames():
+        for idx in range(len(frame_files)):
+            img = stack[idx] if stack is not None else cv2.imread(frame_files[idx], cv2.IMREAD_GRAYSCALE)
+            scale = DIFF_IMAGE_SIZE / max(img.shape)
+            if scale < 1.:
+                img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            yield img.astype(np.float32)
+
+    diffs = [0.]
+    prev = None
+    for img in frames():
+        if prev is not None:
+            diffs.append(float(np.mean(np.abs(img - prev))))
+        prev = img
+    return np.array(diffs[:len(frame_files)])
+
+
+def read_flow(flow_file, num_frames):
+    try:
+        flow = pd.read_csv(flow_file, header=None)[0].to_numpy(dtype=float)
+    except (FileNotFoundError, pd.errors.EmptyDataError):
+        return None
+    if len(flow) != num_frames:
+        return None
+    return flow
+
+
+def normalize(signal, smoothing):
+    # Robust z-score, so that signals of different magnitudes can be combined
+    signal = pd.Series(signal).rolling(smoothing, center=True, min_periods=1).median().to_numpy()
+    median = np.median(signal)
+    mad = np.median(np.abs(signal - median)) * 1.4826
+    scale = mad if mad > 1e-9 else max(np.std(signal), 1e-9)
+    return (signal - median) / scale
+
+
+def _segment_sse(csum, csum_sq, start, end):
+    # Sum of squared errors of a constant fit to signal[start:end], vectorized over start and end
+    n = end - start
+    s = csum[end] - csum[start]
+    return csum_sq[end] - csum_sq[start] - s * s / np.maximum(n, 1)
+
+
+def _best_split(signal, onsets, end_range, min_segment):
+    # Searches all given onsets and the ends within end_range for the lowest total squared error
+    n = len(signal)
+    csum = np.concatenate([[0.], np.cumsum(signal)])
+    csum_sq = np.concatenate([[0.], np.cumsum(signal * signal)])
+
+    best = (np.inf, 0, n)
+    for onset in onsets:
+        ends = np.arange(max(onset + min_segment, end_range[0]), min(n - min_segment, end_range[1]) + 1)
+        if not len(ends):
+            continue
+        cost = (_segment_sse(csum, csum_sq, 0, onset)
+                + _segment_sse(csum, csum_sq, onset, ends)
+                + _segment_sse(csum, csum_sq, ends, n))
+
+        # The middle segment must be the one with motion
+        mid_mean = (csum[ends] - csum[onset]) / (ends - onset)
+        end_mean = (csum[n] - csum[ends]) / (n - ends)
+        cost[(mid_mean <= csum[onset] / onset) | (mid_mean <= end_mean)] = np.inf
+
+        i = np.argmin(cost)
+        if cost[i] < best[0]:
+            best = (cost[i], onset, int(ends[i]))
+
+    if not np.isfinite(best[0]):
+        return None
+    return best[1], best[2]
+
+
+def find_change_points(signal, min_segment=10, max_points=1000):
+    # Best split into rest - motion - rest, i.e. two change points 0 < onset < end < n. The exact
+    # search is quadratic, so long recordings are searched on block means first and then refined
+    # around the coarse solution.
+    n = len(signal)
+    factor = int(np.ceil(n / max_points))
+    if factor <= 1:
+        return _best_split(signal, range(min_segment, n - 2 * min_segment + 1), (0, n), min_segment)
+
+    coarse = signal[:n // factor * factor].reshape(-1, factor).mean(axis=1)
+    coarse_min_segment = max(1, min_segment // factor)
+    res = _best_split(coarse, range(coarse_min_segment, len(coarse) - 2 * coarse_min_segment + 1), (0, len(coarse)), coarse_min_segment)
+    if res is None:
+        return None
+
+    onset, end = res[0] * factor, res[1] * factor
+    onsets = range(max(min_segment, onset - 2 * factor), min(n - 2 * min_segment, onset + 2 * factor) + 1)
+    return _best_split(signal, onsets, (end - 2 * factor, end + 2 * factor), min_segment)
+
+
+def step_confidence(signal, before, split, after):
+    # Fraction of the variance in signal[before:after] that is explained by a step at split
+    segment = signal[before:after]
+    total = np.sum((segment - segment.mean())**2)
+    if total <= 1e-12:
+        return 0.
+    left = signal[before:split]
+    right = signal[split:after]
+    residual = np.sum((left - left.mean())**2) + np.sum((right - right.mean())**2)
+    return float(1. - residual / total)
+
+
+def detect_motion(aris_dir, frame_files, smoothing=5, min_segment=10):
+    basename = os.path.basename(os.path.normpath(aris_dir))
+    num_frames = len(frame_files)
+    if num_frames < 3 * min_segment:
+        return None
+
+    signals = {}
+    flow = read_flow(os.path.join(aris_dir, basename + '_flow.csv'), num_frames)
+    if flow is not None:
+        signals['flow'] = normalize(flow, smoothing)
+    signals['diff'] = normalize(read_frame_diffs(aris_dir, frame_files), smoothing)
+
+    signal = np.mean(list(signals.values()), axis=0)
+    change_points = find_change_points(signal, min_segment)
+    if change_points is None:
+        return None
+
+    onset, end = change_points
+    return dict(
+        onset=int(onset),
+        end=int(end - 1),
+        onset_confidence=round(step_confidence(signal, 0, onset, end), 3),
+        end_confidence=round(step_confidence(signal, onset, end, num_frames), 3),
+        signals='+'.join(signals.keys()),
+    )
+
+
+def write_proposal(aris_dir, proposal):
+    basename = os.path.basename(os.path.normpath(aris_dir))
+    marks_file = os.path.join(aris_dir, basename + '_marks.yaml')
+    try:
+        with open(marks_file, 'r') as f:
+            data = yaml.safe_load(f) or {}
+    except FileNotFoundError:
+        data = {}
+
+    # Manually set values are kept as they are
+    data['auto'] = proposal
+    with open(marks_file, 'w') as f:
+        yaml.safe_dump(data, f)
+
+
+def propose_onsets(aris_dir, smoothing=5, min_segment=10):
+    # Detects and stores the proposal for a single recording, None if there was no motion
+    frame_files = sorted(os.path.join(aris_dir, f) for f in os.listdir(aris_dir) if f.lower().endswith('.pgm'))
+    proposal = detect_motion(aris_dir, frame_files, smoothing, min_segment)
+    if proposal is not None:
+        write_proposal(aris_dir, proposal)
+    return proposal
+
+
+if __name__ == '__main__':
+    config = get_config()
+
+    input_path = config["aris_extract"]
+    smoothing = config.get("aris_onset_smoothing", 5)
+    min_segment = config.get("aris_onset_min_segment", 10)
+
+    t_start = time.perf_counter()
+    for rec_name in tqdm(sorted(os.listdir(input_path))):
+        aris_dir = os.path.join(input_path, rec_name)
+        if not os.path.isdir(aris_dir):
+            continue
+
+        proposal = propose_onsets(aris_dir, smoothing, min_segment)
+        if proposal is None:
+            print(f'{rec_name}: no motion found')
+            continue
+
+        print(f'{rec_name}: onset={proposal["onset"]} ({proposal["onset_confidence"]:.0%}), '
+              f'end={proposal["end"]} ({proposal["end_confidence"]:.0%})')
+
+    print(f'Done in {time.perf_counter() - t_start:.1f}s')
@@ -6,24 +6,90 @@ import numpy as np
 import cv2
 
 from common.config import get_config
+from common.proxies import get_preview_shape, load_aris_preview, make_aris_preview
 
 
-def save_marks(aris_dir, onset, marks):
+def get_marks_file(aris_dir):
     basename = os.path.split(aris_dir)[-1]
-    with open(os.path.join(aris_dir, basename + '_marks.yaml'), 'w') as f:
-        yaml.safe_dump(dict(onset=onset, marks=list(marks)), f)
+    return os.path.join(aris_dir, basename + '_marks.yaml')
+
+
+def read_marks_file(aris_dir):
+    try:
+        with open(get_marks_file(aris_dir), 'r') as f:
+            return yaml.safe_load(f) or {}
+    except FileNotFoundError:
+        return {}
+
+
+def save_marks(aris_dir, onset, marks):
+    # Keep everything else (e.g. the proposals from prep_3b)
+    data = read_marks_file(aris_dir)
+    data.update(onset=onset, marks=list(marks))
+    with open(get_marks_file(aris_dir), 'w') as f:
+        yaml.safe_dump(data, f)
         
         
 def get_marks(aris_dir):
-    basename = os.path.split(aris_dir)[-1]
+    # Returns the manually set onset, marks and the automatic proposal (if any)
+    data = read_marks_file(aris_dir)
+    return data.get('onset', -1), data.get('marks', []), data.get('auto')
+
+
+def load_stack(aris_dir, images):
+    # All frames in a single memory-mapped uint8 array, so navigating never has to touch the disk.
+    # The onsets are set by looking at single beams, so the frames are never scaled down.
+    frame_shape = get_preview_shape(images[0])
+    stack = load_aris_preview(aris_dir, images, 'raw', frame_shape)
+    if stack is not None:
+        return stack
+    
+    # Only done once per recording, prep_8b_make_proxies.py can create these in advance
     try:
-        with open(os.path.join(aris_dir, basename + '_marks.yaml'), 'r') as f:
-            data = yaml.safe_load(f)
-            return data.get('onset', -1), data.get('marks', [])
-    except FileNotFoundError:
-        pass
-            
-    return -1, []
+        make_aris_preview(aris_dir, images, 'raw')
+        stack = load_aris_preview(aris_dir, images, 'raw', frame_shape)
+    except OSError as e:
+        print(f'Could not write preview stack: {e}')
+    
+    if stack is None:
+        stack = np.stack([cv2.imread(f, cv2.IMREAD_GRAYSCALE) for f in images])
+    return stack
+
+
+class StaticOverlay:
+    # Text that doesn't change while viewing a recording is only rendered once and then copied onto
+    # every frame. Only the bands that actually contain text are touched.
+    def __init__(self, h, w, basename, color, proposal=None):
+        mask = np.zeros((h, w), dtype=np.uint8)
+        cv2.putText(mask, basename,           (5, 10),   cv2.FONT_HERSHEY_SIMPLEX, .3,  255, 1)
+        if proposal:
+            text = f'Proposed onset: {proposal["onset"]} ({proposal.get("onset_confidence", 0):.0%})'
+            cv2.putText(mask, text,           (5, 40),   cv2.FONT_HERSHEY_SIMPLEX, .3,  255, 1)
+        cv2.putText(mask, f'arrows: navigate', (5, h-60), cv2.FONT_HERSHEY_SIMPLEX, .3,  255, 1)
+        cv2.putText(mask, f'enter: save',      (5, h-50), cv2.FONT_HERSHEY_SIMPLEX, .3,  255, 1)
+        cv2.putText(mask, f'0: set onset',     (5, h-40), cv2.FONT_HERSHEY_SIMPLEX, .3,  255, 1)
+        cv2.putText(mask, f'm: mark frame',    (5, h-30), cv2.FONT_HERSHEY_SIMPLEX, .3,  255, 1)
+        cv2.putText(mask, f's: skip',          (5, h-20), cv2.FONT_HERSHEY_SIMPLEX, .3,  255, 1)
+        cv2.putText(mask, f'q: quit',          (5, h-10), cv2.FONT_HERSHEY_SIMPLEX, .3,  255, 1)
+        mask = mask >= 64
+        
+        # Split into bands of consecutive rows with text
+        self.bands = []
+        rows = np.flatnonzero(mask.any(axis=1))
+        for band_rows in np.split(rows, np.flatnonzero(np.diff(rows) > 1) + 1):
+            if not len(band_rows):
+                continue
+            r0, r1 = band_rows[0], band_rows[-1] + 1
+            cols = np.flatnonzero(mask[r0:r1].any(axis=0))
+            roi = (slice(r0, r1), slice(cols[0], cols[-1] + 1))
+            band_mask = mask[roi][..., None]
+            band_color = np.broadcast_to(np.array(color, dtype=np.uint8), band_mask.shape[:2] + (3,))
+            self.bands.append((roi, band_color, band_mask))
+    
+    def apply(self, img):
+        for roi, color, mask in self.bands:
+            np.copyto(img[roi], color, where=mask)
+        return img
 
 
 def view_images(aris_dir):
@@ -37,39 +103,41 @@ def view_images(aris_dir):
     idx = 0
     reload = True
     
-    onset, marks = get_marks(aris_dir)
+    onset, marks, proposal = get_marks(aris_dir)
     marks = set(marks)
     
-    # Read first image, all frames of a recording have the same size
-    img = cv2.imread(images[idx])
-    h = img.shape[0]
-    w = img.shape[1]
+    # Start at the automatically detected onset so it only has to be confirmed
+    proposed_onset = proposal['onset'] if proposal else -1
+    if onset < 0 and 0 <= proposed_onset < num_images:
+        idx = proposed_onset
+    
+    # All frames of a recording have the same size
+    stack = load_stack(aris_dir, images)
+    h = stack.shape[1]
+    w = stack.shape[2]
+    overlay = StaticOverlay(h, w, basename, color, proposal)
     
     cv2.namedWindow('preview', cv2.WINDOW_NORMAL)
     cv2.setWindowTitle('preview', basename)
     
     while True:
         if reload:
-            img = cv2.imread(images[idx])
+            img = cv2.cvtColor(stack[idx], cv2.COLOR_GRAY2BGR)
+            overlay.apply(img)
             
-            cv2.putText(img, basename,                 (5, 10), cv2.FONT_HERSHEY_SIMPLEX, .3,  color, 1)
             cv2.putText(img, f'Motion onset: {onset}', (5, 20), cv2.FONT_HERSHEY_SIMPLEX, .3, color, 1)
             
             if idx == onset:
                 cv2.putText(img, f'{idx} / {num_images} *', (5, 30), cv2.FONT_HERSHEY_SIMPLEX, .3,  color, 1)
             elif idx in marks:
                 cv2.putText(img, f'{idx} / {num_images} M', (5, 30), cv2.FONT_HERSHEY_SIMPLEX, .3,  color, 1)
+            elif idx == proposed_onset:
+                cv2.putText(img, f'{idx} / {num_images} A', (5, 30), cv2.FONT_HERSHEY_SIMPLEX, .3,  color, 1)
             else:
                 cv2.putText(img, f'{idx} / {num_images}', (5, 30), cv2.FONT_HERSHEY_SIMPLEX, .3,  color, 1)
             
-            cv2.putText(img, f'arrows: navigate', (5, h-60), cv2.FONT_HERSHEY_SIMPLEX, .3,  color, 1)
-            cv2.putText(img, f'enter: save',      (5, h-50), cv2.FONT_HERSHEY_SIMPLEX, .3,  color, 1)
-            cv2.putText(img, f'0: set onset',     (5, h-40), cv2.FONT_HERSHEY_SIMPLEX, .3,  color, 1)
-            cv2.putText(img, f'm: mark frame',    (5, h-30), cv2.FONT_HERSHEY_SIMPLEX, .3,  color, 1)
-            cv2.putText(img, f's: skip',          (5, h-20), cv2.FONT_HERSHEY_SIMPLEX, .3,  color, 1)
-            cv2.putText(img, f'q: quit',          (5, h-10), cv2.FONT_HERSHEY_SIMPLEX, .3,  color, 1)
-            
-        cv2.imshow('preview', img)
+            cv2.imshow('preview', img)
+        
         key = cv2.waitKey(1) & 0xFF
         reload = True
         
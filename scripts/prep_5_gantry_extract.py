@@ -1,48 +1,56 @@
 #!/usr/bin/env python
 import os
-import csv
-import rosbag
+import numpy as np
 from tqdm import tqdm
 
 from common.config import get_config
+from common.odometry import get_odometry_path, save_odometry, sort_odometry, resample_odometry
+from common.rosbag_reader import BagReader, parse_odometry
 
 
-def stamp_to_microseconds(stamp):
-    return int(stamp.secs * 1e6) + int(stamp.nsecs // 1e3)
+"""
+Extracts the gantry crane trajectories from the recorded ROS bags. The bags are read with the
+pure-Python reader in common/rosbag_reader.py, so no ROS installation is required: the serialized
+/odom messages are decoded all at once with NumPy instead of one Python object per message.
+Run "python -m common.rosbag_reader --benchmark <num_msgs>" to measure the speed on a synthetic bag.
 
+Each bag results in two files: the trajectory (<bag>.csv with timestamp_us,x,y,z) that is used by
+the following steps, and the full odometry including orientation and twist (<bag>_odom.npz, see
+common/odometry.py). Both can optionally be resampled to a fixed rate.
+"""
 
-def extract_bag(bag_file, out_dir_path, time_adjust=0.):
+
+def extract_bag(bag_file, out_dir_path, time_adjust=0., resample_rate=0.):
     basename = os.path.splitext(os.path.basename(bag_file))[0]
-    bag = rosbag.Bag(bag_file)
-    
-    with open(os.path.join(out_dir_path, basename + '.csv'), 'w') as out_file:
-        writer = csv.writer(out_file)
-        
-        # Header
-        writer.writerow(['timestamp_us', 'x', 'y', 'z'])
-        
-        num_msgs = bag.get_message_count('/odom')
-        for _, msg, _ in tqdm(bag.read_messages('/odom'), total=num_msgs):
-            stamp = msg.header.stamp
-            
-            t = stamp_to_microseconds(stamp) + time_adjust * 3600 * 1e6
-            x = msg.pose.pose.position.x
-            y = msg.pose.pose.position.y
-            z = msg.pose.pose.position.z
-            
-            writer.writerow([t, x, y, z])
-
-    
+    csv_file = os.path.join(out_dir_path, basename + '.csv')
+    os.makedirs(out_dir_path, exist_ok=True)
+
+    with BagReader(bag_file) as bag:
+        data, offsets, lengths, _ = bag.read_messages_block('/odom')
+    odom = parse_odometry(data, offsets, lengths)
+    odom['timestamp_us'] += int(round(time_adjust * 3600 * 1e6))
+
+    if resample_rate > 0:
+        odom = resample_odometry(odom, resample_rate)
+    else:
+        odom = sort_odometry(odom)
+
+    save_odometry(get_odometry_path(csv_file), odom)
+    np.savetxt(csv_file, np.column_stack([odom[k] for k in ['timestamp_us', 'x', 'y', 'z']]),
+               fmt=['%d', '%.9g', '%.9g', '%.9g'], delimiter=',', header='timestamp_us,x,y,z', comments='')
+    return len(odom['timestamp_us'])
+
+
 if __name__ == '__main__':
     config = get_config()
 
     input_path = config["gantry_input"]
-    output_path = config["gantry_output"]
-    time_adjust = str(config.get("gantry_time_adjust", "0"))
+    output_path = config["gantry_extract"]
+    time_adjust = float(config.get("gantry_time_adjust", 0))
+    resample_rate = float(config.get("gantry_resample_rate", 0))
 
-    os.makedirs(output_path, exist_ok=True)
     bag_files = sorted([x for x in os.listdir(input_path) if x.endswith(".bag")])
 
     for bag in tqdm(bag_files):
         bag_path = os.path.join(input_path, bag)
-        extract_bag(bag_path, output_path, time_adjust)
+        extract_bag(bag_path, output_path, time_adjust, resample_rate)
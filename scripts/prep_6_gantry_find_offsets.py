@@ -1,46 +1,127 @@
 #!/usr/bin/env python
 import os
 import csv
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
 from common.config import get_config
 
 
-def find_motion_onset(csv_file):
-    data = pd.read_csv(csv_file)
-    
-    # Find index of first change in x or y
-    # NOTE: don't use index before, as there may be a considerable delay
-    diff = data['x'].diff() + data['y'].diff()
-    diff[diff.isna()] = 0.
-    onset_idx = diff.ne(0).idxmax()
-    
-    onset = data['timestamp_us'].iloc[onset_idx]
-    start = data['timestamp_us'].iloc[0]
-    end = data['timestamp_us'].iloc[-1]
-    
-    return start, end, onset
+GANTRY_METADATA_FILE = 'gantry_metadata.csv'
+METADATA_COLUMNS = ['file', 'start_us', 'end_us', 'onset_us', 'motion_end_us', 'num_stops', 'stops_us',
+                    'path_length_m', 'mean_speed_mps', 'max_speed_mps', 'p95_speed_mps']
+
+
+def load_trajectory(csv_file):
+    data = pd.read_csv(csv_file, usecols=['timestamp_us', 'x', 'y', 'z'], dtype={'timestamp_us': np.int64})
+    return data['timestamp_us'].to_numpy(), data[['x', 'y', 'z']].to_numpy(dtype=float)
+
+
+def windowed_speed(t_us, xyz, window_s):
+    # Speed from positions half a window before and after each sample, which averages out the
+    # jitter of the odometry
+    n = len(t_us)
+    dt_median = np.median(np.diff(t_us)) if n > 1 else 1
+    k = max(1, int(round(window_s * 1e6 / 2 / max(dt_median, 1))))
+    idx = np.arange(n)
+    lo = np.maximum(idx - k, 0)
+    hi = np.minimum(idx + k, n - 1)
+    dist = np.linalg.norm(xyz[hi] - xyz[lo], axis=1)
+    dt = np.maximum(t_us[hi] - t_us[lo], 1) / 1e6
+    return dist / dt
+
+
+def find_runs(mask):
+    # Start (inclusive) and end (exclusive) indices of all runs of True
+    padded = np.concatenate([[False], mask, [False]])
+    edges = np.flatnonzero(np.diff(padded.astype(np.int8)))
+    return edges[0::2], edges[1::2]
+
+
+def segment_trajectory(t_us, xyz, noise_threshold=5e-4, speed_threshold=2e-3, min_stop_s=0.5, window_s=0.2):
+    # Finds the motion onset and end as well as all stops in between. Positions are compared in 3D,
+    # so opposite moves along different axes can't cancel out.
+    n = len(t_us)
+    res = dict(start_us=int(t_us[0]), end_us=int(t_us[-1]), onset_us=int(t_us[0]), motion_end_us=int(t_us[0]),
+               num_stops=0, stops_us='', path_length_m=0., mean_speed_mps=0., max_speed_mps=0., p95_speed_mps=0.)
+    if n < 2:
+        return res
+
+    # Onset: first sample that left the initial position, end: first sample at the final position,
+    # i.e. the first one after the last move. A threshold of 0 is the same as looking for the first change.
+    moved_from_start = np.linalg.norm(xyz - xyz[0], axis=1) > noise_threshold
+    moved_from_end = np.linalg.norm(xyz - xyz[-1], axis=1) > noise_threshold
+    if not moved_from_start.any():
+        return res
+
+    onset_idx = int(np.argmax(moved_from_start))
+    end_idx = min(n - 1, int(n - np.argmax(moved_from_end[::-1])))
+    res['onset_us'] = int(t_us[onset_idx])
+    res['motion_end_us'] = int(t_us[end_idx])
+
+    # Stops: sufficiently long periods without motion between onset and end
+    speed = windowed_speed(t_us, xyz, window_s)
+    motion = slice(onset_idx, end_idx + 1)
+    starts, ends = find_runs(speed[motion] < speed_threshold)
+    starts += onset_idx
+    ends += onset_idx
+    durations = (t_us[ends - 1] - t_us[starts]) / 1e6
+    stops = [(int(t_us[s]), int(t_us[e - 1])) for s, e, d in zip(starts, ends, durations) if d >= min_stop_s]
+    res['num_stops'] = len(stops)
+    res['stops_us'] = ' '.join(f'{s}:{e}' for s, e in stops)
+
+    # Velocity statistics while moving
+    steps = np.linalg.norm(np.diff(xyz[motion], axis=0), axis=1)
+    res['path_length_m'] = float(steps.sum())
+    moving_speed = speed[motion][speed[motion] >= speed_threshold]
+    if len(moving_speed):
+        res['mean_speed_mps'] = float(moving_speed.mean())
+        res['max_speed_mps'] = float(moving_speed.max())
+        res['p95_speed_mps'] = float(np.percentile(moving_speed, 95))
+
+    return res
+
+
+def find_motion_onset(csv_file, **segment_args):
+    t_us, xyz = load_trajectory(csv_file)
+    res = segment_trajectory(t_us, xyz, **segment_args)
+    res['file'] = os.path.basename(csv_file)
+    return {k: round(v, 6) if isinstance(v, float) else v for k, v in res.items()}
+
+
+def write_gantry_metadata(input_path, segment_args, workers=0):
+    metadata_file = os.path.join(input_path, GANTRY_METADATA_FILE)
+    csv_files = [
+        os.path.join(input_path, f) for f in sorted(os.listdir(input_path))
+        if f.lower().endswith('.csv') and f != GANTRY_METADATA_FILE
+    ]
+
+    with ProcessPoolExecutor(workers or os.cpu_count()) as pool:
+        futures = [pool.submit(find_motion_onset, f, **segment_args) for f in csv_files]
+        results = [f.result() for f in tqdm(futures)]
+
+    with open(metadata_file, 'w') as out_file:
+        writer = csv.DictWriter(out_file, METADATA_COLUMNS)
+        writer.writeheader()
+
+        for res in results:
+            print(f'{res["file"]}: onset={(res["onset_us"] - res["start_us"]) / 1e6:.3f}s, '
+                  f'end={(res["motion_end_us"] - res["start_us"]) / 1e6:.3f}s, {res["num_stops"]} stops')
+            writer.writerow(res)
+    return metadata_file
 
 
 if __name__ == '__main__':
     config = get_config()
-    
+
     input_path = config["gantry_extract"]
-    metadata_file = os.path.join(input_path, "gantry_metadata.csv")
+    segment_args = dict(
+        noise_threshold=config.get("gantry_noise_threshold", 5e-4),
+        speed_threshold=config.get("gantry_speed_threshold", 2e-3),
+        min_stop_s=config.get("gantry_min_stop_duration", 0.5),
+    )
+    workers = config.get("gantry_segment_workers", 0)
 
-    with open(metadata_file, 'w') as out_file:
-        writer = csv.writer(out_file)
-        writer.writerow(['file', 'start_us', 'end_us', 'onset_us'])
-        
-        for csv_file in tqdm(sorted(os.listdir(input_path))):
-            if not csv_file.lower().endswith('.csv'):
-                continue
-            
-            if csv_file == 'gantry_metadata.csv':
-                continue
-            
-            print(f'{csv_file} ... ', end='')
-            start, end, onset = find_motion_onset(os.path.join(input_path, csv_file))
-            print((onset - start) / 1e6)
-            writer.writerow([csv_file, start, end, onset])
+    write_gantry_metadata(input_path, segment_args, workers)
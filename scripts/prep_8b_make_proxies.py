@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+import os
+import cv2
+from tqdm import tqdm
+
+from common.config import get_config
+from common.matching_context import get_aris_frame_lists
+from common.proxies import PROXY_CLIPS_DIR, get_proxy_clip, get_proxy_clip_path, get_preview_shape, load_aris_preview, make_aris_preview
+
+
+"""
+Creates small proxies for the interactive tools (prep_4_aris_find_offsets.py and
+prep_x_match_recordings.py), which use them automatically whenever they exist:
+ - GoPro: low resolution clips in which every frame is a keyframe (motion JPEG), so that seeking
+   never has to decode any other frames. They are placed in clips_proxy next to the other clips.
+ - ARIS: all frames of a recording in a single .npy stack that can be memory-mapped, instead of
+   one image file per frame. The raw frames keep their resolution, the polar frames are scaled
+   down to proxy_aris_max_size.
+
+Proxies are only used for display. The export always reads the full resolution data.
+"""
+
+
+def find_source_clips_dir(gopro_base_path, resolutions):
+    # The smallest clips are the cheapest to decode
+    for res in ["sd"] + resolutions.split("+") + ["fhd", "uhd"]:
+        clips_dir = os.path.join(gopro_base_path, "clips_" + res)
+        if os.path.isdir(clips_dir):
+            return clips_dir
+    raise Exception("Could not find gopro clips directory for any supported resolution")
+
+
+def make_proxy_clip(src_file, dst_file, height, quality):
+    clip = cv2.VideoCapture(src_file)
+    fps = clip.get(cv2.CAP_PROP_FPS)
+    src_w = int(clip.get(cv2.CAP_PROP_FRAME_WIDTH))
+    src_h = int(clip.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    src_frames = int(clip.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    height = min(height, src_h)
+    size = (round(src_w * height / src_h / 2) * 2, height)
+
+    # The mp4 container has no tag for motion JPEG, OpenCV will warn about this and use a generic
+    # one instead (which decodes just fine)
+    tmp_file = os.path.splitext(dst_file)[0] + '.part.mp4'
+    writer = cv2.VideoWriter(tmp_file, cv2.VideoWriter_fourcc(*'MJPG'), fps, size)
+    writer.set(cv2.VIDEOWRITER_PROP_QUALITY, quality)
+
+    num_frames = 0
+    while True:
+        has_frame, frame = clip.read()
+        if not has_frame:
+            break
+        writer.write(cv2.resize(frame, size, interpolation=cv2.INTER_AREA))
+        num_frames += 1
+
+    writer.release()
+    clip.release()
+
+    # Offsets are matched in frames, so the proxy must not lose any
+    if num_frames != src_frames:
+        os.remove(tmp_file)
+        print(f'{os.path.basename(src_file)}: decoded {num_frames} of {src_frames} frames, no proxy created')
+        return False
+
+    os.replace(tmp_file, dst_file)
+    return True
+
+
+def make_aris_previews(aris_dir, polar_img_format, max_size, skip_existing=True):
+    # The raw stack is where prep_4 marks the onsets, so it keeps the full beam resolution. Only the
+    # polar stack for prep_x is scaled down.
+    frames_raw, frames_polar = get_aris_frame_lists(aris_dir, polar_img_format)
+    for kind, frame_files, size in (('raw', frames_raw, 0), ('polar', frames_polar, max_size)):
+        if not frame_files:
+            continue
+        if skip_existing and load_aris_preview(aris_dir, frame_files, kind, get_preview_shape(frame_files[0], size)) is not None:
+            continue
+        make_aris_preview(aris_dir, frame_files, kind, size)
+
+
+if __name__ == '__main__':
+    config = get_config()
+
+    skip_existing = config.get("proxy_skip_existing", True)
+
+    # GoPro proxy clips
+    gopro_base_path = config["gopro_extract"]
+    src_dir = find_source_clips_dir(gopro_base_path, config["gopro_clip_resolution"])
+    proxy_dir = os.path.join(gopro_base_path, PROXY_CLIPS_DIR)
+    os.makedirs(proxy_dir, exist_ok=True)
+
+    height = config.get("proxy_gopro_height", 270)
+    quality = config.get("proxy_gopro_quality", 75)
+    gopro_clips = sorted(f for f in os.listdir(src_dir) if f.lower().endswith('.mp4'))
+
+    for clip in tqdm(gopro_clips, desc='gopro'):
+        src_file = os.path.join(src_dir, clip)
+        if skip_existing and get_proxy_clip(src_file):
+            continue
+        make_proxy_clip(src_file, get_proxy_clip_path(src_file), height, quality)
+
+    # ARIS preview stacks
+    aris_base_path = config["aris_extract"]
+    polar_img_format = config["aris_to_polar_image_format"]
+    max_size = config.get("proxy_aris_max_size", 512)
+
+    for aris_name in tqdm(sorted(os.listdir(aris_base_path)), desc='aris'):
+        aris_dir = os.path.join(aris_base_path, aris_name)
+        if not os.path.isdir(aris_dir):
+            continue
+
+        make_aris_previews(aris_dir, polar_img_format, max_size, skip_existing)
@@ -1,5 +1,4 @@
 #!/usr/bin/env python
-import sys
 import os
 import cv2
 import pandas as pd
@@ -33,6 +32,45 @@ feature_params_lk = dict(
 )
 
 
+class GoproIterator:
+    def __init__(self, video) -> None:
+        self._clip = cv2.VideoCapture(video)
+        self._num_frames = int(self._clip.get(cv2.CAP_PROP_FRAME_COUNT))
+    
+    def __iter__(self):
+        for idx in trange(len(self)):
+            self._clip.set(cv2.CAP_PROP_POS_FRAMES, idx)
+            has_frame, frame = self._clip.read()
+            if not has_frame:
+                break
+            yield cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            
+    def __len__(self):
+        return self._num_frames
+
+
+def get_gopro_flow_path(clip_path):
+    return os.path.join(
+        os.path.dirname(clip_path), 
+        os.path.splitext(os.path.basename(clip_path))[0] + '_flow.csv'
+    )
+
+
+def calc_gopro_flow(clip_path, method='lk'):
+    iterator = GoproIterator(clip_path)
+    
+    if method == 'lk':
+        flow = calc_optical_flow_lk(iterator, flow_params_lk, feature_params_lk)
+    elif method == 'farnerback':
+        flow = calc_optical_flow_farnerback(iterator, flow_params_farneback)
+    else:
+        raise ValueError('Invalid method')
+
+    out_file = get_gopro_flow_path(clip_path)
+    pd.DataFrame(flow).to_csv(out_file, header=None, index=None)
+    return out_file
+
+
 if __name__ == '__main__':
     config = get_config()
 
@@ -49,37 +87,9 @@ if __name__ == '__main__':
             clip_path = os.path.join(all_clips_path, clip)
             print(clip_path)
 
-            out_file = os.path.join(
-                os.path.dirname(clip_path), 
-                os.path.splitext(os.path.basename(clip_path))[0] + '_flow.csv'
-            )
+            out_file = get_gopro_flow_path(clip_path)
             if not recalc and os.path.isfile(out_file):
                 print(f'{out_file} already exists, skipping')
-                sys.exit(0)
-            
-            class GoproIterator:
-                def __init__(self, video) -> None:
-                    self._clip = cv2.VideoCapture(video)
-                    self._num_frames = int(self._clip.get(cv2.CAP_PROP_FRAME_COUNT))
-                
-                def __iter__(self):
-                    for idx in trange(len(self)):
-                        self._clip.set(cv2.CAP_PROP_POS_FRAMES, idx)
-                        has_frame, frame = self._clip.read()
-                        if not has_frame:
-                            break
-                        yield cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                        
-                def __len__(self):
-                    return self._num_frames
-            
-            iterator = GoproIterator(clip_path)
+                continue
             
-            if method == 'lk':
-                flow = calc_optical_flow_lk(iterator, flow_params_lk, feature_params_lk)
-            elif method == 'farnerback':
-                flow = calc_optical_flow_farnerback(iterator, flow_params_farneback)
-            else:
-                raise ValueError('Invalid method')
-
-            pd.DataFrame(flow).to_csv(out_file, header=None, index=None)
+            calc_gopro_flow(clip_path, method)
@@ -2,6 +2,8 @@
 import sys
 import os
 import csv
+import time
+from collections import deque
 import numpy as np
 import pandas as pd
 import cv2
@@ -15,11 +17,15 @@ from PyQt5 import QtCore, QtGui, QtWidgets
 from common.config import get_config
 from common.qrangeslider import QRangeSlider
 from common.q_custom_widgets import MainWidget, MySlider
-from common.matching_context import MatchingContext, get_aris_metadata, get_gantry_metadata, folder_basename
+from common.matching_context import MatchingContext, get_aris_metadata, get_aris_marks, get_gantry_metadata, get_frame_index, folder_basename, video_capture_pool
+from common.proxies import get_proxy_clip, load_aris_preview
+from common.cache import LRUCache, print_cache_stats
+from common.q_frame_loader import FramePrefetcher, ring_indices
+from common.video_index import FrameSeeker
 
 
 class QtMatchingContext(MatchingContext):
-    def __init__(self, aris_dir, gantry_file, gopro_file, polar_img_format='png'):
+    def __init__(self, aris_dir, gantry_file, gopro_file, polar_img_format='png', prefetch_ticks=8):
         super().__init__(aris_dir, 
                          gantry_file, 
                          gopro_file, 
@@ -30,10 +36,40 @@ class QtMatchingContext(MatchingContext):
         #self.gopro_original_creation_time = parse_gopro_datetime(self.gopro_meta['creation_time'])
         #self.gopro_original_creation_time_simple = self.gopro_original_creation_time.strftime('%Y-%m-%d_%H%M%S')
         
-        self.aris_img = None
-        self.gopro_img = None
+        self.colorize = True
         self.reload = True
         
+        # Display the proxies from prep_8b if they exist, they are much faster to load
+        self.aris_preview = load_aris_preview(aris_dir, self.aris_frames_polar, 'polar') if self.aris_frames_polar else None
+        proxy_file = get_proxy_clip(gopro_file) if gopro_file else None
+        proxy_index = get_frame_index(proxy_file) if proxy_file else None
+        
+        # Frames are loaded and decoded in the background, the UI only picks up what is ready
+        self.aris_loader = FramePrefetcher('aris_frames', self._load_aris_frame, prefetch_ticks)
+        self._gopro_file = gopro_file
+        self._gopro_reader_index = self.gopro_index if gopro_file else None
+        self._gopro_reader = None
+        self._gopro_reader_idx = -1
+        self._gopro_reader_seeker = None
+        if proxy_index is not None and len(proxy_index) == self.gopro_frames_total:
+            self._gopro_file = proxy_file
+            self._gopro_reader_index = proxy_index
+        self.gopro_loader = FramePrefetcher('gopro_frames', self._load_gopro_frame, prefetch_ticks)
+    
+    def close(self):
+        self.aris_loader.stop()
+        self.gopro_loader.stop()
+        # Frames of this recording must not show up in the next one
+        for loader in (self.aris_loader, self.gopro_loader):
+            try:
+                loader.frameReady.disconnect()
+            except TypeError:
+                pass
+        if self._gopro_reader is not None:
+            video_capture_pool.release(self._gopro_file, self._gopro_reader)
+            self._gopro_reader = None
+            self._gopro_reader_seeker = None
+        super().close()
         
     @property
     def aris_frame_idx(self):
@@ -45,7 +81,6 @@ class QtMatchingContext(MatchingContext):
             self._aris_frame_idx = new_val
         else:
             self._aris_frame_idx = self.aris_start_frame
-        self.aris_img = None
     
     @property
     def aris_start_frame(self):
@@ -66,31 +101,79 @@ class QtMatchingContext(MatchingContext):
         self.aris_frame_idx = min(self.aris_frame_idx, self.aris_end_frame)
     
     def tick(self):
-        self.aris_img = None
         self.aris_frame_idx += self.aris_tick_step
-        
     
-    def get_aris_frame(self, colorize=True):
+    def _load_aris_frame(self, frame_idx):
+        # Runs on the loader thread
+        if self.aris_preview is not None:
+            frame = np.ascontiguousarray(self.aris_preview[frame_idx])
+            if not self.colorize:
+                h, w = frame.shape
+                return QtGui.QImage(frame.data, w, h, w, QtGui.QImage.Format_Grayscale8).copy()
+        elif self.colorize:
+            frame = cv2.imread(self.aris_frames_polar[frame_idx])
+        
+        if self.colorize:
+            frame_colorized = cv2.applyColorMap(frame, cv2.COLORMAP_TWILIGHT_SHIFTED)  # MAGMA, DEEPGREEN, OCEAN
+            h, w, channels = frame_colorized.shape
+            bytes_per_line = 3 * w
+            # rgbSwapped creates a copy, so the image doesn't reference the numpy buffer anymore
+            return QtGui.QImage(frame_colorized.data, w, h, bytes_per_line, QtGui.QImage.Format_RGB888).rgbSwapped()
+        
+        return QtGui.QImage(self.aris_frames_polar[frame_idx])
+    
+    def _load_gopro_frame(self, gopro_frame_idx):
+        # Runs on the loader thread, so it needs its own video handle
+        if self._gopro_reader is None:
+            self._gopro_reader = video_capture_pool.acquire(self._gopro_file)
+            self._gopro_reader_idx = -1
+            if self._gopro_reader_index is not None:
+                self._gopro_reader_seeker = FrameSeeker(self._gopro_reader, self._gopro_reader_index)
+        
+        if self._gopro_reader_seeker is not None:
+            frame = self._gopro_reader_seeker.read(gopro_frame_idx)
+            if frame is None:
+                return None
+        else:
+            # Avoid seeking when playing forward
+            if gopro_frame_idx != self._gopro_reader_idx + 1:
+                self._gopro_reader.set(cv2.CAP_PROP_POS_FRAMES, gopro_frame_idx)
+            has_frame, frame = self._gopro_reader.read()
+            if not has_frame:
+                self._gopro_reader_idx = -1
+                return None
+            self._gopro_reader_idx = gopro_frame_idx
+        
+        img = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        h, w, _ = img.shape
+        return QtGui.QImage(img.data, w, h, 3 * w, QtGui.QImage.Format_RGB888).copy()
+    
+    def aris_idx_to_gopro_idx(self, aris_frame_idx):
+        return self.aristime_to_gopro_idx(self.get_aris_frametime_ext(aris_frame_idx))
+    
+    def prefetch(self):
+        # Keep the frames around the playback cursor ready, both directions
+        lo, hi = self.aris_start_frame, self.aris_end_frame
+        aris_keys = ring_indices(self.aris_frame_idx, self.aris_tick_step, self.aris_loader.ring_size, lo, hi)
+        self.aris_loader.request(aris_keys)
+        
+        if self.has_gopro:
+            gopro_keys = []
+            for aris_idx in aris_keys:
+                gopro_idx = self.aris_idx_to_gopro_idx(aris_idx)
+                if 0 <= gopro_idx < self.gopro_frames_total and gopro_idx not in gopro_keys:
+                    gopro_keys.append(gopro_idx)
+            self.gopro_loader.request(gopro_keys)
+    
+    def get_aris_frame(self):
+        # Returns None for the image if it has not been loaded yet
         frametime = self.get_aris_frametime(self.aris_frame_idx)
-        if self.aris_img is None:
-            if colorize:
-                frame = cv2.imread(self.aris_frames_polar[self.aris_frame_idx])
-                frame_colorized = cv2.applyColorMap(frame, cv2.COLORMAP_TWILIGHT_SHIFTED)  # MAGMA, DEEPGREEN, OCEAN
-                h, w, channels = frame_colorized.shape
-                bytes_per_line = 3 * w
-                self.aris_img = QtGui.QImage(frame_colorized.data, w, h, bytes_per_line, QtGui.QImage.Format_RGB888).rgbSwapped()
-            else:
-                self.aris_img = QtGui.QImage(self.aris_frames_polar[self.aris_frame_idx])
-        return self.aris_img, frametime
+        return self.aris_loader.get(self.aris_frame_idx), frametime
     
-
     def get_gopro_frame(self, aris_frametime, exact: bool = True):
-        frame, idx = super().get_gopro_frame(aris_frametime, exact)
-        if frame is not None:
-            img = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            self.gopro_img = QtGui.QImage(img, img.shape[1], img.shape[0], QtGui.QImage.Format_RGB888)
-        
-        return self.gopro_img, self.gopro_frame_idx
+        # Returns None for the image if it has not been loaded yet
+        self.gopro_frame_idx = self.aristime_to_gopro_idx(aris_frametime)
+        return self.gopro_loader.get(self.gopro_frame_idx), self.gopro_frame_idx
     
         
 
@@ -121,11 +204,8 @@ def parse_gopro_timestamp(t_string):
     return int(m) * 60 + int(s) + float(ms) / 1000
 
 
-_optical_flow_cache = {}
+_optical_flow_cache = LRUCache('optical_flow', max_items=64, max_bytes=64 * 2**20)
 def get_optical_flow(dataset_path):
-    if dataset_path in _optical_flow_cache:
-        return _optical_flow_cache[dataset_path]
-    
     if os.path.isdir(dataset_path):
         data_folder = dataset_path
     else:
@@ -133,14 +213,15 @@ def get_optical_flow(dataset_path):
     data_id = os.path.splitext(folder_basename(dataset_path))[0]
     cache_file = os.path.join(data_folder, data_id + '_flow.csv')
     
-    flow = np.squeeze(pd.read_csv(cache_file, header=None).to_numpy())
-    norm_f = np.quantile(flow, 0.95) - np.min(flow)
-    #norm_f = np.max(flow) - np.min(flow)
-    if not np.isclose(norm_f, 0.):
-        flow = (flow - np.min(flow)) / norm_f
+    def load():
+        flow = np.squeeze(pd.read_csv(cache_file, header=None).to_numpy())
+        norm_f = np.quantile(flow, 0.95) - np.min(flow)
+        #norm_f = np.max(flow) - np.min(flow)
+        if not np.isclose(norm_f, 0.):
+            flow = (flow - np.min(flow)) / norm_f
+        return flow
     
-    _optical_flow_cache[dataset_path] = flow
-    return flow
+    return _optical_flow_cache.get(dataset_path, load, depends_on=[cache_file])
 
 
 def smooth_data(data, window_length):
@@ -148,6 +229,43 @@ def smooth_data(data, window_length):
     return (cumsum_vec[window_length:] - cumsum_vec[:-window_length]) / window_length
 
 
+class PlotBlitter:
+    # Redraws only the moving marker lines on top of a cached background instead of rendering the 
+    # entire figure. Call redraw() whenever anything else in the figure changed.
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self._background = None
+        self._artists = []
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+    
+    def set_artists(self, artists):
+        self._artists = list(artists)
+        for a in self._artists:
+            a.set_animated(True)
+        self.redraw()
+    
+    def _on_draw(self, event):
+        # Called after every full render, including resizes
+        self._background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        self._draw_artists()
+    
+    def _draw_artists(self):
+        for a in self._artists:
+            self.canvas.figure.draw_artist(a)
+    
+    def redraw(self):
+        self._background = None
+        self.canvas.draw_idle()
+    
+    def update(self):
+        if self._background is None:
+            # A full render is pending anyway
+            return
+        self.canvas.restore_region(self._background)
+        self._draw_artists()
+        self.canvas.blit(self.canvas.figure.bbox)
+
+
 @dataclass
 class Association:
     aris_idx: int
@@ -189,6 +307,7 @@ class MainWindow(QtWidgets.QMainWindow):
         
         # Everything else will be stored inside the context
         self.context = None
+        self.plot_lines = None
         self.dirty = False
         self.playing = autoplay
 
@@ -227,6 +346,12 @@ class MainWindow(QtWidgets.QMainWindow):
         self.canvas_flow_plot.setSizePolicy(QtWidgets.QSizePolicy.Minimum, QtWidgets.QSizePolicy.Minimum)
         self.canvas_flow_plot.updateGeometry()
         
+        # Only the markers move during playback, everything else is drawn from a cached background
+        self.flow_blitter = PlotBlitter(self.canvas_flow_plot)
+        self.gantry_blitter = PlotBlitter(self.canvas_gantry_plot)
+        self.flow_view = None
+        self.flow_window = None
+        
         # UI controls
         mono_font = QtGui.QFont('Monospace')
         mono_font.setStyleHint(QtGui.QFont.TypeWriter)
@@ -330,6 +455,11 @@ class MainWindow(QtWidgets.QMainWindow):
         self.spinner_playback_ups.valueChanged[int].connect(self._on_playback_ups_changed)
         
         self.button_play_pause = QtWidgets.QPushButton('&Play / Pause')
+        
+        # Profiling of the update loop
+        self.frame_times = deque(maxlen=100)
+        self.frames_over_budget = 0
+        self.label_frame_time = QtWidgets.QLabel()
         self.button_play_pause.clicked.connect(self._handle_play_pause_button)
         
         # Export
@@ -407,6 +537,7 @@ class MainWindow(QtWidgets.QMainWindow):
         
         ui_layout.addWidget(QtWidgets.QLabel(""))
         ui_layout.addLayout(fps_layout)
+        ui_layout.addWidget(self.label_frame_time)
         ui_layout.addWidget(self.button_play_pause)
         
         ui_layout.addWidget(QtWidgets.QLabel(""))
@@ -597,14 +728,14 @@ class MainWindow(QtWidgets.QMainWindow):
         aris_items = []
         aris_frames_meta = None
         for idx,item in enumerate(self.aris_data_dirs):
-            aris_metadata = get_aris_metadata(item)
-            marks = aris_metadata[2]
+            # Only the (small) marks are needed for all recordings
+            marks = get_aris_marks(item)
             
             if idx == max(0, self.dropdown_select_aris.currentIndex()):
-                aris_frames_meta = aris_metadata[1]
+                aris_frames_meta = get_aris_metadata(item)[1]
             
             associated = '*' if idx in self.aris_associated else ' '
-            motion_onset = 'm' if 'onset' in marks else ' '
+            motion_onset = 'm' if marks and 'onset' in marks else ' '
             aris_items.append(f'({associated}) ({motion_onset})  {idx:02}: {folder_basename(item)}')
         
         # Context may not be initialized yet, so don't use context.get_aris_frametime()
@@ -709,39 +840,70 @@ class MainWindow(QtWidgets.QMainWindow):
         if not self.needs_update():
             return
         
+        t_start = time.perf_counter()
+        self._do_update()
+        self._profile_update(time.perf_counter() - t_start)
+    
+    def _profile_update(self, frame_time):
+        # Playback should fit into the timer interval, otherwise it will not reach the target rate
+        budget = self.update_timer.interval() / 1000
+        self.frame_times.append(frame_time)
+        if self.playing and frame_time > budget:
+            self.frames_over_budget += 1
+        
+        mean_ms = np.mean(self.frame_times) * 1000
+        max_ms = np.max(self.frame_times) * 1000
+        self.label_frame_time.setText(f'Update time: {mean_ms:.1f}ms avg, {max_ms:.1f}ms max '
+                                      f'(budget {budget * 1000:.0f}ms, {self.frames_over_budget} over)')
+    
+    def _do_update(self):
         if not self.context or self.context.reload:
             self.reset_context()
         
         if self.playing:
             self.context.tick()
         
+        # Frames that are not ready yet are dropped; they will be shown once they arrive (see 
+        # _on_aris_frame_ready) unless playback moved on already
+        self.context.prefetch()
+        
         # ARIS
         aris_frame, aris_frametime = self.context.get_aris_frame()
         self.slider_aris_pos.setValue(self.context.aris_frame_idx)
-        self.set_image_scaled(aris_frame, self.canvas_aris)
+        if aris_frame is not None:
+            self.set_image_scaled(aris_frame, self.canvas_aris)
         
         # GoPro
         gopro_frame, gopro_frame_idx = self.context.get_gopro_frame(aris_frametime, False)
-        if gopro_frame:
+        if gopro_frame is not None:
             self.canvas_gopro.setPixmap(QtGui.QPixmap(gopro_frame))
-            self.slider_gopro_pos.setValue(gopro_frame_idx)
-            self.spinner_gopro_pos.setValue(gopro_frame_idx)
-        else:
-            print(f'no gopro frame for {aris_frametime - self.context.aris_t0}, this may be a bug')
+        self.slider_gopro_pos.setValue(gopro_frame_idx)
+        self.spinner_gopro_pos.setValue(gopro_frame_idx)
 
-        # Flow plot
+        # Flow plot. The visible window only moves once the marker gets close to its edges, 
+        # otherwise only the marker is redrawn.
+        aris_frame_idx = self.context.aris_frame_idx
         idx_half_range = 75 * self.spinner_playback_fpu.value()
-        aris_start_idx = self.context.aris_frame_idx - idx_half_range
-        aris_end_idx = self.context.aris_frame_idx + idx_half_range
-        self.flow_plot.set_xticks(np.arange(aris_start_idx, aris_end_idx, (aris_end_idx - aris_start_idx) / 20))
-        self.flow_plot.set_xlim([aris_start_idx, aris_end_idx])
+        idx_margin = idx_half_range // 5
+        if self.flow_window is None \
+                or self.flow_window[1] - self.flow_window[0] != 2 * idx_half_range \
+                or not self.flow_window[0] + idx_margin <= aris_frame_idx <= self.flow_window[1] - idx_margin:
+            self.flow_window = (aris_frame_idx - idx_half_range, aris_frame_idx + idx_half_range)
+        aris_start_idx, aris_end_idx = self.flow_window
         
         gopro_start_idx = self.context.aristime_to_gopro_idx(self.context.get_aris_frametime_ext(aris_start_idx))
         gopro_end_idx = self.context.aristime_to_gopro_idx(self.context.get_aris_frametime_ext(aris_end_idx))
-        self.flow_plot2.set_xlim([gopro_start_idx, gopro_end_idx])
         
-        self.flow_playback_marker.set_xdata([self.context.aris_frame_idx, self.context.aris_frame_idx])
-        self.flow_fig.canvas.draw_idle()
+        self.flow_playback_marker.set_xdata([aris_frame_idx, aris_frame_idx])
+        flow_view = (aris_start_idx, aris_end_idx, gopro_start_idx, gopro_end_idx)
+        if flow_view != self.flow_view:
+            self.flow_plot.set_xticks(np.arange(aris_start_idx, aris_end_idx, (aris_end_idx - aris_start_idx) / 20))
+            self.flow_plot.set_xlim([aris_start_idx, aris_end_idx])
+            self.flow_plot2.set_xlim([gopro_start_idx, gopro_end_idx])
+            self.flow_view = flow_view
+            self.flow_blitter.redraw()
+        else:
+            self.flow_blitter.update()
 
         # Gantry
         gantry_odom, gantry_time = self.context.get_gantry_odom(aris_frametime)
@@ -749,10 +911,21 @@ class MainWindow(QtWidgets.QMainWindow):
         self.gantry_offset_marker.set_xdata([gantry_time - self.context.gantry_t0, gantry_time - self.context.gantry_t0])
         self.slider_gantry_pos.setValue(gantry_progress)
         self.spinner_gantry_pos.setValue(gantry_progress)
-        self.gantry_fig.canvas.draw_idle()
+        self.gantry_blitter.update()
         
         self.dirty = False
     
+    @QtCore.pyqtSlot(object, object)
+    def _on_aris_frame_ready(self, frame_idx, img):
+        # Signals queued before the previous context was closed may still arrive
+        if self.context and self.sender() is self.context.aris_loader and frame_idx == self.context.aris_frame_idx:
+            self.set_image_scaled(img, self.canvas_aris)
+    
+    @QtCore.pyqtSlot(object, object)
+    def _on_gopro_frame_ready(self, gopro_frame_idx, img):
+        if self.context and self.sender() is self.context.gopro_loader and gopro_frame_idx == self.context.gopro_frame_idx:
+            self.canvas_gopro.setPixmap(QtGui.QPixmap(img))
+    
     def reset_context(self):
         self.refresh_dropdowns()
         
@@ -766,7 +939,11 @@ class MainWindow(QtWidgets.QMainWindow):
 
         print(aris_file, gopro_file, gantry_file)
         
+        if self.context:
+            self.context.close()
         self.context = QtMatchingContext(aris_file, gantry_file, gopro_file, self.polar_img_format)
+        self.context.aris_loader.frameReady.connect(self._on_aris_frame_ready)
+        self.context.gopro_loader.frameReady.connect(self._on_gopro_frame_ready)
         
         self.context.aris_tick_step = self.spinner_playback_fpu.value()
         
@@ -792,32 +969,55 @@ class MainWindow(QtWidgets.QMainWindow):
         self.slider_gantry_offset_us.setValue(gantry_offset_us)
         
         # Prepare the optical flow plot. Only the gopro's flow plot will change as the offset is updated.
-        self.flow_plot.cla()
-        self.flow_plot.set_xticks(np.arange(0, self.context.aris_frames_total, self.context.aris_frames_total // 20))
-        self.flow_plot.set_xticklabels([])
-        self.flow_plot.get_xaxis().grid(which='both')
+        # The lines are created once and only receive new data when switching recordings, which is
+        # a lot cheaper than clearing and rebuilding the axes.
         aris_flow_x = np.arange(self.context.aris_frames_total - 2)
         aris_flow_y = smooth_data(self.context.aris_optical_flow, 3)
-        self.flow_plot.plot(aris_flow_x, aris_flow_y, 'blue', label='aris')
-        self.flow_playback_marker = self.flow_plot.axvline(0, color='orange')
-        
-        self.flow_plot2.cla()
-        self.flow_plot2.set_ylim([0, 1])
         gopro_flow_x = np.arange(self.context.gopro_frames_total - 2)
         gopro_flow_y = smooth_data(self.context.gopro_optical_flow, 3)
-        self.flow_plot2.plot(gopro_flow_x, gopro_flow_y, 'grey', label='gopro')
+        gantry_data = self.context.gantry_data
+        gantry_t = gantry_data['timestamp_us'] - self.context.gantry_t0
+        
+        if self.plot_lines is None:
+            self.flow_plot.get_xaxis().grid(which='both')
+            self.flow_plot2.set_ylim([0, 1])
+            self.plot_lines = dict(
+                aris_flow=self.flow_plot.plot(aris_flow_x, aris_flow_y, 'blue', label='aris')[0],
+                gopro_flow=self.flow_plot2.plot(gopro_flow_x, gopro_flow_y, 'grey', label='gopro')[0],
+                x=self.gantry_plot.plot(gantry_t, gantry_data['x'], 'r', label='x')[0],
+                y=self.gantry_plot.plot(gantry_t, gantry_data['y'], 'g', label='y')[0],
+                z=self.gantry_plot.plot(gantry_t, gantry_data['z'], 'b', label='z')[0],
+            )
+            self.flow_playback_marker = self.flow_plot.axvline(0, color='orange')
+            self.gantry_offset_marker = self.gantry_plot.axvline(self.context.gantry_offset, color='orange')
+            self.flow_blitter.set_artists([self.flow_playback_marker])
+            self.gantry_blitter.set_artists([self.gantry_offset_marker])
+        else:
+            self.plot_lines['aris_flow'].set_data(aris_flow_x, aris_flow_y)
+            self.plot_lines['gopro_flow'].set_data(gopro_flow_x, gopro_flow_y)
+            for axis in 'xyz':
+                self.plot_lines[axis].set_data(gantry_t, gantry_data[axis])
+            self.flow_playback_marker.set_xdata([0, 0])
+            self.gantry_offset_marker.set_xdata([self.context.gantry_offset, self.context.gantry_offset])
+            for plot in (self.flow_plot, self.gantry_plot):
+                plot.relim(visible_only=True)
+                plot.autoscale_view()
+        
+        self.flow_plot.set_xticks(np.arange(0, self.context.aris_frames_total, max(1, self.context.aris_frames_total // 20)))
+        self.flow_plot.set_xticklabels([])
+        self.flow_plot.set_xlim([0, len(aris_flow_x)])
+        self.flow_plot2.set_xlim([0, len(gopro_flow_x)])
+        self.flow_view = None
+        self.flow_window = None
         
         # Prepare the gantry plot. As we update, we will only move the vertical line marker across.
-        self.gantry_plot.cla()
-        gantry_data = self.context.gantry_data
         self.gantry_plot.set_xlim([0, self.context.gantry_duration])
-        gantry_t = gantry_data['timestamp_us'] - self.context.gantry_t0
-        self.gantry_plot.plot(gantry_t, gantry_data['x'], 'r', label='x')
-        self.gantry_plot.plot(gantry_t, gantry_data['y'], 'g', label='y')
-        self.gantry_plot.plot(gantry_t, gantry_data['z'], 'b', label='z')
-        self.gantry_offset_marker = self.gantry_plot.axvline(self.context.gantry_offset, color='orange')
         self.canvas_gantry_plot.setStyleSheet('background-color:none;')  # TODO not working yet
-        
+
+        # The axes changed, so the backgrounds cached by the blitters are outdated
+        self.flow_blitter.redraw()
+        self.gantry_blitter.redraw()
+
         association: Association = self.association_details.get(aris_idx)
         if association and (not association.has_gopro() or association.gopro_idx == gopro_idx) and (not association.has_gantry() or association.gantry_idx == gantry_idx):
             self.notes_widget.setPlainText(association.notes)
@@ -854,4 +1054,7 @@ if __name__ == '__main__':
 
     app = QtWidgets.QApplication(sys.argv)
     main = MainWindow(aris_dir_path, gopro_dir_path, gantry_dir_path, match_file, polar_img_format)
-    sys.exit(app.exec_())
+    ret = app.exec_()
+    print_cache_stats()
+    print(video_capture_pool)
+    sys.exit(ret)
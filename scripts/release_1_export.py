@@ -1,35 +1,43 @@
 #!/usr/bin/env python3
 import os
 import re
+import json
 import shutil
+import hashlib
 import yaml
 import pandas as pd
-import numpy as np
-from scipy.spatial.transform import Rotation as R
-import cv2
 from tqdm import tqdm, trange
 
 from common.config import get_config
 from common.aris_definitions import FrameHeaderFields
-from common.matching_context import MatchingContext, folder_basename
-from dataset.calibration.tf_demo.transforms import get_tf_manager
+from common.checksums import (file_checksum, copy_with_checksum, write_with_checksum, write_checksum_file, stat_signature,
+                              copytree_with_checksums, write_release_manifest, CHECKSUM_FILE, RELEASE_MANIFEST)
+from common.matching_context import MatchingContext, folder_basename, get_aris_frame_lists
+from common.odometry import get_odometry_path
+from common.dataset_index import update_index, get_index_path
+from common.image_codecs import encode_image, read_sonar_image
+from common.gopro_export import GoProFrameWriter, StageTimer, extract_frames_ffmpeg, GOPRO_ENCODERS
+from common.poses import BatchPoseEngine
+from dataset.calibration.tf_demo.transforms import get_tf_registry
 
 
-def _create_ar3_df(df_aris_metadata, df_portal_crane):
-    tm = get_tf_manager()
+_ar3_pose_engine = None
+def _get_ar3_pose_engine():
+    # The static transforms never change during an export, so only resolve them once
+    global _ar3_pose_engine
+    if _ar3_pose_engine is None:
+        _ar3_pose_engine = BatchPoseEngine(get_tf_registry(), 'setup/ar3', 'setup/portal_crane')
+    return _ar3_pose_engine
+
 
-    poss = []
-    for index, row in df_portal_crane.iterrows():
-        A2B = np.eye(4) 
-        A2B[:3,3] = np.array(row[['x','y','z']])
-        tm.add_transform("setup/portal_crane", "world", A2B=A2B)
-        poss.append(tm.get_transform("setup/ar3", "world")[:3, 3])
+def _create_ar3_df(df_aris_metadata, df_portal_crane):
+    engine = _get_ar3_pose_engine()
 
-    rots = [(R.from_matrix(tm.get_transform("setup/ar3", "world")[:3,:3]) * 
-             R.from_euler('xyz', row[['SonarRoll', 'SonarTilt', 'SonarPan']], degrees=True)).as_quat() for index, row in df_aris_metadata.iterrows()]
+    poss = engine.positions(df_portal_crane[['x', 'y', 'z']].to_numpy())
+    rots = engine.orientations(df_aris_metadata[['SonarRoll', 'SonarTilt', 'SonarPan']].to_numpy()).as_quat()
 
     df_ar3 = pd.DataFrame()
-    df_ar3['aris_frame_idx'] = df_portal_crane['aris_frame_idx']
+    df_ar3['aris_frame_idx'] = df_portal_crane['aris_frame_idx'].to_numpy()
     df_ar3[['pos.x','pos.y', 'pos.z']] = poss.round(6)
     df_ar3[['rot.x','rot.y', 'rot.z', 'rot.w']] = rots.round(6)
 
@@ -43,14 +51,87 @@ def get_target_type(notes: str) -> str:
     return 'other'
 
 
+MANIFEST_FILE = 'manifest.yaml'
+
+# GoPro encoding options as they were before they became configurable
+GOPRO_ENCODING_DEFAULTS = {'gopro_encoder': 'opencv', 'gopro_quality': 95, 'gopro_subsampling': '420'}
+
+
+def get_match_hash(match: pd.Series, **export_options) -> str:
+    # Any change to the match row (e.g. an adjusted offset) or to the export options changes the hash
+    row = {k: str(v) for k,v in match.items()}
+    row.update({k: str(v) for k,v in export_options.items()})
+    return hashlib.sha256(json.dumps(row, sort_keys=True).encode()).hexdigest()
+
+
+def get_input_signature(data_root: str, aris_dir: str, gantry_file: str, gopro_file: str, polar_img_format: str = 'png') -> dict:
+    # Only the files the export reads, so previews or flow files written next to the frames don't
+    # make the recording stale. Frame lists are signed by their length and first and last frame,
+    # which is enough to notice a re-extraction while keeping the check O(1).
+    aris_basename = folder_basename(aris_dir)
+    frames_raw, frames_polar = get_aris_frame_lists(aris_dir, polar_img_format)
+    
+    def relpath(p):
+        return os.path.relpath(p, data_root).replace(os.sep, '/')
+    
+    signature = {}
+    for key, frames in (('aris_frames_raw', frames_raw), ('aris_frames_polar', frames_polar)):
+        frames = frames or []
+        signature[key] = [len(frames)] + [[relpath(f), stat_signature(f)] for f in ([frames[0], frames[-1]] if frames else [])]
+    
+    inputs = [
+        os.path.join(aris_dir, aris_basename + '_frames.csv'),
+        os.path.join(aris_dir, aris_basename + '_metadata.yaml'),
+        os.path.join(aris_dir, aris_basename + '_marks.yaml'),
+        gantry_file,
+        get_odometry_path(gantry_file),
+        os.path.join(os.path.dirname(gantry_file), 'gantry_metadata.csv'),
+    ]
+    if gopro_file:
+        inputs.append(gopro_file)
+
+    signature.update({relpath(p): stat_signature(p) for p in inputs})
+    return signature
+
+
+def is_up_to_date(rec_root: str, match_hash: str, inputs: dict) -> bool:
+    manifest_file = os.path.join(rec_root, MANIFEST_FILE)
+    if not os.path.isfile(manifest_file):
+        return False
+    
+    with open(manifest_file, 'r') as f:
+        manifest = yaml.safe_load(f)
+
+    return manifest.get('match_hash') == match_hash and manifest.get('inputs') == inputs
+
+
+def export_sonar_frame(src: str, dst: str, **imwrite_params) -> str:
+    # Frames already in the target format are copied as they are, others are re-encoded losslessly
+    fmt = os.path.splitext(dst)[1][1:].lower()
+    if os.path.splitext(src)[1][1:].lower() == fmt:
+        return copy_with_checksum(src, dst)
+    return write_with_checksum(dst, encode_image(read_sonar_image(src), fmt, **imwrite_params))
+
+
 def export_recording(match: pd.Series, 
                      data_root: str, 
                      out_dir_root: str, 
                      aris_polar_img_format: str = 'png',
+                     aris_raw_format: str = 'pgm',
+                     aris_polar_format: str = '',
+                     png_compression: int = 3,
+                     jxl_effort: int = 7,
                      gopro_resolution: str = 'fhd', 
                      gopro_format: str = 'jpg', 
-                     trim_from_gopro: bool = True
-) -> None:
+                     gopro_encoder: str = 'opencv',
+                     gopro_quality: int = 95,
+                     gopro_subsampling: str = '420',
+                     gopro_workers: int = 0,
+                     ffmpeg: str = 'ffmpeg',
+                     trim_from_gopro: bool = True,
+                     force: bool = False,
+                     timer: StageTimer = None,
+) -> bool:
     # Help to resolve the recording locations
     aris_dir = os.path.join(data_root, match['aris_file'])
     gantry_file = os.path.join(data_root, match['gantry_file'])
@@ -62,6 +143,42 @@ def export_recording(match: pd.Series,
         if gopro_file and not os.path.isfile(gopro_file):
             raise ValueError(f'{gopro_resolution}: missing GoPro file {gopro_file}')
     
+    # Sonar frames are only re-encoded if a different format was requested, so only then do the
+    # encoding options affect the export
+    aris_polar_format = aris_polar_format or aris_polar_img_format
+    sonar_options = {}
+    if aris_raw_format != 'pgm' or aris_polar_format != aris_polar_img_format:
+        sonar_options = dict(aris_raw_format=aris_raw_format,
+                             aris_polar_format=aris_polar_format,
+                             png_compression=png_compression,
+                             jxl_effort=jxl_effort)
+    imwrite_params = dict(png_compression=png_compression, jxl_effort=jxl_effort)
+    
+    # Same for the GoPro encoding options, so exports from before they existed stay valid
+    if gopro_encoder not in GOPRO_ENCODERS:
+        raise ValueError(f'Unknown GoPro encoder {gopro_encoder}, use one of {", ".join(GOPRO_ENCODERS)}')
+    gopro_options = {k: v for k,v in dict(gopro_encoder=gopro_encoder, 
+                                          gopro_quality=gopro_quality, 
+                                          gopro_subsampling=gopro_subsampling).items() 
+                     if v != GOPRO_ENCODING_DEFAULTS[k]}
+    timer = timer if timer is not None else StageTimer()
+    
+    # Skip recordings that have been exported before and neither their match nor their inputs changed
+    name = folder_basename(match['aris_file'])
+    rec_root = os.path.join(out_dir_root, get_target_type(match['notes']), name)
+    match_hash = get_match_hash(match, 
+                                aris_polar_img_format=aris_polar_img_format, 
+                                gopro_resolution=gopro_resolution, 
+                                gopro_format=gopro_format, 
+                                trim_from_gopro=trim_from_gopro,
+                                **sonar_options,
+                                **gopro_options)
+    inputs = get_input_signature(data_root, aris_dir, gantry_file, gopro_file, aris_polar_img_format)
+    
+    if not force and is_up_to_date(rec_root, match_hash, inputs):
+        print(f' -> {name} is up to date, skipping')
+        return False
+    
     # Context makes it much easier to retrieve individual data points from the processed recordings
     ctx = MatchingContext(aris_dir, 
                           gantry_file, 
@@ -71,52 +188,79 @@ def export_recording(match: pd.Series,
     ctx.gopro_offset = match['gopro_offset']
     ctx.gantry_offset = match['gantry_offset']
     
-    # Create export folders
-    rec_root = os.path.join(out_dir_root, get_target_type(match['notes']), ctx.recording_label)
-    os.makedirs(rec_root, exist_ok=False)
+    # Create export folders. Anything left over from a previous (possibly interrupted) export is 
+    # outdated, so start from scratch.
+    if os.path.isdir(rec_root):
+        print(f' -> {name} is outdated, re-exporting')
+        shutil.rmtree(rec_root)
+    os.makedirs(rec_root)
     
     rec_aris_raw = os.path.join(rec_root, 'aris_raw')
-    os.makedirs(rec_aris_raw, exist_ok=False)
+    os.makedirs(rec_aris_raw)
     
     rec_aris_polar = os.path.join(rec_root, 'aris_polar')
-    os.makedirs(rec_aris_polar, exist_ok=False)
+    os.makedirs(rec_aris_polar)
     
     if ctx.has_gopro:
         rec_gopro = os.path.join(rec_root, 'gopro')
-        os.makedirs(rec_gopro, exist_ok=False)
+        os.makedirs(rec_gopro)
     
     # Export data
     indices = []
     gantry_data = []
-    name = folder_basename(match['aris_file'])
-    for aris_frame_idx in trange(ctx.aris_start_frame, ctx.aris_end_frame + 1, desc=name):
-        frametime = ctx.get_aris_frametime(aris_frame_idx)
-        
-        # GoPro frames
-        if ctx.has_gopro:
-            gopro_file = os.path.join(rec_gopro, f'{aris_frame_idx:04}.{gopro_format}')
-
-            if os.path.isfile(gopro_file):
-                print(f' -> frame {aris_frame_idx} already exists in export, skipping rest of this recording')
-                break
-
-            gopro_frame, _ = ctx.get_gopro_frame(frametime)
-            if gopro_frame is not None:
-                cv2.imwrite(gopro_file, gopro_frame)
+    checksums = {}
+    gopro_frames = {}   # for ffmpeg: frame index in the clip -> export paths
+    with GoProFrameWriter(rec_root, gopro_format, gopro_quality, gopro_subsampling, gopro_workers, timer) as gopro_writer:
+        for aris_frame_idx in trange(ctx.aris_start_frame, ctx.aris_end_frame + 1, desc=name):
+            frametime = ctx.get_aris_frametime(aris_frame_idx)
             
-            # If gopro footage is available, only export data when a gopro frame is also available
-            if trim_from_gopro and gopro_frame is None:
-                continue
+            # GoPro frames
+            if ctx.has_gopro:
+                gopro_relpath = f'gopro/{aris_frame_idx:04}.{gopro_format}'
+                if gopro_encoder == 'ffmpeg':
+                    # Extracted after the loop, the clip's frame count tells if the frame exists
+                    gopro_frame_idx = ctx.aristime_to_gopro_idx(frametime)
+                    has_gopro_frame = 0 <= gopro_frame_idx < ctx.gopro_frames_total
+                    if has_gopro_frame:
+                        gopro_frames.setdefault(gopro_frame_idx, []).append(gopro_relpath)
+                else:
+                    with timer.measure('gopro decode'):
+                        gopro_frame, _ = ctx.get_gopro_frame(frametime)
+                    has_gopro_frame = gopro_frame is not None
+                    if has_gopro_frame:
+                        gopro_writer.submit(gopro_relpath, gopro_frame)
+                
+                # If gopro footage is available, only export data when a gopro frame is also available
+                if trim_from_gopro and not has_gopro_frame:
+                    continue
+                
+            # ARIS frames
+            with timer.measure('sonar frames', 2):
+                aris_raw_relpath = f'aris_raw/{aris_frame_idx:04}.{aris_raw_format}'
+                aris_polar_relpath = f'aris_polar/{aris_frame_idx:04}.{aris_polar_format}'
+                checksums[aris_raw_relpath] = export_sonar_frame(ctx.aris_frames_raw[aris_frame_idx], os.path.join(rec_root, aris_raw_relpath), **imwrite_params)
+                checksums[aris_polar_relpath] = export_sonar_frame(ctx.aris_frames_polar[aris_frame_idx], os.path.join(rec_root, aris_polar_relpath), **imwrite_params)
             
-        # ARIS frames
-        shutil.copy(ctx.aris_frames_raw[aris_frame_idx], os.path.join(rec_aris_raw, f'{aris_frame_idx:04}.pgm'))
-        shutil.copy(ctx.aris_frames_polar[aris_frame_idx], os.path.join(rec_aris_polar, f'{aris_frame_idx:04}.{aris_polar_img_format}'))
-        
-        # Collect gantry data (write later)
-        (x, y, z), _ = ctx.get_gantry_odom(frametime)
-        gantry_data.append((aris_frame_idx, x, y, z))
+            # Collect gantry data (write later)
+            with timer.measure('gantry'):
+                (x, y, z), _ = ctx.get_gantry_odom(frametime)
+                (vx, vy, vz), _ = ctx.get_gantry_velocity(frametime)
+                gantry_data.append((aris_frame_idx, x, y, z, vx, vy, vz))
+            
+            indices.append(aris_frame_idx)
         
-        indices.append(aris_frame_idx)
+        checksums.update(gopro_writer.finish())
+    
+    # Hand the video back to the pool of open captures
+    ctx.close()
+    
+    if gopro_frames:
+        gopro_checksums = extract_frames_ffmpeg(ctx.gopro_file, gopro_frames, rec_root, gopro_format, 
+                                                gopro_quality, gopro_subsampling, ffmpeg, timer)
+        missing = sum(len(relpaths) for relpaths in gopro_frames.values()) - len(gopro_checksums)
+        if missing:
+            raise RuntimeError(f'{name}: ffmpeg could not extract {missing} GoPro frames, use the opencv encoder instead')
+        checksums.update(gopro_checksums)
     
     if trim_from_gopro and len(indices) != ctx.aris_active_frames:
         print(f' -> recording was trimmed to frames {indices[0]} to {indices[-1]}')
@@ -128,72 +272,96 @@ def export_recording(match: pd.Series,
         yaml.safe_dump(ctx.aris_file_meta, f)
     
     # Write gantry data
-    pd.DataFrame(gantry_data, columns=['aris_frame_idx', 'x', 'y', 'z']).to_csv(os.path.join(rec_root, 'gantry.csv'), header=True, index=False)
+    df_gantry = pd.DataFrame(gantry_data, columns=['aris_frame_idx', 'x', 'y', 'z', 'vx', 'vy', 'vz'])
+    df_gantry.to_csv(os.path.join(rec_root, 'gantry.csv'), header=True, index=False)
     
     # Write ar3 data
-    _create_ar3_df(frame_meta_sel, gantry_data).to_csv(os.path.join(rec_root, 'ar3.csv'), header=True, index=False)
+    _create_ar3_df(frame_meta_sel, df_gantry).to_csv(os.path.join(rec_root, 'ar3.csv'), header=True, index=False)
 
     # Additional notes
     with open(os.path.join(rec_root, 'notes.txt'), 'w') as f:
         f.write(match['notes'])
+    
+    # The small tables are written by pandas & co, so we hash them afterwards
+    for relpath in ['aris_frame_meta.csv', 'aris_file_meta.yaml', 'gantry.csv', 'ar3.csv', 'notes.txt']:
+        checksums[relpath] = file_checksum(os.path.join(rec_root, relpath))
+    write_checksum_file(os.path.join(rec_root, CHECKSUM_FILE), checksums)
+    
+    # The manifest is written last so that an interrupted export will be redone on the next run
+    manifest = {
+        'match_hash': match_hash,
+        'offsets': {
+            'aris_onset': int(match['aris_onset']),
+            'gopro_offset': int(match['gopro_offset']) if ctx.has_gopro else None,
+            'gantry_offset': float(match['gantry_offset']),
+        },
+        'frames': [int(indices[0]), int(indices[-1])] if indices else [],
+        'inputs': inputs,
+        'checksums': CHECKSUM_FILE,
+    }
+    with open(os.path.join(rec_root, MANIFEST_FILE), 'w') as f:
+        yaml.safe_dump(manifest, f)
+    
+    return True
         
 
-if __name__ == '__main__':
-    config = get_config()
+def get_export_options(config) -> dict:
+    # Keyword arguments for export_recording from the config
+    return dict(
+        aris_polar_img_format=config["aris_to_polar_image_format"],
+        aris_raw_format=config.get("export_aris_raw_format", "pgm"),
+        aris_polar_format=config.get("export_aris_polar_format", ""),
+        png_compression=config.get("export_png_compression", 3),
+        jxl_effort=config.get("export_jxl_effort", 7),
+        gopro_resolution=config.get("export_gopro_resolution", "fhd"),
+        gopro_format=config.get("export_gopro_format", "jpg"),
+        gopro_encoder=config.get("export_gopro_encoder", "opencv"),
+        gopro_quality=config.get("export_gopro_quality", 95),
+        gopro_subsampling=str(config.get("export_gopro_subsampling", "420")),
+        gopro_workers=config.get("export_gopro_workers", 0),
+        ffmpeg=config.get("export_ffmpeg", "ffmpeg"),
+        trim_from_gopro=config.get("export_only_with_gopro", True),
+    )
 
-    match_file = config["match_file"]
-    export_dir = config["export_dir"]
-    polar_img_format = config["aris_to_polar_image_format"]
-    gopro_resolution = config.get("export_gopro_resolution", "fhd")
-    gopro_format = config.get("export_gopro_format", "jpg")
-    trim_from_gopro = config.get("export_only_with_gopro", True)
 
-    data_root = os.path.dirname(match_file)
-    
-    # Copy recording data
-    print(f'Exporting recordings to {export_dir}')
-    os.makedirs(export_dir, exist_ok=True)
-    matches = pd.read_csv(match_file, converters={
+def read_matches(match_file: str) -> pd.DataFrame:
+    return pd.read_csv(match_file, converters={
         'aris_file': str,
         'gantry_file': str,
         'gopro_file': str,
         'notes': str,
     })
-    
-    recordings_dir = os.path.join(export_dir, 'recordings')
-    for _,match in tqdm(matches.itertuples(), total=len(matches), desc='overall'):
-        export_recording(match, 
-                         data_root, 
-                         recordings_dir, 
-                         aris_polar_img_format=polar_img_format,
-                         gopro_resolution=gopro_resolution, 
-                         gopro_format=gopro_format, 
-                         trim_from_gopro=trim_from_gopro)
+
+
+def finalize_export(export_dir: str, data_root: str) -> None:
+    # Viewers and loaders read the file lists from the index instead of walking the tree
+    num_indexed = update_index(export_dir)
+    print(f'Updated {num_indexed} recordings in {get_index_path(export_dir)}')
     
     # NOTE labels have been generated after export, so this script can't know about them
 
+    # Everything else is hashed while copying, too
+    checksums = {}
+
     # Copy 3d models
     print('Copying 3d models...')
-    model_dir = os.path.join(export_dir, '3d_models/')
-    shutil.copytree(os.path.join(data_root, '../3d_models'), 
-                    model_dir, 
-                    dirs_exist_ok=True, 
-                    ignore=lambda src, names: [x for x in names if 'metashape' in x])
+    checksums.update({'3d_models/' + k: v for k,v in copytree_with_checksums(
+                      os.path.join(data_root, '../3d_models'), 
+                      os.path.join(export_dir, '3d_models'), 
+                      ignore=lambda src, names: [x for x in names if 'metashape' in x]).items()})
 
     # Copy scripts
     print('Copying scripts...')
-    scripts_dir = os.path.join(export_dir, 'scripts/')
-    shutil.copytree(os.path.dirname(__file__), 
-                    scripts_dir, 
-                    dirs_exist_ok=True, 
-                    ignore=lambda src, names: [x for x in names if '__pycache__' in x])
+    checksums.update({'scripts/' + k: v for k,v in copytree_with_checksums(
+                      os.path.dirname(os.path.abspath(__file__)), 
+                      os.path.join(export_dir, 'scripts'), 
+                      ignore=lambda src, names: [x for x in names if '__pycache__' in x]).items()})
 
     # Copy calibration data
     print('Copying calibrations...')
-    calib_dir = os.path.join(export_dir, 'calibration')
-    shutil.copytree(os.path.join(data_root, '../calibration'),
-                    calib_dir,
-                    dirs_exist_ok=True)
+    checksums.update({'calibration/' + k: v for k,v in copytree_with_checksums(
+                      os.path.join(data_root, '../calibration'),
+                      os.path.join(export_dir, 'calibration')).items()})
 
     # Copy README and more
     print('Tidying up...')
@@ -202,6 +370,45 @@ if __name__ == '__main__':
         '../preview.jpg',
     ]
     for file in other_files:
-        shutil.copy(os.path.join(data_root, file), export_dir)
+        checksums[os.path.basename(file)] = copy_with_checksum(os.path.join(data_root, file), 
+                                                               os.path.join(export_dir, os.path.basename(file)))
+
+    # The recordings' checksums are taken from their checksum files, so hardly anything is read again
+    print('Writing release manifest...')
+    num_hashed = write_release_manifest(export_dir, checksums)
+    print(f'Wrote {RELEASE_MANIFEST} ({num_hashed} files had to be hashed)')
+
+
+if __name__ == '__main__':
+    config = get_config()
+
+    match_file = config["match_file"]
+    export_dir = config["export_dir"]
+    export_options = get_export_options(config)
+    force_export = config.get("export_force", False)
+
+    data_root = os.path.dirname(match_file)
+    
+    # Copy recording data
+    print(f'Exporting recordings to {export_dir}')
+    os.makedirs(export_dir, exist_ok=True)
+    matches = read_matches(match_file)
+    
+    recordings_dir = os.path.join(export_dir, 'recordings')
+    num_exported = 0
+    timer = StageTimer()
+    for _,match in tqdm(matches.iterrows(), total=len(matches), desc='overall'):
+        num_exported += export_recording(match, 
+                                         data_root, 
+                                         recordings_dir, 
+                                         **export_options,
+                                         force=force_export,
+                                         timer=timer)
+    print(f'Exported {num_exported} recordings, {len(matches) - num_exported} were up to date')
+    if timer.stages:
+        print('Time per export stage (summed over all threads):')
+        print(timer.summary())
+    
+    finalize_export(export_dir, data_root)
 
     print(f'Done! Find your dataset at: {export_dir}')
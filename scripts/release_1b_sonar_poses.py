@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Calculates the ground truth pose of the sonar relative to the target for every frame of an exported
+dataset, i.e. the transform from setup/sonar to target/<target_type>. This is the same as what the
+demo notebooks do interactively for single frames, but for all frames in vectorized batches.
+
+Each recording receives a single pose table (sonar_pose.csv or sonar_pose.npz) with one row per
+ARIS frame containing the sonar position and orientation (quaternion, scalar last) in the target frame.
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from common.aris_definitions import FrameHeaderFields
+from common.checksums import read_checksum_file, write_release_manifest, RELEASE_MANIFEST
+from common.dataset_index import update_index, get_index_path, INDEX_FILE
+from common.poses import BatchPoseEngine, invert_transforms, transforms_to_pq
+from dataset.calibration.tf_demo.transforms import get_tf_registry, get_tf_manager
+
+
+POSE_COLUMNS = ['pos.x', 'pos.y', 'pos.z', 'rot.x', 'rot.y', 'rot.z', 'rot.w']
+
+
+class SonarPoseCalculator:
+    def __init__(self, tf_registry, sonar_frame='setup/sonar'):
+        self.tf_registry = tf_registry
+        self.engine = BatchPoseEngine(tf_registry, 'setup/ar3', 'setup/portal_crane')
+        self.sonar2ar3 = tf_registry.get_transform(sonar_frame, 'setup/ar3')
+
+    def has_target(self, target_frame):
+        return self.tf_registry.has_transform(target_frame, 'world')
+
+    def calc_poses(self, target_frame, crane_positions, roll_tilt_pan, batch_size=10000):
+        world2target = invert_transforms(self.tf_registry.get_transform(target_frame, 'world'))
+
+        poses = np.empty((len(crane_positions), len(POSE_COLUMNS)))
+        for start in range(0, len(crane_positions), batch_size):
+            end = start + batch_size
+            sonar2world = self.engine.child_transforms(self.sonar2ar3, crane_positions[start:end], roll_tilt_pan[start:end])
+            pos, rot = transforms_to_pq(world2target @ sonar2world)
+            poses[start:end, :3] = pos
+            poses[start:end, 3:] = rot
+
+        return poses
+
+
+def iter_recordings(export_dir):
+    # Exported recordings are placed in recordings/<target_type>/<recording>
+    recordings_dir = os.path.join(export_dir, 'recordings')
+    for target_type in sorted(os.listdir(recordings_dir)):
+        target_dir = os.path.join(recordings_dir, target_type)
+        if not os.path.isdir(target_dir):
+            continue
+
+        for rec_name in sorted(os.listdir(target_dir)):
+            rec_dir = os.path.join(target_dir, rec_name)
+            if os.path.isdir(rec_dir):
+                yield target_type, rec_dir
+
+
+def load_recording_inputs(rec_dir):
+    gantry = pd.read_csv(os.path.join(rec_dir, 'gantry.csv'), usecols=['aris_frame_idx', 'x', 'y', 'z'])
+    frame_meta = pd.read_csv(os.path.join(rec_dir, 'aris_frame_meta.csv'),
+                             usecols=[FrameHeaderFields.frame_index, 'SonarRoll', 'SonarTilt', 'SonarPan'])
+
+    # Only frames that have both gantry data and metadata
+    data = gantry.merge(frame_meta, left_on='aris_frame_idx', right_on=FrameHeaderFields.frame_index.value)
+    return (data['aris_frame_idx'].to_numpy(),
+            data[['x', 'y', 'z']].to_numpy(dtype=float),
+            data[['SonarRoll', 'SonarTilt', 'SonarPan']].to_numpy(dtype=float))
+
+
+def write_pose_table(out_file, frame_indices, poses, target_frame):
+    if out_file.endswith('.npz'):
+        np.savez_compressed(out_file,
+                            aris_frame_idx=frame_indices.astype(np.int32),
+                            pose=poses.astype(np.float32),
+                            columns=np.array(POSE_COLUMNS),
+                            target_frame=np.array(target_frame))
+    else:
+        df = pd.DataFrame(poses.round(6), columns=POSE_COLUMNS)
+        df.insert(0, 'aris_frame_idx', frame_indices)
+        df.to_csv(out_file, header=True, index=False)
+
+
+def export_poses(export_dir, out_format='csv', target_override=None, batch_size=10000):
+    calculator = SonarPoseCalculator(get_tf_registry())
+    num_frames = 0
+    t_start = time.perf_counter()
+
+    for target_type, rec_dir in tqdm(list(iter_recordings(export_dir))):
+        target_frame = target_override or f'target/{target_type}'
+        if not calculator.has_target(target_frame):
+            print(f' -> {os.path.basename(rec_dir)}: unknown target frame {target_frame}, skipping')
+            continue
+
+        frame_indices, crane_positions, roll_tilt_pan = load_recording_inputs(rec_dir)
+        poses = calculator.calc_poses(target_frame, crane_positions, roll_tilt_pan, batch_size)
+        write_pose_table(os.path.join(rec_dir, 'sonar_pose.' + out_format), frame_indices, poses, target_frame)
+        num_frames += len(frame_indices)
+
+    duration = time.perf_counter() - t_start
+    print(f'Calculated {num_frames} poses in {duration:.2f}s ({num_frames / max(duration, 1e-9):.0f} frames/s)')
+
+    # The pose tables are a new modality for the dataset index
+    if os.path.isfile(get_index_path(export_dir)):
+        update_index(export_dir)
+
+    # Files of the recordings are covered by their checksum files and everything outside of them except
+    # the index is unchanged since the manifest was written. Only the pose tables, the index and the
+    # small bookkeeping files of the recordings have to be hashed.
+    manifest_file = os.path.join(export_dir, RELEASE_MANIFEST)
+    if os.path.isfile(manifest_file):
+        known = {relpath: checksum for relpath, checksum in read_checksum_file(manifest_file).items()
+                 if not relpath.startswith('recordings/') and relpath != INDEX_FILE}
+        num_hashed = write_release_manifest(export_dir, known)
+        print(f'Updated {RELEASE_MANIFEST} ({num_hashed} files had to be hashed)')
+
+
+def benchmark(num_frames, batch_size=10000, num_reference=500):
+    # Compares the batched calculation against updating a TransformManager for every frame
+    rng = np.random.default_rng(0)
+    crane_positions = rng.uniform([0., 0., -1.], [3., 3., 0.], (num_frames, 3))
+    roll_tilt_pan = rng.uniform([-5., -45., -90.], [5., 0., 90.], (num_frames, 3))
+    target_frame = 'target/100lbs'
+
+    calculator = SonarPoseCalculator(get_tf_registry())
+    t = time.perf_counter()
+    poses = calculator.calc_poses(target_frame, crane_positions, roll_tilt_pan, batch_size)
+    t_batch = time.perf_counter() - t
+
+    from pytransform3d.transformations import transform_from
+    from scipy.spatial.transform import Rotation as R
+
+    tm = get_tf_manager()
+    ar3_rot = R.from_matrix(tm.get_transform('setup/ar3', 'setup/portal_crane')[:3, :3])
+    ar3_pos = tm.get_transform('setup/ar3', 'setup/portal_crane')[:3, 3]
+    t = time.perf_counter()
+    max_error = 0.
+    max_angle = 0.
+    for i in range(min(num_reference, num_frames)):
+        rot = ar3_rot * R.from_euler('xyz', roll_tilt_pan[i], degrees=True)
+        tm.add_transform('setup/ar3', 'world', transform_from(rot.as_matrix(), crane_positions[i] + ar3_pos))
+        sonar2target = tm.get_transform('setup/sonar', target_frame)
+        max_error = max(max_error, np.abs(sonar2target[:3, 3] - poses[i, :3]).max())
+        # Angle of the rotation between both orientations, q and -q are the same
+        max_angle = max(max_angle, (R.from_matrix(sonar2target[:3, :3]).inv() * R.from_quat(poses[i, 3:])).magnitude())
+    t_reference = (time.perf_counter() - t) / min(num_reference, num_frames) * num_frames
+
+    print(f'batched:   {num_frames / t_batch:12.0f} frames/s ({t_batch:.3f}s for {num_frames} frames)')
+    print(f'per frame: {num_frames / t_reference:12.0f} frames/s (extrapolated from {min(num_reference, num_frames)} frames)')
+    print(f'max. position deviation: {max_error:.2e}m')
+    print(f'max. orientation deviation: {max_angle:.2e}rad')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Calculate sonar to target poses for all frames of an exported dataset')
+    parser.add_argument('export_dir', nargs='?')
+    parser.add_argument('-f', '--format', choices=['csv', 'npz'], default='csv')
+    parser.add_argument('-t', '--target', default=None, help='use this target frame for all recordings (e.g. target/100lbs)')
+    parser.add_argument('-b', '--batch-size', type=int, default=10000)
+    parser.add_argument('--benchmark', type=int, metavar='NUM_FRAMES', default=0, help='measure throughput on synthetic data and exit')
+
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark, args.batch_size)
+        sys.exit(0)
+
+    if not args.export_dir:
+        parser.error('export_dir is required')
+
+    export_poses(args.export_dir, args.format, args.target, args.batch_size)
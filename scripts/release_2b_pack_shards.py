@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from tqdm import tqdm
+
+from common.config import get_config
+from common.shards import ShardWriter, ShardedArchive, get_shard_index_path
+
+
+"""
+Packs the exported recordings into tar shards of a fixed maximum size, each with an offset index
+(see common/shards.py). Unlike the archives of release_2_archive.bash, the shards don't have to be
+extracted before use: single frames can be read directly from them, and whole shards can be
+streamed sequentially for training.
+
+Within a recording, the small tables come first, followed by the frames in order, with all
+modalities of a frame next to each other. A sequential read of a shard thus yields complete,
+synchronized samples. Use --verify to compare the shards against the export tree.
+"""
+
+
+def _pack_order(name):
+    # Tables first, then frames by number, e.g. aris_raw/0042.pgm, aris_polar/0042.png, gopro/0042.jpg
+    modality, _, filename = name.rpartition('/')
+    stem = os.path.splitext(filename)[0]
+    if modality and stem.isdigit():
+        return (1, int(stem), modality)
+    return (0, 0, name)
+
+
+def iter_export_files(export_dir):
+    # Paths relative to the export dir of all files of the exported recordings, in packing order
+    recordings_dir = os.path.join(export_dir, 'recordings')
+    for target_type in sorted(os.listdir(recordings_dir)):
+        target_dir = os.path.join(recordings_dir, target_type)
+        if not os.path.isdir(target_dir):
+            continue
+        for rec_name in sorted(os.listdir(target_dir)):
+            rec_dir = os.path.join(target_dir, rec_name)
+            if not os.path.isdir(rec_dir):
+                continue
+
+            names = []
+            for root, _, files in os.walk(rec_dir):
+                relroot = os.path.relpath(root, rec_dir)
+                names += [f if relroot == '.' else f'{relroot}/{f}' for f in files]
+
+            rec_relpath = f'recordings/{target_type}/{rec_name}'
+            for name in sorted(names, key=_pack_order):
+                yield f'{rec_relpath}/{name}'
+
+
+def pack_export(export_dir, shard_dir, prefix, shard_size):
+    os.makedirs(shard_dir, exist_ok=True)
+
+    # Shards of a previous run would be mixed up with the new ones
+    for f in os.listdir(shard_dir):
+        if f.startswith(prefix + '-') and (f.endswith('.tar') or f.endswith('.tar.idx')):
+            os.remove(os.path.join(shard_dir, f))
+
+    files = list(iter_export_files(export_dir))
+    num_bytes = 0
+    t = time.perf_counter()
+    with ShardWriter(shard_dir, prefix, shard_size) as writer:
+        for relpath in tqdm(files, desc='packing'):
+            path = os.path.join(export_dir, relpath)
+            writer.add_file(path, relpath)
+            num_bytes += os.path.getsize(path)
+    duration = time.perf_counter() - t
+
+    print(f'Packed {len(files)} files ({num_bytes / 1e6:.1f}MB) into {len(writer.shard_files)} shards '
+          f'in {duration:.1f}s ({num_bytes / 1e6 / max(duration, 1e-9):.1f}MB/s)')
+    return writer.shard_files
+
+
+def verify_shards(export_dir, shard_dir, prefix):
+    # Round trip: every file of the export must be readable from the shards by random access and
+    # by streaming, with identical content
+    files = list(iter_export_files(export_dir))
+    errors = 0
+
+    with ShardedArchive(shard_dir, prefix) as archive:
+        missing = set(files) - set(archive.names())
+        extra = set(archive.names()) - set(files)
+        for name in sorted(missing):
+            print(f'missing: {name}')
+        for name in sorted(extra):
+            print(f'not in export: {name}')
+        errors += len(missing) + len(extra)
+
+        # Random access in random order
+        order = np.random.default_rng(0).permutation(len(files))
+        num_bytes = 0
+        t = time.perf_counter()
+        for i in tqdm(order, desc='random access'):
+            name = files[i]
+            if name in missing:
+                continue
+            data = archive.read(name)
+            with open(os.path.join(export_dir, name), 'rb') as f:
+                if data != f.read():
+                    print(f'content differs: {name}')
+                    errors += 1
+            num_bytes += len(data)
+        t_random = time.perf_counter() - t
+
+        # Sequential streaming, must also preserve the packing order
+        t = time.perf_counter()
+        streamed = []
+        for name, data in tqdm(archive.stream(), total=len(archive), desc='streaming'):
+            streamed.append(name)
+            with open(os.path.join(export_dir, name), 'rb') as f:
+                if data != f.read():
+                    print(f'streamed content differs: {name}')
+                    errors += 1
+        t_stream = time.perf_counter() - t
+        if streamed != [name for name in files if name not in missing]:
+            print('streaming order differs from the packing order')
+            errors += 1
+
+    print(f'random access: {len(files) / t_random:.0f} files/s, {num_bytes / 1e6 / t_random:.1f}MB/s '
+          f'(including reading the original files)')
+    print(f'streaming:     {len(streamed) / t_stream:.0f} files/s, {num_bytes / 1e6 / t_stream:.1f}MB/s')
+    print('OK' if not errors else f'{errors} errors')
+    return errors == 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack the exported recordings into tar shards with offset indices')
+    parser.add_argument('-c', '--config', default='', help='config file, defaults to config.yaml next to this script')
+    parser.add_argument('-s', '--shard-size', type=float, default=None, help='maximum shard size in MB, overrides the config')
+    parser.add_argument('--verify', action='store_true', help='compare the shards against the export after packing')
+    parser.add_argument('--verify-only', action='store_true', help='only compare existing shards against the export')
+
+    args = parser.parse_args()
+    config = get_config(args.config)
+
+    export_dir = config["export_dir"]
+    shard_dir = config.get("shards_dir", os.path.join(os.path.dirname(os.path.normpath(export_dir)), 'shards'))
+    prefix = os.path.basename(os.path.normpath(export_dir))
+    shard_size = int((args.shard_size or config.get("shards_size_mb", 1024)) * 1e6)
+
+    if not args.verify_only:
+        shard_files = pack_export(export_dir, shard_dir, prefix, shard_size)
+        print(f'Shards written to {shard_dir}, e.g. {os.path.basename(shard_files[0])} '
+              f'and {os.path.basename(get_shard_index_path(shard_files[0]))}' if shard_files else 'Nothing to pack')
+
+    if args.verify or args.verify_only:
+        sys.exit(0 if verify_shards(export_dir, shard_dir, prefix) else 1)
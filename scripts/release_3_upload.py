@@ -1,22 +1,364 @@
 import os
+import json
+import time
+import random
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
 import click
+from tqdm import tqdm
+
+from common.checksums import new_hash, file_checksum, write_checksum_file
+
+
+"""
+Uploads the release archives to a bucket (e.g. a Zenodo deposition's bucket URL). Files are
+streamed from disk and uploaded in parallel, failed requests are retried with exponential backoff.
+
+By default every file is sent with a single PUT request, which is what the Zenodo bucket API
+accepts. Servers that support resumable uploads (PUT requests with a Content-Range header, answered
+with "308 Resume Incomplete" and a Range header until the file is complete) can be used with
+--ranges: each chunk is then a separate request, so a failure only repeats the current chunk.
+
+The progress is kept in a state file. Files that were uploaded before (same size and modification
+time) are skipped when the upload is started again, unfinished chunked uploads continue where the
+server stopped. For testing, run "python -m common.upload_server <dir>" and upload to
+http://localhost:8000/<bucket>.
+"""
+
+
+# Worth another try, anything else >= 400 is fatal for the file
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class UploadError(Exception):
+    pass
+
+
+class _RetryableError(Exception):
+    pass
+
+
+class UploadState:
+    """
+    Persistent upload progress (json), shared between the upload threads. Entries are keyed by
+    bucket and filename, so the same file can be uploaded to different buckets.
+    """
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.isfile(state_file):
+            with open(state_file, 'r') as f:
+                self._entries = json.load(f)
+
+    def get(self, key):
+        with self._lock:
+            return dict(self._entries.get(key, {}))
+
+    def update(self, key, **values):
+        with self._lock:
+            self._entries.setdefault(key, {}).update(values)
+            # Never leave a half-written state file behind
+            tmp_file = self.state_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(self._entries, f, indent=2, sort_keys=True)
+            os.replace(tmp_file, self.state_file)
+
+
+class _Digests:
+    # md5 to compare with what the bucket received, sha256 for the release manifest
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.sha256 = new_hash()
+
+    def update(self, data):
+        self.md5.update(data)
+        self.sha256.update(data)
+
+
+class _HashingReader:
+    # File-like body that hashes and reports the bytes as they are being sent
+    def __init__(self, fp, size, digests, progress, cancelled):
+        self._fp = fp
+        self._cancelled = cancelled
+        self._remaining = size
+        self._digests = digests
+        self._progress = progress
+
+    def __len__(self):
+        return self._remaining
+
+    def read(self, n=-1):
+        if self._cancelled.is_set():
+            raise UploadError('cancelled')
+        data = self._fp.read(self._remaining if n is None or n < 0 else min(n, self._remaining))
+        self._remaining -= len(data)
+        self._digests.update(data)
+        self._progress(len(data))
+        return data
+
+
+class Uploader:
+    def __init__(self, bucket, key, state, chunk_size=64 * 2**20, retries=5, backoff=2., use_ranges=False, progress=None):
+        self.bucket = bucket.rstrip('/')
+        self.key = key
+        self.state = state
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.backoff = backoff
+        self.use_ranges = use_ranges
+        self._progress = progress or (lambda n: None)
+        self._local = threading.local()
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        # Running uploads stop after the current chunk, the state allows to continue later
+        self._cancelled.set()
+
+    def _session(self):
+        # Sessions keep connections alive, but must not be shared between threads
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _with_retries(self, func, what):
+        for attempt in range(self.retries + 1):
+            try:
+                return func()
+            except (requests.ConnectionError, requests.Timeout, _RetryableError) as e:
+                if attempt == self.retries:
+                    raise UploadError(f'{what} failed after {attempt + 1} attempts: {e}') from e
+                # Exponential backoff with jitter, so parallel uploads don't retry in lockstep
+                delay = self.backoff * 2**attempt * random.uniform(0.5, 1.)
+                tqdm.write(f'{what}: {e}, retrying in {delay:.1f}s')
+                time.sleep(delay)
+
+    @staticmethod
+    def _check(r):
+        if r.status_code in RETRY_STATUS:
+            raise _RetryableError(f'HTTP {r.status_code}')
+        if r.status_code >= 400:
+            raise UploadError(f'HTTP {r.status_code}: {r.text[:500]}')
+        return r
+
+    def _put(self, url, **kwargs):
+        return self._session().put(url, params={'access_token': self.key}, **kwargs)
+
+    def upload(self, path):
+        if self._cancelled.is_set():
+            raise UploadError('cancelled')
+        filename = os.path.basename(path)
+        url = f'{self.bucket}/{filename}'
+        st = os.stat(path)
+        state_key = url
+        entry = self.state.get(state_key)
+
+        if entry.get('size') != st.st_size or entry.get('mtime_ns') != st.st_mtime_ns:
+            # New or modified file
+            self.state.update(state_key, size=st.st_size, mtime_ns=st.st_mtime_ns, done=False, offset=0)
+        elif entry.get('done'):
+            self._progress(st.st_size)
+            return dict(filename=filename, skipped=True, size=st.st_size, sha256=entry.get('sha256'))
+
+        t = time.perf_counter()
+        if self.use_ranges and st.st_size > 0:
+            response, digests, sent = self._upload_ranges(path, url, st.st_size, state_key)
+        else:
+            response, digests, sent = self._upload_whole(path, url, st.st_size)
+        duration = time.perf_counter() - t
+        md5 = digests.md5.hexdigest()
+        sha256 = digests.sha256.hexdigest()
+
+        # Zenodo reports the checksum of what it received as "md5:<hex>"
+        try:
+            remote_checksum = response.json().get('checksum', '')
+        except ValueError:
+            remote_checksum = ''
+        if remote_checksum.startswith('md5:') and remote_checksum[4:] != md5:
+            self.state.update(state_key, done=False, offset=0)
+            raise UploadError(f'{filename}: checksum mismatch (local md5:{md5}, remote {remote_checksum})')
+
+        self.state.update(state_key, done=True, offset=st.st_size, md5=md5, sha256=sha256, uploaded=time.strftime('%Y-%m-%d %H:%M:%S'))
+        return dict(filename=filename, skipped=False, size=st.st_size, sent=sent, duration=duration, md5=md5, sha256=sha256)
+
+    def _upload_whole(self, path, url, size):
+        sent = 0
+
+        def attempt():
+            nonlocal sent
+            digests = _Digests()
+            attempt_sent = 0
+
+            def progress(n):
+                nonlocal attempt_sent
+                attempt_sent += n
+                self._progress(n)
+
+            try:
+                with open(path, 'rb') as fp:
+                    r = self._check(self._put(url, data=_HashingReader(fp, size, digests, progress, self._cancelled)))
+            except Exception:
+                # The whole file has to be sent again
+                self._progress(-attempt_sent)
+                sent += attempt_sent
+                raise
+            sent += attempt_sent
+            return r, digests
+
+        r, digests = self._with_retries(attempt, os.path.basename(path))
+        return r, digests, sent
+
+    def _query_offset(self, url, size):
+        # Number of bytes the server already has of an unfinished upload
+        r = self._put(url, headers={'Content-Range': f'bytes */{size}'})
+        if r.status_code == 308:
+            return self._acknowledged(r)
+        if r.status_code in (200, 201):
+            return size
+        return 0
+
+    @staticmethod
+    def _acknowledged(r):
+        # "Range: bytes=0-<last byte>", missing if nothing was received yet
+        received = r.headers.get('Range')
+        return int(received.rsplit('-', 1)[-1]) + 1 if received else 0
+
+    def _upload_ranges(self, path, url, size, state_key):
+        filename = os.path.basename(path)
+        offset = 0
+        if self.state.get(state_key).get('offset'):
+            offset = self._with_retries(lambda: self._query_offset(url, size), f'{filename} (resume)')
+            if offset:
+                tqdm.write(f'{filename}: resuming at {offset / 1e6:.1f}MB')
+
+        digests = _Digests()
+        sent = 0
+        with open(path, 'rb') as fp:
+            # The part that is already on the server still has to be hashed
+            done = 0
+            while done < offset:
+                data = fp.read(min(self.chunk_size, offset - done))
+                digests.update(data)
+                done += len(data)
+            self._progress(offset)
+
+            response = None
+            while response is None:
+                if self._cancelled.is_set():
+                    raise UploadError(f'cancelled at {offset / 1e6:.1f}MB')
+                fp.seek(offset)
+                data = fp.read(self.chunk_size)
+                end = offset + len(data) - 1
+
+                def attempt():
+                    r = self._check(self._put(url, data=data, headers={'Content-Range': f'bytes {offset}-{end}/{size}'}))
+                    return r
+
+                r = self._with_retries(attempt, f'{filename} ({offset / 1e6:.1f}MB)')
+                sent += len(data)
+                if r.status_code == 308:
+                    new_offset = self._acknowledged(r)
+                else:
+                    new_offset = size
+                    response = r
+
+                # The server may have kept less than we sent
+                if new_offset < offset + len(data):
+                    digests = _Digests()
+                    fp.seek(0)
+                    done = 0
+                    while done < new_offset:
+                        chunk = fp.read(min(self.chunk_size, new_offset - done))
+                        digests.update(chunk)
+                        done += len(chunk)
+                    self._progress(new_offset - offset)
+                else:
+                    digests.update(data)
+                    self._progress(len(data))
+                offset = new_offset
+                self.state.update(state_key, offset=offset)
+
+        return response, digests, sent
 
 
 @click.command()
-@click.argument("files", type=click.Path(exists=True), nargs=-1)
+@click.argument("files", type=click.Path(exists=True, dir_okay=False), nargs=-1)
 @click.option("--key", prompt="Access token")
 @click.option("--bucket", prompt="Bucket URL")
-def main(files, key, bucket):
-    for file in files:
-        filename = os.path.basename(file)
-        print(f"Uploading {filename} - please be patient...")
-
-        with open(file, "rb") as fp:
-            r = requests.put(
-                f"{bucket}/{filename}", data=fp, params={"access_token": key}
-            )
-            print(f"{r.status_code}:\n{r.json()}")
+@click.option("--workers", default=2, show_default=True, help="Number of files to upload in parallel.")
+@click.option("--chunk-size", default=64, show_default=True, help="Chunk size in MB for --ranges.")
+@click.option("--ranges/--no-ranges", default=False, show_default=True, help="Upload in chunks with Content-Range headers (server must support resumable uploads).")
+@click.option("--retries", default=5, show_default=True, help="Retries per request before a file is given up.")
+@click.option("--backoff", default=2., show_default=True, help="Initial delay in seconds between retries, doubles with every retry.")
+@click.option("--state", "state_file", default="upload_state.json", show_default=True, help="File to keep the upload progress in.")
+@click.option("--manifest", default="upload_manifest.sha256", show_default=True, help="Write the sha256 checksums of the uploaded files to this file.")
+def main(files, key, bucket, workers, chunk_size, ranges, retries, backoff, state_file, manifest):
+    state = UploadState(state_file)
+    total_size = sum(os.path.getsize(f) for f in files)
+
+    with tqdm(total=total_size, unit='B', unit_scale=True, unit_divisor=1024, desc='upload') as pbar:
+        lock = threading.Lock()
+        def progress(n):
+            with lock:
+                pbar.update(n)
+
+        uploader = Uploader(bucket, key, state,
+                            chunk_size=chunk_size * 2**20,
+                            retries=retries,
+                            backoff=backoff,
+                            use_ranges=ranges,
+                            progress=progress)
+
+        t_start = time.perf_counter()
+        results = []
+        failed = []
+        pool = ThreadPoolExecutor(max(1, workers))
+        futures = {pool.submit(uploader.upload, f): f for f in files}
+        try:
+            for future in as_completed(futures):
+                filename = os.path.basename(futures[future])
+                try:
+                    res = future.result()
+                except (UploadError, OSError) as e:
+                    tqdm.write(f"{filename}: FAILED ({e})")
+                    failed.append(filename)
+                    continue
+
+                results.append(res)
+                if res['skipped']:
+                    tqdm.write(f"{filename}: already uploaded, skipping")
+                else:
+                    tqdm.write(f"{filename}: {res['size'] / 1e6:.1f}MB, sent {res['sent'] / 1e6:.1f}MB in {res['duration']:.1f}s "
+                               f"({res['sent'] / 1e6 / max(res['duration'], 1e-9):.1f}MB/s), md5:{res['md5']}")
+        except KeyboardInterrupt:
+            tqdm.write('Interrupted, stopping the running uploads...')
+            uploader.cancel()
+            pool.shutdown(wait=True, cancel_futures=True)
+            raise SystemExit(f'Upload interrupted, run again to continue (progress is kept in {state_file})')
+        pool.shutdown()
+        duration = time.perf_counter() - t_start
+
+    uploaded = [r for r in results if not r['skipped']]
+    num_bytes = sum(r['size'] for r in uploaded)
+    num_sent = sum(r['sent'] for r in uploaded)
+    # Resumed uploads send less than the file size, retried single-request uploads more
+    print(f"Uploaded {len(uploaded)} files ({num_bytes / 1e6:.1f}MB), sent {num_sent / 1e6:.1f}MB in {duration:.1f}s "
+          f"({num_sent / 1e6 / max(duration, 1e-9):.1f}MB/s)")
+    if len(results) > len(uploaded):
+        print(f"{len(results) - len(uploaded)} files were already uploaded")
+    # The checksums were calculated while uploading. Only files uploaded without them (by an older
+    # version of this script) have to be read again.
+    if manifest and results:
+        paths = {os.path.basename(p): p for p in files}
+        checksums = {res['filename']: res['sha256'] or file_checksum(paths[res['filename']]) for res in results}
+        write_checksum_file(manifest, checksums)
+        print(f"Checksums written to {manifest}, verify downloads with: python -m common.checksums --manifest {manifest}")
+
+    if failed:
+        print(f"{len(failed)} files failed, run again to continue: {', '.join(failed)}")
+        raise SystemExit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import argparse
+import subprocess
+
+from common.config import get_config
+from common.matching_context import folder_basename
+from common.odometry import get_odometry_path
+from common.checksums import CHECKSUM_FILE, RELEASE_MANIFEST
+from common.dataset_index import get_index_path
+from common.proxies import PROXY_CLIPS_DIR, get_proxy_clip_path, get_aris_preview_path
+from common.pipeline import Task, PipelineState, run_tasks
+from prep_1_aris_extract import extract_aris_file
+from prep_2_aris_to_polar import convert_recording, get_polar_imwrite_params
+from prep_3_aris_calc_optical_flow import calc_aris_flow
+from prep_3b_aris_detect_onsets import propose_onsets
+from prep_5_gantry_extract import extract_bag
+from prep_6_gantry_find_offsets import GANTRY_METADATA_FILE, write_gantry_metadata
+from prep_8b_make_proxies import make_proxy_clip, make_aris_previews
+from prep_9_gopro_calc_optical_flow import calc_gopro_flow, get_gopro_flow_path
+from release_1_export import MANIFEST_FILE, export_recording, get_export_options, get_target_type, read_matches, finalize_export
+from release_1b_sonar_poses import export_poses
+
+
+"""
+Brings the whole dataset up to date with a single command. Every preprocessing and export step is
+modelled as a task per recording (or clip, or bag) with declared inputs and outputs, and only the
+tasks whose inputs or options changed since they last ran are executed (see common/pipeline.py).
+Independent tasks, e.g. the polar conversion of one recording and the optical flow of another, run
+in parallel.
+
+The interactive steps can't be automated and still have to be run by hand: cutting the GoPro
+footage (prep_7_gopro_cut.bash), checking the ARIS onsets (prep_4_aris_find_offsets.py) and
+matching the recordings (prep_x_match_recordings.py). The export tasks are only created once the
+match file exists; changing it re-exports only the recordings whose matches changed.
+
+Use -n to see what would run, --steps to restrict the run to some steps and --force to re-run a
+step for all items.
+"""
+
+
+STEPS = ['aris_extract', 'aris_to_polar', 'aris_flow', 'aris_onsets', 'aris_preview',
+         'gantry_extract', 'gantry_offsets',
+         'gopro_downsample', 'gopro_flow', 'gopro_proxy',
+         'export', 'sonar_poses', 'export_finalize']
+
+# Same as prep_8_gopro_downsample.bash
+DOWNSAMPLE_OPTIONS = {
+    'fhd': ['-vf', 'scale=1920:1080', '-c:v', 'libx264', '-an'],
+    'sd': ['-vf', 'scale=640:360', '-c:v', 'libx264', '-an'],
+}
+
+
+def _aris_to_polar(aris_dir, polar_args):
+    # All frames are converted, the task only runs if they are outdated
+    convert_recording(aris_dir, skip_existing=False, **polar_args)
+
+
+def _downsample_clip(src_file, dst_file, res, ffmpeg):
+    os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+    tmp_file = dst_file + '.part'
+    cmd = [ffmpeg, '-hide_banner', '-loglevel', 'error', '-nostdin', '-y', '-i', src_file,
+           *DOWNSAMPLE_OPTIONS[res], '-f', 'mp4', tmp_file]
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+        raise RuntimeError(f'ffmpeg failed on {src_file}: {result.stderr.strip()}')
+    os.replace(tmp_file, dst_file)
+
+
+def _make_proxy_clip(src_file, height, quality):
+    dst_file = get_proxy_clip_path(src_file)
+    os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+    make_proxy_clip(src_file, dst_file, height, quality)
+
+
+def _export_recording(match, data_root, recordings_dir, export_options, force):
+    os.makedirs(recordings_dir, exist_ok=True)
+    export_recording(match, data_root, recordings_dir, **export_options, force=force)
+
+
+def _list_files(path, ext):
+    if not os.path.isdir(path):
+        return []
+    return sorted(f for f in os.listdir(path) if f.lower().endswith(ext))
+
+
+def get_aris_tasks(config, make_proxies):
+    input_path = config["aris_input"]
+    extract_path = config["aris_extract"]
+    polar_img_format = config["aris_to_polar_image_format"]
+
+    polar_args = dict(
+        methods=config["aris_to_polar_method"].split("+"),
+        image_format=polar_img_format,
+        imwrite_params=get_polar_imwrite_params(polar_img_format,
+                                                config.get("aris_to_polar_png_compression", 3),
+                                                config.get("aris_to_polar_jxl_effort", 7)),
+        polar1_norm_intensity=config.get("aris_to_polar_polar1_norm_intensity", False),
+        polar1_antialiasing=config.get("aris_to_polar_polar1_antialiasing", False),
+        polar1_scale=config.get("aris_to_polar_polar1_scale", 2.0),
+        polar2_resolution=config.get("aris_to_polar_polar2_resolution", 500),
+    )
+    flow_method = config.get("aris_optical_flow_method", "lk")
+    onset_args = dict(smoothing=config.get("aris_onset_smoothing", 5),
+                      min_segment=config.get("aris_onset_min_segment", 10))
+    preview_size = config.get("proxy_aris_max_size", 512)
+
+    # Recordings that still have to be extracted and those that have been extracted before
+    aris_files = {os.path.splitext(f)[0]: os.path.join(input_path, f) for f in _list_files(input_path, '.aris')}
+    recordings = set(aris_files)
+    if os.path.isdir(extract_path):
+        recordings.update(d for d in os.listdir(extract_path) if os.path.isdir(os.path.join(extract_path, d)))
+
+    tasks = []
+    for rec in sorted(recordings):
+        aris_dir = os.path.join(extract_path, rec)
+        raw_frames = os.path.join(aris_dir, '*.pgm')
+        frames_csv = os.path.join(aris_dir, rec + '_frames.csv')
+        polar_dir = os.path.join(aris_dir, 'polar')
+        polar_frames = os.path.join(polar_dir, '*.' + polar_img_format)
+        flow_file = os.path.join(aris_dir, rec + '_flow.csv')
+
+        if rec in aris_files:
+            tasks.append(Task('aris_extract', rec, extract_aris_file, (aris_files[rec], extract_path),
+                              inputs=[aris_files[rec]],
+                              outputs=[frames_csv, os.path.join(aris_dir, rec + '_metadata.yaml')]))
+        tasks.append(Task('aris_to_polar', rec, _aris_to_polar, (aris_dir, polar_args),
+                          inputs=[raw_frames, frames_csv],
+                          outputs=[polar_dir],
+                          params=polar_args,
+                          deps=[f'aris_extract:{rec}']))
+        tasks.append(Task('aris_flow', rec, calc_aris_flow, (aris_dir, flow_method, polar_img_format),
+                          inputs=[polar_frames],
+                          outputs=[flow_file],
+                          params={'method': flow_method, 'polar_img_format': polar_img_format},
+                          deps=[f'aris_to_polar:{rec}']))
+        # The proposal is added to the marks file, which isn't written if no motion was found
+        tasks.append(Task('aris_onsets', rec, propose_onsets, (aris_dir, onset_args['smoothing'], onset_args['min_segment']),
+                          inputs=[raw_frames, flow_file],
+                          params=onset_args,
+                          deps=[f'aris_flow:{rec}']))
+        if make_proxies:
+            tasks.append(Task('aris_preview', rec, make_aris_previews, (aris_dir, polar_img_format, preview_size, False),
+                              inputs=[raw_frames, polar_frames],
+                              outputs=[get_aris_preview_path(aris_dir, 'raw'), get_aris_preview_path(aris_dir, 'polar')],
+                              params={'max_size': preview_size},
+                              deps=[f'aris_to_polar:{rec}']))
+    return tasks
+
+
+def get_gantry_tasks(config):
+    input_path = config["gantry_input"]
+    extract_path = config["gantry_extract"]
+    time_adjust = float(config.get("gantry_time_adjust", 0))
+    resample_rate = float(config.get("gantry_resample_rate", 0))
+    segment_args = dict(
+        noise_threshold=config.get("gantry_noise_threshold", 5e-4),
+        speed_threshold=config.get("gantry_speed_threshold", 2e-3),
+        min_stop_s=config.get("gantry_min_stop_duration", 0.5),
+    )
+    segment_workers = config.get("gantry_segment_workers", 0)
+
+    tasks = []
+    trajectories = []
+    for bag in _list_files(input_path, '.bag'):
+        name = os.path.splitext(bag)[0]
+        csv_file = os.path.join(extract_path, name + '.csv')
+        trajectories.append(csv_file)
+        tasks.append(Task('gantry_extract', name, extract_bag, (os.path.join(input_path, bag), extract_path, time_adjust, resample_rate),
+                          inputs=[os.path.join(input_path, bag)],
+                          outputs=[csv_file, get_odometry_path(csv_file)],
+                          params={'time_adjust': time_adjust, 'resample_rate': resample_rate}))
+
+    # The metadata file sits next to the trajectories, so they are listed instead of the folder
+    for f in _list_files(extract_path, '.csv'):
+        if f != GANTRY_METADATA_FILE and os.path.join(extract_path, f) not in trajectories:
+            trajectories.append(os.path.join(extract_path, f))
+    # Nothing to segment before the first bag arrived
+    if trajectories:
+        tasks.append(Task('gantry_offsets', '', write_gantry_metadata, (extract_path, segment_args, segment_workers),
+                          inputs=sorted(trajectories),
+                          outputs=[os.path.join(extract_path, GANTRY_METADATA_FILE)],
+                          params=segment_args,
+                          deps=[t.name for t in tasks]))
+    return tasks
+
+
+def get_proxy_source_res(gopro_base_path, resolutions):
+    # Same preference as find_source_clips_dir, but including clips that are yet to be downsampled
+    for res in ["sd"] + resolutions + ["fhd", "uhd"]:
+        if res in resolutions or res == "uhd" or os.path.isdir(os.path.join(gopro_base_path, "clips_" + res)):
+            return res
+
+
+def get_gopro_tasks(config, make_proxies):
+    gopro_base_path = config["gopro_extract"]
+    resolutions = [r for r in config["gopro_clip_resolution"].split("+") if r != "copy"]
+    flow_method = config.get("gopro_optical_flow_method", "lk")
+    ffmpeg = config.get("export_ffmpeg", "ffmpeg")
+    proxy_height = config.get("proxy_gopro_height", 270)
+    proxy_quality = config.get("proxy_gopro_quality", 75)
+
+    uhd_dir = os.path.join(gopro_base_path, "clips_uhd")
+    uhd_clips = _list_files(uhd_dir, '.mp4')
+
+    tasks = []
+    clips = {}
+    for res in resolutions:
+        if res not in DOWNSAMPLE_OPTIONS and res != "uhd":
+            raise ValueError(f"resolution '{res}' not recognized, must be one of 'uhd', 'fhd', 'sd'")
+        res_dir = os.path.join(gopro_base_path, "clips_" + res)
+        if res == "uhd" or not uhd_clips:
+            # Nothing to downsample from, use the clips that are there
+            clips[res] = _list_files(res_dir, '.mp4')
+            continue
+
+        clips[res] = uhd_clips
+        for clip in uhd_clips:
+            tasks.append(Task('gopro_downsample', f'{res}/{clip}', _downsample_clip,
+                              (os.path.join(uhd_dir, clip), os.path.join(res_dir, clip), res, ffmpeg),
+                              inputs=[os.path.join(uhd_dir, clip)],
+                              outputs=[os.path.join(res_dir, clip)],
+                              params={'options': DOWNSAMPLE_OPTIONS[res]}))
+
+    for res in resolutions:
+        for clip in clips[res]:
+            clip_path = os.path.join(gopro_base_path, "clips_" + res, clip)
+            tasks.append(Task('gopro_flow', f'{res}/{clip}', calc_gopro_flow, (clip_path, flow_method),
+                              inputs=[clip_path],
+                              outputs=[get_gopro_flow_path(clip_path)],
+                              params={'method': flow_method},
+                              deps=[f'gopro_downsample:{res}/{clip}']))
+
+    if make_proxies:
+        res = get_proxy_source_res(gopro_base_path, resolutions)
+        for clip in clips.get(res) or _list_files(os.path.join(gopro_base_path, "clips_" + res), '.mp4'):
+            clip_path = os.path.join(gopro_base_path, "clips_" + res, clip)
+            tasks.append(Task('gopro_proxy', clip, _make_proxy_clip, (clip_path, proxy_height, proxy_quality),
+                              inputs=[clip_path],
+                              outputs=[os.path.join(gopro_base_path, PROXY_CLIPS_DIR, clip)],
+                              params={'height': proxy_height, 'quality': proxy_quality},
+                              deps=[f'gopro_downsample:{res}/{clip}']))
+    return tasks
+
+
+def get_export_tasks(config, force):
+    match_file = config["match_file"]
+    export_dir = config["export_dir"]
+    export_options = get_export_options(config)
+    gopro_resolution = export_options["gopro_resolution"]
+    polar_img_format = export_options["aris_polar_img_format"]
+    data_root = os.path.dirname(match_file)
+    recordings_dir = os.path.join(export_dir, 'recordings')
+
+    if not os.path.isfile(match_file):
+        print(f'{match_file} does not exist yet, run prep_x_match_recordings.py to match the recordings '
+              f'and then run this script again to export them')
+        return []
+
+    tasks = []
+    for _, match in read_matches(match_file).iterrows():
+        aris_dir = os.path.join(data_root, match['aris_file'])
+        rec = folder_basename(match['aris_file'])
+        gantry_file = os.path.join(data_root, match['gantry_file'])
+        bag = os.path.splitext(os.path.basename(gantry_file))[0]
+        inputs = [
+            os.path.join(aris_dir, '*.pgm'),
+            os.path.join(aris_dir, 'polar', '*.' + polar_img_format),
+            os.path.join(aris_dir, rec + '_frames.csv'),
+            os.path.join(aris_dir, rec + '_metadata.yaml'),
+            os.path.join(aris_dir, rec + '_marks.yaml'),
+            gantry_file,
+            get_odometry_path(gantry_file),
+            os.path.join(os.path.dirname(gantry_file), GANTRY_METADATA_FILE),
+        ]
+        # The onset proposal is written to the marks file and the previews into the recording folder,
+        # so both have to be finished before the inputs are fingerprinted
+        deps = [f'aris_to_polar:{rec}', f'aris_onsets:{rec}', f'aris_preview:{rec}', f'gantry_extract:{bag}', 'gantry_offsets']
+        if match['gopro_file']:
+            # Resolved to the exported resolution like export_recording does
+            gopro_file = os.path.join(data_root, match['gopro_file'])
+            if gopro_resolution:
+                gopro_file = re.sub(r'/clips_.+?/', '/clips_' + gopro_resolution + '/', gopro_file)
+            res = os.path.basename(os.path.dirname(gopro_file))[len('clips_'):]
+            inputs.append(gopro_file)
+            deps.append(f'gopro_downsample:{res}/{os.path.basename(gopro_file)}')
+
+        rec_root = os.path.join(recordings_dir, get_target_type(match['notes']), rec)
+        tasks.append(Task('export', rec, _export_recording, (match, data_root, recordings_dir, export_options, force),
+                          inputs=inputs,
+                          outputs=[os.path.join(rec_root, MANIFEST_FILE)],
+                          params={'match': {k: str(v) for k, v in match.items()}, **export_options},
+                          deps=deps))
+
+    exported = [t.outputs[0] for t in tasks]
+    tasks.append(Task('sonar_poses', '', export_poses, (export_dir,),
+                      inputs=[os.path.join(os.path.dirname(f), name) for f in exported for name in ('gantry.csv', 'aris_frame_meta.csv')],
+                      outputs=[os.path.join(os.path.dirname(f), 'sonar_pose.csv') for f in exported],
+                      deps=[t.name for t in tasks]))
+
+    tasks.append(Task('export_finalize', '', finalize_export, (export_dir, data_root),
+                      inputs=[os.path.join(recordings_dir, '*', '*', CHECKSUM_FILE),
+                              os.path.join(recordings_dir, '*', '*', 'sonar_pose.*'),
+                              os.path.join(data_root, '../3d_models'),
+                              os.path.join(data_root, '../calibration'),
+                              os.path.dirname(os.path.abspath(__file__)),
+                              os.path.join(data_root, '../README.md'),
+                              os.path.join(data_root, '../preview.jpg')],
+                      outputs=[os.path.join(export_dir, RELEASE_MANIFEST), get_index_path(export_dir)],
+                      deps=['sonar_poses']))
+    return tasks
+
+
+def get_tasks(config, force_export=False):
+    make_proxies = config.get("pipeline_make_proxies", True)
+    return (get_aris_tasks(config, make_proxies)
+            + get_gantry_tasks(config)
+            + get_gopro_tasks(config, make_proxies)
+            + get_export_tasks(config, force_export))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run all outdated preprocessing and export steps')
+    parser.add_argument('-c', '--config', default='', help='config file, defaults to config.yaml next to this script')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='number of tasks to run in parallel, overrides the config')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='only show which tasks would run')
+    parser.add_argument('-s', '--steps', nargs='+', choices=STEPS, default=None, help='only run these steps')
+    parser.add_argument('-f', '--force', nargs='+', choices=STEPS, default=[], help='run these steps even if they are up to date')
+
+    args = parser.parse_args()
+    config = get_config(args.config)
+
+    workers = args.workers if args.workers is not None else config.get("pipeline_workers", 0)
+    state = PipelineState(config.get("pipeline_state_file", "../data_processed/pipeline_state.json"))
+
+    tasks = get_tasks(config, force_export='export' in args.force or config.get("export_force", False))
+    if args.steps:
+        tasks = [t for t in tasks if t.step in args.steps]
+
+    num_failed = run_tasks(tasks, state, workers, args.dry_run, args.force)
+    sys.exit(1 if num_failed else 0)
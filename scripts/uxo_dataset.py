@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import yaml
+import numpy as np
+import pandas as pd
+import cv2
+
+from common.aris_definitions import FrameHeaderFields
+from common.cache import LRUCache
+from common.dataset_index import iter_recordings, find_index
+
+
+"""
+Reader for the exported dataset that does not require anything beyond NumPy, pandas and OpenCV
+(in particular no PyTorch). The export tree is indexed once into a compact table with one row per
+ARIS frame, which allows random access as well as streaming iteration over synchronized samples:
+
+    from uxo_dataset import UXODataset
+
+    ds = UXODataset('data_export', modalities=['aris_polar', 'gopro', 'gantry', 'pose'])
+    sample = ds[123]
+    for sample in ds.shard(num_workers, worker_id).stream(shuffle=True, seed=epoch):
+        ...
+
+Each sample is a dict with the recording name, target type and ARIS frame index plus one entry per
+requested modality:
+ - aris_raw, aris_polar: sonar frames as 2D uint8 arrays, None if the recording has no such frames
+ - gopro: camera frame (BGR like OpenCV, HxWx3), None if the frame has no camera image
+ - gantry: crane position and velocity (x, y, z, vx, vy, vz)
+ - ar3: pose of the sonar mount in the crane frame (pos.x, pos.y, pos.z, rot.x, rot.y, rot.z, rot.w)
+ - pose: sonar pose relative to the target as calculated by release_1b_sonar_poses.py (same
+   columns), None if it has not been calculated
+ - meta: the frame's row of aris_frame_meta.csv as a dict
+
+Missing table rows are NaN. The frame index is read from the dataset index file
+(common/dataset_index.py) when the export has one. Tables are loaded once per recording when first
+needed, images are decoded by a pool of threads (OpenCV releases the GIL while decoding) so that
+iteration keeps up with the disk. Run "python uxo_dataset.py <export_dir> --benchmark <num_samples>" to measure the
+throughput.
+"""
+
+
+MODALITIES = ('aris_raw', 'aris_polar', 'gopro', 'gantry', 'ar3', 'pose', 'meta')
+IMAGE_MODALITIES = ('aris_raw', 'aris_polar', 'gopro')
+DEFAULT_MODALITIES = ('aris_polar', 'gopro', 'gantry', 'pose', 'meta')
+
+GANTRY_COLUMNS = ['x', 'y', 'z', 'vx', 'vy', 'vz']
+POSE_COLUMNS = ['pos.x', 'pos.y', 'pos.z', 'rot.x', 'rot.y', 'rot.z', 'rot.w']
+
+# One row per exported ARIS frame
+INDEX_DTYPE = np.dtype([
+    ('recording', np.int32),
+    ('aris_frame_idx', np.int32),
+    ('has_gopro', np.bool_),
+])
+
+
+def _list_frames(frame_dir):
+    # Frame numbers and file extension of an export folder (e.g. aris_polar/0042.png), the extension
+    # is None if there are no frames
+    if not os.path.isdir(frame_dir):
+        return np.empty(0, dtype=np.int32), None
+    names = [f for f in os.listdir(frame_dir) if f[:1].isdigit()]
+    if not names:
+        return np.empty(0, dtype=np.int32), None
+    ext = os.path.splitext(names[0])[1]
+    frames = np.array([int(os.path.splitext(f)[0]) for f in names], dtype=np.int32)
+    frames.sort()
+    return frames, ext
+
+
+def _index_from_file(root):
+    # Uses the dataset index written by the export if it covers root, None otherwise
+    index = find_index(root)
+    if index is None:
+        return None
+
+    with index:
+        recs = index.recordings_under(root)
+        if not recs:
+            return None
+
+        recordings = []
+        tables = []
+        for rec_id, rec in enumerate(recs):
+            recordings.append(dict(
+                name=rec['name'],
+                target_type=rec['target_type'],
+                path=rec['abspath'],
+                ext={m: rec[m + '_ext'] or None for m in IMAGE_MODALITIES},
+            ))
+            frames = index.get_frames(rec['id'])
+            table = np.empty(len(frames), dtype=INDEX_DTYPE)
+            table['recording'] = rec_id
+            table['aris_frame_idx'] = frames['aris_frame_idx']
+            table['has_gopro'] = frames['gopro_size'] >= 0
+            tables.append(table)
+
+    return recordings, np.concatenate(tables)
+
+
+def build_index(root, use_index_file=True):
+    """
+    Returns the recordings (list of dicts) and the frame index (structured array with INDEX_DTYPE)
+    of an export. They are read from the dataset index (see common/dataset_index.py) if there is
+    one, otherwise the export tree is walked once; only directories are listed, no file is opened.
+    """
+    if use_index_file:
+        res = _index_from_file(root)
+        if res is not None:
+            return res
+
+    recordings = []
+    tables = []
+    for target_type, rec_dir in iter_recordings(root):
+        aris_frames, aris_polar_ext = _list_frames(os.path.join(rec_dir, 'aris_polar'))
+        raw_frames, aris_raw_ext = _list_frames(os.path.join(rec_dir, 'aris_raw'))
+        gopro_frames, gopro_ext = _list_frames(os.path.join(rec_dir, 'gopro'))
+        if not len(aris_frames):
+            aris_frames = raw_frames
+
+        rec_id = len(recordings)
+        recordings.append(dict(
+            name=os.path.basename(rec_dir),
+            target_type=target_type,
+            path=rec_dir,
+            ext={'aris_polar': aris_polar_ext, 'aris_raw': aris_raw_ext, 'gopro': gopro_ext},
+        ))
+
+        table = np.empty(len(aris_frames), dtype=INDEX_DTYPE)
+        table['recording'] = rec_id
+        table['aris_frame_idx'] = aris_frames
+        table['has_gopro'] = np.isin(aris_frames, gopro_frames, assume_unique=True)
+        tables.append(table)
+
+    index = np.concatenate(tables) if tables else np.empty(0, dtype=INDEX_DTYPE)
+    return recordings, index
+
+
+def _read_image(path, flags=cv2.IMREAD_UNCHANGED):
+    img = cv2.imread(path, flags)
+    if img is None:
+        raise IOError(f'Could not read {path}')
+    return img
+
+
+class _RecordingTables:
+    # The small per-recording tables, aligned by ARIS frame index
+    def __init__(self, rec):
+        path = rec['path']
+
+        gantry = pd.read_csv(os.path.join(path, 'gantry.csv'))
+        self.gantry = self._lookup_table(gantry, 'aris_frame_idx', GANTRY_COLUMNS)
+
+        ar3_file = os.path.join(path, 'ar3.csv')
+        self.ar3 = None
+        if os.path.isfile(ar3_file):
+            self.ar3 = self._lookup_table(pd.read_csv(ar3_file), 'aris_frame_idx', POSE_COLUMNS)
+
+        self.pose = None
+        pose_npz = os.path.join(path, 'sonar_pose.npz')
+        pose_csv = os.path.join(path, 'sonar_pose.csv')
+        if os.path.isfile(pose_npz):
+            with np.load(pose_npz) as f:
+                self.pose = (f['aris_frame_idx'].astype(np.int64), f['pose'].astype(np.float64))
+        elif os.path.isfile(pose_csv):
+            self.pose = self._lookup_table(pd.read_csv(pose_csv), 'aris_frame_idx', POSE_COLUMNS)
+
+        meta = pd.read_csv(os.path.join(path, 'aris_frame_meta.csv'))
+        meta = meta.sort_values(FrameHeaderFields.frame_index.value)
+        self.meta_frames = meta[FrameHeaderFields.frame_index.value].to_numpy(np.int64)
+        self.meta_columns = list(meta.columns)
+        self.meta = meta.to_dict('records')
+
+    @staticmethod
+    def _lookup_table(df, key, columns):
+        df = df.sort_values(key)
+        columns = [c for c in columns if c in df]
+        return df[key].to_numpy(np.int64), df[columns].to_numpy(np.float64)
+
+    @staticmethod
+    def _find(frames, frame_idx):
+        i = np.searchsorted(frames, frame_idx)
+        return i if i < len(frames) and frames[i] == frame_idx else None
+
+    def row(self, table, frame_idx):
+        if table is None:
+            return None
+        frames, values = table
+        i = self._find(frames, frame_idx)
+        if i is None:
+            return np.full(values.shape[1], np.nan)
+        return values[i]
+
+    def meta_row(self, frame_idx):
+        i = self._find(self.meta_frames, frame_idx)
+        return None if i is None else self.meta[i]
+
+
+class UXODataset:
+    """
+    Synchronized samples of an exported dataset. Subsets created by select() and shard() share the
+    loaded tables and the frame cache with the dataset they were created from.
+    """
+    def __init__(self,
+                 root: str,
+                 modalities=DEFAULT_MODALITIES,
+                 target_types=None,
+                 with_gopro: bool = None,
+                 gopro_reduce: int = 1,
+                 cache_mb: int = 0,
+                 use_index_file: bool = True):
+        unknown = set(modalities) - set(MODALITIES)
+        if unknown:
+            raise ValueError(f'Unknown modalities {sorted(unknown)}, choose from {MODALITIES}')
+        if gopro_reduce not in (1, 2, 4, 8):
+            raise ValueError('gopro_reduce must be 1, 2, 4 or 8')
+
+        self.root = root
+        self.modalities = tuple(modalities)
+        self.gopro_reduce = gopro_reduce
+        self.recordings, self.index = build_index(root, use_index_file)
+
+        self._tables = {}
+        self._tables_lock = threading.Lock()
+        # Decoded frames, only worth it if samples are visited more than once (e.g. several epochs)
+        self._cache = LRUCache('uxo_dataset', max_bytes=cache_mb * 2**20) if cache_mb > 0 else None
+
+        if target_types is not None or with_gopro is not None:
+            self.index = self.select(target_types=target_types, with_gopro=with_gopro).index
+
+    def _subset(self, index):
+        sub = object.__new__(UXODataset)
+        sub.__dict__.update(self.__dict__)
+        sub.index = index
+        return sub
+
+    def select(self, target_types=None, recordings=None, with_gopro=None):
+        mask = np.ones(len(self.index), dtype=bool)
+        if target_types is not None:
+            rec_ids = [i for i,rec in enumerate(self.recordings) if rec['target_type'] in target_types]
+            mask &= np.isin(self.index['recording'], rec_ids)
+        if recordings is not None:
+            rec_ids = [i for i,rec in enumerate(self.recordings) if rec['name'] in recordings]
+            mask &= np.isin(self.index['recording'], rec_ids)
+        if with_gopro is not None:
+            mask &= self.index['has_gopro'] == with_gopro
+        return self._subset(self.index[mask])
+
+    def shard(self, num_shards: int, shard_id: int, contiguous: bool = True):
+        # Contiguous shards keep the frames of a recording together, which is friendlier to the disk
+        # and the table loading; strided shards are better balanced across target types
+        if not 0 <= shard_id < num_shards:
+            raise ValueError(f'shard_id must be in [0, {num_shards})')
+        if contiguous:
+            bounds = np.linspace(0, len(self.index), num_shards + 1).astype(int)
+            return self._subset(self.index[bounds[shard_id]:bounds[shard_id + 1]])
+        return self._subset(self.index[shard_id::num_shards])
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.index)
+        if not 0 <= i < len(self.index):
+            raise IndexError(i)
+        return self._load_sample(self.index[i])
+
+    def __iter__(self):
+        return self.stream()
+
+    def stream(self, shuffle: bool = False, seed=None, num_threads: int = 4, readahead: int = 32):
+        """
+        Yields all samples, loading up to readahead samples ahead on num_threads threads. The order
+        is the index order (by recording and frame) unless shuffle is set.
+        """
+        order = np.arange(len(self.index))
+        if shuffle:
+            np.random.default_rng(seed).shuffle(order)
+
+        if num_threads <= 1:
+            for i in order:
+                yield self._load_sample(self.index[i])
+            return
+
+        with ThreadPoolExecutor(num_threads) as pool:
+            pending = deque()
+            for i in order:
+                pending.append(pool.submit(self._load_sample, self.index[i]))
+                if len(pending) >= readahead:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def get_tables(self, rec_id):
+        tables = self._tables.get(rec_id)
+        if tables is None:
+            with self._tables_lock:
+                tables = self._tables.get(rec_id)
+                if tables is None:
+                    tables = _RecordingTables(self.recordings[rec_id])
+                    self._tables[rec_id] = tables
+        return tables
+
+    def get_frame_path(self, rec_id, modality, aris_frame_idx):
+        rec = self.recordings[rec_id]
+        if rec['ext'][modality] is None:
+            raise ValueError(f'Recording {rec["name"]} has no {modality} frames')
+        return os.path.join(rec['path'], modality, f'{aris_frame_idx:04}{rec["ext"][modality]}')
+
+    def _load_image(self, rec_id, modality, aris_frame_idx):
+        path = self.get_frame_path(rec_id, modality, aris_frame_idx)
+        if modality == 'gopro':
+            flags = {1: cv2.IMREAD_COLOR,
+                     2: cv2.IMREAD_REDUCED_COLOR_2,
+                     4: cv2.IMREAD_REDUCED_COLOR_4,
+                     8: cv2.IMREAD_REDUCED_COLOR_8}[self.gopro_reduce]
+            return _read_image(path, flags)
+        # Sonar frames may also have been exported as WebP, which always decodes to 3 channels
+        return _read_image(path, cv2.IMREAD_GRAYSCALE)
+
+    def load_image(self, rec_id, modality, aris_frame_idx):
+        if self._cache is None:
+            return self._load_image(rec_id, modality, aris_frame_idx)
+        return self._cache.get((rec_id, modality, aris_frame_idx),
+                               lambda: self._load_image(rec_id, modality, aris_frame_idx))
+
+    def _load_sample(self, row):
+        rec_id = int(row['recording'])
+        frame_idx = int(row['aris_frame_idx'])
+        rec = self.recordings[rec_id]
+
+        sample = {
+            'recording': rec['name'],
+            'target_type': rec['target_type'],
+            'aris_frame_idx': frame_idx,
+        }
+
+        for modality in self.modalities:
+            if modality == 'gopro':
+                sample['gopro'] = self.load_image(rec_id, 'gopro', frame_idx) if row['has_gopro'] else None
+            elif modality in IMAGE_MODALITIES:
+                # Recordings may have been exported without raw or polar frames
+                sample[modality] = self.load_image(rec_id, modality, frame_idx) if rec['ext'][modality] is not None else None
+            else:
+                tables = self.get_tables(rec_id)
+                if modality == 'meta':
+                    sample['meta'] = tables.meta_row(frame_idx)
+                else:
+                    sample[modality] = tables.row(getattr(tables, modality), frame_idx)
+
+        return sample
+
+    def get_file_meta(self, rec_id):
+        with open(os.path.join(self.recordings[rec_id]['path'], 'aris_file_meta.yaml')) as f:
+            return yaml.safe_load(f)
+
+    def __repr__(self):
+        num_recs = len(np.unique(self.index['recording']))
+        return f'UXODataset({self.root}: {len(self)} samples from {num_recs} recordings, modalities {list(self.modalities)})'
+
+
+def collate(samples):
+    """
+    Combines a list of samples into a dict of lists. Arrays of the same shape (e.g. the table rows
+    or equally sized images) are stacked into one array.
+    """
+    batch = {}
+    for key in samples[0]:
+        values = [s[key] for s in samples]
+        if all(isinstance(v, np.ndarray) for v in values) and len({v.shape for v in values}) == 1:
+            values = np.stack(values)
+        batch[key] = values
+    return batch
+
+
+def benchmark(root, num_samples, modalities, num_threads, shuffle, gopro_reduce):
+    t = time.perf_counter()
+    ds = UXODataset(root, modalities=modalities, gopro_reduce=gopro_reduce)
+    print(f'{ds}\nindexed in {(time.perf_counter() - t) * 1000:.1f}ms')
+    if not len(ds):
+        return
+
+    # Sequential reads of the same files for reference, i.e. what the disk (or page cache) delivers
+    num_samples = min(num_samples, len(ds))
+    order = np.random.default_rng(0).permutation(len(ds))[:num_samples] if shuffle else np.arange(num_samples)
+    t = time.perf_counter()
+    num_bytes = 0
+    for i in order:
+        row = ds.index[i]
+        for modality in modalities:
+            if modality in IMAGE_MODALITIES and (modality != 'gopro' or row['has_gopro']):
+                with open(ds.get_frame_path(row['recording'], modality, row['aris_frame_idx']), 'rb') as f:
+                    num_bytes += len(f.read())
+    t_read = time.perf_counter() - t
+
+    sub = ds._subset(ds.index[order])
+    t = time.perf_counter()
+    num_decoded = 0
+    for sample in sub.stream(num_threads=num_threads):
+        num_decoded += sum(v.nbytes for v in sample.values() if isinstance(v, np.ndarray))
+    t_stream = time.perf_counter() - t
+
+    print(f'file reads: {num_samples / t_read:8.1f} samples/s, {num_bytes / t_read / 1e6:7.1f}MB/s')
+    print(f'stream:     {num_samples / t_stream:8.1f} samples/s, {num_bytes / t_stream / 1e6:7.1f}MB/s read, '
+          f'{num_decoded / t_stream / 1e6:.1f}MB/s decoded ({num_threads} threads)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Read synchronized samples from an exported dataset')
+    parser.add_argument('root', help='export dir, its recordings folder or a single recording')
+    parser.add_argument('-m', '--modalities', nargs='+', choices=MODALITIES, default=list(DEFAULT_MODALITIES))
+    parser.add_argument('-t', '--threads', type=int, default=4)
+    parser.add_argument('-r', '--gopro-reduce', type=int, choices=[1, 2, 4, 8], default=1, help='decode GoPro frames at a reduced size')
+    parser.add_argument('--shuffle', action='store_true')
+    parser.add_argument('--benchmark', type=int, metavar='NUM_SAMPLES', default=0, help='measure the throughput and exit')
+
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.root, args.benchmark, args.modalities, args.threads, args.shuffle, args.gopro_reduce)
+        sys.exit(0)
+
+    ds = UXODataset(args.root, modalities=args.modalities)
+    print(ds)
+    for rec_id, rec in enumerate(ds.recordings):
+        rows = ds.index[ds.index['recording'] == rec_id]
+        print(f' - {rec["target_type"]}/{rec["name"]}: {len(rows)} frames, {rows["has_gopro"].sum()} with GoPro')
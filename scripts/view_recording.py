@@ -2,32 +2,63 @@
 
 import sys
 import os
+import time
 import argparse
-from functools import lru_cache
+from collections import deque
 import yaml
+import numpy as np
 import pandas as pd
 import cv2
 from PyQt5 import QtCore, QtGui, QtWidgets
 
 from common.matching_context import folder_basename
+from common.dataset_index import find_index
 from common.aris_definitions import FrameHeaderFields
 from common.q_custom_widgets import MainWidget, MySlider
+from common.q_frame_loader import FramePrefetcher, ring_indices
+
+
+PLAYBACK_SPEEDS = [0.25, 0.5, 1., 2., 4., 8.]
 
 
 class DatasetViewer(QtWidgets.QMainWindow):
-    def __init__(self, recording_dir: str, aris_polar: bool = True, aris_colorize: bool = True, use_lru_cache: bool = False):
+    def __init__(self, recording_dir: str, aris_polar: bool = True, aris_colorize: bool = True, prefetch_frames: int = 8, cache_mb: int = 512, speed: float = 1.):
         super().__init__()
         
         self._recording_dir = recording_dir
         self._aris_polar = aris_polar
         self._aris_colorize = aris_colorize
         self._pos = 0
-        
-        if use_lru_cache:
-            self.get_data = lru_cache(None)(self.get_data)
+        self._direction = 1
+        
+        # Images are loaded, decoded and scaled in the background, the UI only shows what is ready.
+        # The frames around the current position are prefetched in both directions and kept in 
+        # bounded caches (GoPro frames are a lot larger, so they get most of the memory).
+        self._images = {}  # canvas -> image currently shown
+        self._display_sizes = {}  # canvas -> size the loaders scale the images to
+        self._aris_loader = FramePrefetcher('aris_frames', self._load_aris_frame, prefetch_frames, cache_mb // 4 * 2**20)
+        self._gopro_loader = FramePrefetcher('gopro_frames', self._load_gopro_frame, prefetch_frames, cache_mb * 3 // 4 * 2**20, num_threads=2)
+        self._aris_loader.frameReady.connect(self._on_aris_frame_ready)
+        self._gopro_loader.frameReady.connect(self._on_gopro_frame_ready)
+        
+        # Playback follows the recorded frame times. The timer runs faster than the frame rate and 
+        # each tick jumps to the frame that is due, so frames that are not loaded in time are 
+        # dropped instead of slowing down playback.
+        self._playing = False
+        self._playback_start = None  # wall time and recording time (µs) when playback (re)started
+        self._playback_timer = QtCore.QTimer(self)
+        self._playback_timer.setTimerType(QtCore.Qt.PreciseTimer)
+        self._playback_timer.timeout.connect(self._playback_tick)
+        self._shown_times = deque(maxlen=256)  # when frames were shown during playback
+        self._last_shown_pos = -1
+        self._frames_advanced = 0
+        self._frames_shown = 0
+        self._stats_updated = 0.
         
         self._make_gui()
         self._load_recording(recording_dir, aris_polar=aris_polar)
+        self._speed_select.setCurrentIndex(int(np.argmin([abs(s - speed) for s in PLAYBACK_SPEEDS])))
+        self._update_playback_info(force=True)
         self.update()
         self.show()
         
@@ -75,6 +106,24 @@ class DatasetViewer(QtWidgets.QMainWindow):
         self._slider.setPageStep(10)
         self._slider.valueChanged.connect(self._pos_set)
         
+        self._play_button = QtWidgets.QPushButton('Play')
+        self._play_button.setFocusPolicy(QtCore.Qt.NoFocus)
+        self._play_button.clicked.connect(self.toggle_playback)
+        
+        self._speed_select = QtWidgets.QComboBox()
+        self._speed_select.setFocusPolicy(QtCore.Qt.NoFocus)
+        self._speed_select.addItems([f'{s:g}x' for s in PLAYBACK_SPEEDS])
+        self._speed_select.currentIndexChanged.connect(self._speed_changed)
+        
+        self._playback_info = QtWidgets.QLabel()
+        self._playback_info.setMinimumWidth(260)
+        
+        controls = QtWidgets.QHBoxLayout()
+        controls.addWidget(self._play_button)
+        controls.addWidget(self._speed_select)
+        controls.addWidget(self._slider, 1)
+        controls.addWidget(self._playback_info)
+        
         info_boxes = QtWidgets.QHBoxLayout()
         for box,title,stretch in zip([self._notes_info, self._file_info, self._frame_info], 
                              ['Notes', 'File Metadata', 'Frame Metadata'],
@@ -98,6 +147,7 @@ class DatasetViewer(QtWidgets.QMainWindow):
         
         self._layout = QtWidgets.QVBoxLayout(self._main_widget)
         self._layout.addWidget(splitter)
+        self._layout.addLayout(controls)
         self.setCentralWidget(self._main_widget)
 
         self.resize(1200, 960)
@@ -105,32 +155,48 @@ class DatasetViewer(QtWidgets.QMainWindow):
     def resizeEvent(self, event):
         super().resizeEvent(event)
         self.scale_image()
+    
+    def closeEvent(self, event):
+        self._playback_timer.stop()
+        self._aris_loader.stop()
+        self._gopro_loader.stop()
+        super().closeEvent(event)
 
     # Scale the image while keeping the aspect ratio
     def scale_image(self):
-        aris = self._canvas_aris.pixmap()
-        gopro = self._canvas_gopro.pixmap()
-
-        if aris:
-            self._canvas_aris.setPixmap(aris.scaled(self._canvas_aris.size(), QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation))
-
-        if gopro:
-            self._canvas_gopro.setPixmap(gopro.scaled(self._canvas_gopro.size(), QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation))
+        for canvas, img in self._images.items():
+            self._show_image(img, canvas)
+    
+    def _show_image(self, img, canvas):
+        self._images[canvas] = img
+        if img is None:
+            canvas.clear()
+            return
+        
+        size = canvas.size()
+        if size != self._display_sizes.get(canvas):
+            # Frames that were scaled for the previous size are outdated, load them again
+            self._display_sizes[canvas] = QtCore.QSize(size)
+            loader = self._aris_loader if canvas is self._canvas_aris else self._gopro_loader
+            loader.cache.clear()
+            self.prefetch()
+        
+        # Usually the loader already scaled the image to the right size
+        if img.size().scaled(size, QtCore.Qt.KeepAspectRatio) != img.size():
+            img = img.scaled(size, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation)
+        canvas.setPixmap(QtGui.QPixmap.fromImage(img))
+    
+    def _scale_for(self, img, canvas):
+        # Runs on the loader threads, scaling full resolution images is too slow for the UI thread
+        size = self._display_sizes.get(canvas)
+        if size is None:
+            return img
+        return img.scaled(size, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation)
 
     def _load_recording(self, recording_dir: str, aris_polar: bool = True):
         self._dataset_name = folder_basename(recording_dir)
         
-        if aris_polar:
-            aris_dir = os.path.join(recording_dir, 'aris_polar')
-        if not aris_polar or not os.path.isdir(aris_dir):
-            aris_dir = os.path.join(recording_dir, 'aris_raw')
-        
-        self.aris_frames = sorted([os.path.join(aris_dir, f) 
-                                   for f in os.listdir(aris_dir)])
-        
-        gopro_dir = os.path.join(recording_dir, 'gopro')
-        self.gopro_frames = dict(sorted([(int(os.path.splitext(f)[0].lstrip('0')), os.path.join(gopro_dir, f)) 
-                                         for f in os.listdir(gopro_dir)]))
+        self.aris_frames, self.gopro_frames = self._find_frames(recording_dir, aris_polar)
         
         gantry_file = os.path.join(recording_dir, 'gantry.csv')
         self.gantry_data = pd.read_csv(gantry_file, index_col='aris_frame_idx')
@@ -138,6 +204,20 @@ class DatasetViewer(QtWidgets.QMainWindow):
         self.aris_frame_meta = pd.read_csv(os.path.join(recording_dir, 'aris_frame_meta.csv'), index_col=FrameHeaderFields.frame_index)
         self.aris_file_meta = yaml.safe_load(open(os.path.join(recording_dir, 'aris_file_meta.yaml')))
         
+        # Frame times relative to the first frame (µs). The recorded frame rate is only used if the 
+        # frame times are missing or broken.
+        frame_rate = self.aris_file_meta.get('FrameRate')
+        if not frame_rate and FrameHeaderFields.frame_rate.value in self.aris_frame_meta:
+            frame_rate = self.aris_frame_meta[FrameHeaderFields.frame_rate.value].median()
+        self.frame_rate = float(frame_rate or 15.)
+        
+        frame_idxs = [self.get_aris_frame_idx(pos) for pos in range(len(self.aris_frames))]
+        frame_times = self.aris_frame_meta[FrameHeaderFields.frame_time.value].reindex(frame_idxs).to_numpy(dtype=float)
+        if np.isnan(frame_times).any() or np.any(np.diff(frame_times) < 0):
+            print('Frame times are missing or not monotonic, using the frame rate for playback instead')
+            frame_times = np.arange(len(frame_idxs)) * 1e6 / self.frame_rate
+        self.frame_times = frame_times - frame_times[0]
+        
         self.notes = []
         notes_file = os.path.join(recording_dir, 'notes.txt')
         if os.path.isfile(notes_file):
@@ -145,10 +225,40 @@ class DatasetViewer(QtWidgets.QMainWindow):
             
         # Update some QT widgets that won't change per frame
         self.setWindowTitle('Dataset ' + self._dataset_name)
-        self._slider.setMaximum(len(self.aris_frames))
+        self._slider.setMaximum(len(self.aris_frames) - 1)
         self._file_info.setPlainText('\n'.join(f'{k}: {v}' for k,v in self.aris_file_meta.items()))
         self._notes_info.setPlainText('\n'.join(self.notes))
         
+    def _find_frames(self, recording_dir: str, aris_polar: bool = True):
+        # The dataset index knows all files of the export, so we don't have to list the folders
+        index = find_index(recording_dir)
+        rec = index.find_recording(recording_dir) if index is not None else None
+        if rec is not None:
+            with index:
+                frames = index.get_frames(rec['id'])
+            modality = 'aris_polar' if aris_polar and frames.size and (frames['aris_polar_size'] >= 0).all() else 'aris_raw'
+            aris_frames = [index.get_frame_path(rec, modality, idx) for idx in frames['aris_frame_idx']]
+            gopro_frames = {int(idx): index.get_frame_path(rec, 'gopro', idx) 
+                            for idx in frames['aris_frame_idx'][frames['gopro_size'] >= 0]}
+            return aris_frames, gopro_frames
+        if index is not None:
+            index.close()
+        
+        if aris_polar:
+            aris_dir = os.path.join(recording_dir, 'aris_polar')
+        if not aris_polar or not os.path.isdir(aris_dir):
+            aris_dir = os.path.join(recording_dir, 'aris_raw')
+        
+        aris_frames = sorted([os.path.join(aris_dir, f) 
+                              for f in os.listdir(aris_dir)])
+        
+        gopro_dir = os.path.join(recording_dir, 'gopro')
+        gopro_frames = {}
+        if os.path.isdir(gopro_dir):
+            gopro_frames = dict(sorted([(int(os.path.splitext(f)[0]), os.path.join(gopro_dir, f)) 
+                                        for f in os.listdir(gopro_dir)]))
+        return aris_frames, gopro_frames
+    
     def _handle_keypress(self, key):
         if key == QtCore.Qt.Key.Key_Left:
             self._pos_adjust(-1)
@@ -158,6 +268,12 @@ class DatasetViewer(QtWidgets.QMainWindow):
             self._pos_adjust(-10)
         elif key == QtCore.Qt.Key.Key_Up:
             self._pos_adjust(10)
+        elif key == QtCore.Qt.Key.Key_Space:
+            self.toggle_playback()
+        elif key in (QtCore.Qt.Key.Key_Plus, QtCore.Qt.Key.Key_BracketRight):
+            self._speed_select.setCurrentIndex(min(self._speed_select.currentIndex() + 1, len(PLAYBACK_SPEEDS) - 1))
+        elif key in (QtCore.Qt.Key.Key_Minus, QtCore.Qt.Key.Key_BracketLeft):
+            self._speed_select.setCurrentIndex(max(self._speed_select.currentIndex() - 1, 0))
         elif key == QtCore.Qt.Key.Key_Q:
             self.close()
         
@@ -165,15 +281,104 @@ class DatasetViewer(QtWidgets.QMainWindow):
         self._pos_set(self._pos + steps)
         
     def _pos_set(self, pos):
+        # Frames in the direction we're moving are prefetched first
+        if pos != self._pos:
+            self._direction = 1 if pos > self._pos else -1
         self._pos = pos % len(self.aris_frames)
+        
+        # Continue playback from here
+        if self._playing:
+            self._playback_start = (time.perf_counter(), self.frame_times[self._pos])
         self.update()
     
-    def get_data(self, pos):
-        # We step through the ARIS frames and get the other data points by frame index
-        aris_file = self.aris_frames[pos]
-        aris_frame_idx = int(os.path.splitext(os.path.basename(aris_file))[0])
-        
-        aris_frame = cv2.imread(aris_file)
+    @property
+    def speed(self):
+        return PLAYBACK_SPEEDS[self._speed_select.currentIndex()]
+    
+    @property
+    def target_fps(self):
+        return self.frame_rate * self.speed
+    
+    def toggle_playback(self):
+        self._playing = not self._playing
+        self._play_button.setText('Pause' if self._playing else 'Play')
+        if self._playing:
+            if self._pos >= len(self.aris_frames) - 1:
+                self._pos = 0
+            self._direction = 1
+            self._playback_start = (time.perf_counter(), self.frame_times[self._pos])
+            self._shown_times.clear()
+            self._frames_advanced = 0
+            self._frames_shown = 0
+            
+            # Ticks at twice the target rate are within half a frame of the due time
+            self._playback_timer.start(max(2, int(500 / self.target_fps)))
+            self.update()
+        else:
+            self._playback_timer.stop()
+        self._update_playback_info(force=True)
+    
+    def _speed_changed(self, idx):
+        if self._playing:
+            self._playback_start = (time.perf_counter(), self.frame_times[self._pos])
+            self._playback_timer.setInterval(max(2, int(500 / self.target_fps)))
+            self._shown_times.clear()
+        self._update_playback_info(force=True)
+    
+    def _playback_tick(self):
+        # Jump to the frame that is due according to the frame times
+        wall_start, rec_start = self._playback_start
+        rec_time = rec_start + (time.perf_counter() - wall_start) * 1e6 * self.speed
+        pos = int(np.searchsorted(self.frame_times, rec_time, side='right')) - 1
+        
+        if pos >= len(self.aris_frames) - 1:
+            self._advance_playback(len(self.aris_frames) - 1)
+            self.toggle_playback()
+        elif pos > self._pos:
+            self._advance_playback(pos)
+        self._update_playback_info()
+    
+    def _advance_playback(self, pos):
+        self._frames_advanced += pos - self._pos
+        self._pos = pos
+        self.update()
+    
+    def _frame_shown(self, pos):
+        # Counts the frames that were actually shown during playback, everything else was dropped
+        if self._playing and pos != self._last_shown_pos:
+            self._shown_times.append(time.perf_counter())
+            self._frames_shown += 1
+        self._last_shown_pos = pos
+    
+    def measured_fps(self):
+        if len(self._shown_times) < 2:
+            return 0.
+        # Only the last two seconds
+        now = time.perf_counter()
+        times = [t for t in self._shown_times if now - t < 2.]
+        if len(times) < 2:
+            return 0.
+        return (len(times) - 1) / (now - times[0])
+    
+    def _update_playback_info(self, force=False):
+        # Updating the label every frame would be a waste
+        now = time.perf_counter()
+        if not force and now - self._stats_updated < 0.5:
+            return
+        self._stats_updated = now
+        
+        if not self._playing:
+            self._playback_info.setText(f'Paused, {self.target_fps:.1f} fps at {self.speed:g}x (space to play)')
+            return
+        dropped = max(0, self._frames_advanced - self._frames_shown)
+        self._playback_info.setText(f'{self.measured_fps():.1f} / {self.target_fps:.1f} fps, {dropped} dropped')
+    
+    def get_aris_frame_idx(self, pos):
+        return int(os.path.splitext(os.path.basename(self.aris_frames[pos]))[0])
+    
+    def _load_aris_frame(self, pos):
+        # Runs on the loader thread, so it must not create any QPixmaps
+        aris_frame = cv2.imread(self.aris_frames[pos])
         
         if not self._aris_polar:
             # In ARIS frames, beams are ordered right to left
@@ -184,25 +389,73 @@ class DatasetViewer(QtWidgets.QMainWindow):
             aris_frame = cv2.applyColorMap(aris_frame, cv2.COLORMAP_TWILIGHT_SHIFTED)  
             
         h, w, channels = aris_frame.shape
+        # rgbSwapped creates a copy, so the image doesn't reference the numpy buffer anymore
         aris = QtGui.QImage(aris_frame.data, w, h, channels * w, QtGui.QImage.Format_RGB888).rgbSwapped()
-        aris = QtGui.QPixmap(aris)
-        
-        if pos < len(self.gopro_frames):
-            gopro = QtGui.QPixmap(self.gopro_frames[aris_frame_idx])
-        else:
-            gopro = None
-            
+        return self._scale_for(aris, self._canvas_aris)
+    
+    def _load_gopro_frame(self, pos):
+        # Runs on the loader thread
+        gopro_file = self.gopro_frames.get(self.get_aris_frame_idx(pos))
+        if gopro_file is None:
+            return None
+        # JPEGs can be decoded at a reduced size right away, which is a lot faster than scaling the
+        # full resolution image afterwards
+        reader = QtGui.QImageReader(gopro_file)
+        size = self._display_sizes.get(self._canvas_gopro)
+        if size is not None and reader.size().isValid():
+            reader.setScaledSize(reader.size().scaled(size, QtCore.Qt.KeepAspectRatio))
+        gopro = reader.read()
+        return None if gopro.isNull() else gopro
+    
+    def get_data(self, pos):
+        # We step through the ARIS frames and get the other data points by frame index. Images that
+        # have not been loaded yet are None.
+        aris_frame_idx = self.get_aris_frame_idx(pos)
+        aris = self._aris_loader.get(pos)
+        gopro = self._gopro_loader.get(pos)
         gantry = self.gantry_data.loc[aris_frame_idx]
         frame_meta = self.aris_frame_meta.loc[aris_frame_idx]
         
         return aris_frame_idx, aris, gopro, gantry, frame_meta
     
+    def prefetch(self):
+        last = len(self.aris_frames) - 1
+        if self._playing:
+            # Frames we already passed will never be shown
+            keys = list(range(self._pos, min(self._pos + 2 * self._aris_loader.ring_size, last) + 1))
+        else:
+            keys = ring_indices(self._pos, self._direction, self._aris_loader.ring_size, 0, last)
+        self._aris_loader.request(keys)
+        self._gopro_loader.request(keys)
+    
+    @QtCore.pyqtSlot(object, object)
+    def _on_aris_frame_ready(self, pos, img):
+        if pos == self._pos:
+            self._show_image(img, self._canvas_aris)
+            self._frame_shown(pos)
+    
+    @QtCore.pyqtSlot(object, object)
+    def _on_gopro_frame_ready(self, pos, img):
+        if pos == self._pos:
+            self._show_image(img, self._canvas_gopro)
+    
     def update(self):
+        self.prefetch()
         aris_frame_idx, aris, gopro, gantry, frame_meta = self.get_data(self._pos)
         
+        # Images that are not ready yet are shown once they arrive (see _on_aris_frame_ready), until
+        # then the previous ones stay visible so that the UI never has to wait
         self._pos_info.setText(f'Frame {aris_frame_idx} ({self._pos + 1} / {len(self.aris_frames)})')
-        self._canvas_aris.setPixmap(aris)
-        self._canvas_gopro.setPixmap(gopro)
+        self._slider.blockSignals(True)
+        self._slider.setValue(self._pos)
+        self._slider.blockSignals(False)
+        if aris is not None:
+            self._show_image(aris, self._canvas_aris)
+            self._frame_shown(self._pos)
+        if gopro is not None:
+            self._show_image(gopro, self._canvas_gopro)
+        elif aris_frame_idx not in self.gopro_frames:
+            self._show_image(None, self._canvas_gopro)
         self._gantry_info.setText('\n'.join(f'{k}: {v}' for k,v in gantry.to_dict().items()))
         
         # Prevent the frame infobox from scrolling on update. Only works with line wrapping disabled.
@@ -217,7 +470,9 @@ if __name__ == '__main__':
     parser.add_argument('recording_dir')
     parser.add_argument('-p', '--polar', action=argparse.BooleanOptionalAction, default=True)
     parser.add_argument('-c', '--colorize', action=argparse.BooleanOptionalAction, default=True)
-    parser.add_argument('-l', '--use-lru-cache', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('-n', '--prefetch', type=int, default=8, help='number of frames to load ahead in each direction')
+    parser.add_argument('-m', '--cache-size', type=int, default=512, help='memory budget for loaded frames in MB')
+    parser.add_argument('-s', '--speed', type=float, default=1., help='playback speed as a multiple of the ARIS frame rate')
 
     args = parser.parse_args()
 
@@ -226,6 +481,8 @@ if __name__ == '__main__':
         args.recording_dir, 
         aris_polar=args.polar, 
         aris_colorize=args.colorize, 
-        use_lru_cache=args.use_lru_cache
+        prefetch_frames=args.prefetch,
+        cache_mb=args.cache_size,
+        speed=args.speed,
     )
     sys.exit(app.exec_())